@@ -1,6 +1,13 @@
 from dotenv import dotenv_values
 
 config = dotenv_values(".env")
+
+def _flag(name, default=False):
+    value=config.get(name)
+    if value is None or value=='':
+        return default
+    return value.strip().lower() in ('1','true','yes','on')
+
 class Config:
     SECRET_KEY=config['SECRET_KEY']
     ALGORITHM=config['ALGORITHM']
@@ -20,8 +27,215 @@ class GmailConfig:
 
 class PostgresSQLConfig:
     DATABASE_URL=config['DATABASE_URL']
+
+class ReplicaConfig:
+    # comma separated read replica URLs, read-only endpoints are spread over them
+    URLS=[url.strip() for url in (config.get('DATABASE_REPLICA_URLS') or '').split(',') if url.strip()]
+    # replicas further behind get no reads until they catch up
+    MAX_LAG_SECONDS=float(config.get('REPLICA_MAX_LAG_SECONDS') or 5)
+    LAG_CHECK_INTERVAL_SECONDS=float(config.get('REPLICA_LAG_CHECK_INTERVAL') or 5)
+    # clients stay on the primary this long after a write, longer than lag limit plus check interval
+    STICKY_SECONDS=float(config.get('REPLICA_STICKY_SECONDS') or 15)
+    # sqlite file recording which users stay on the primary, shared by the workers of a host
+    STATE_PATH=config.get('REPLICA_STATE_PATH') or '/tmp/fileserver-replicas.sqlite3'
     
 class CORSOrigins:
     FRONTEND_URL=config['FRONTEND_URL']
-    
 
+class DownloadConfig:
+    # "x-accel-redirect" (nginx), "x-sendfile" (apache/lighttpd) or empty to stream from python
+    OFFLOAD_MODE=(config.get('DOWNLOAD_OFFLOAD_MODE') or '').lower()
+    OFFLOAD_PREFIX=config.get('DOWNLOAD_OFFLOAD_PREFIX') or '/protected-files'
+
+class SQLProfilingConfig:
+    ECHO=_flag('SQL_ECHO')
+    # statements per request before the request is reported as over budget
+    QUERY_BUDGET=int(config.get('SQL_QUERY_BUDGET') or 25)
+    # executions of the same statement within one request that look like an N+1
+    N_PLUS_ONE_THRESHOLD=int(config.get('SQL_N_PLUS_ONE_THRESHOLD') or 5)
+    SLOWEST_STATEMENTS=int(config.get('SQL_SLOWEST_STATEMENTS') or 3)
+    # raise instead of logging, meant for the test suite and benchmarks
+    STRICT=_flag('SQL_PROFILE_STRICT')
+    # send the statement count and DB time of every request in a Server-Timing header; it tells
+    # callers about the internals, meant for the test suite, benchmarks and local debugging
+    SERVER_TIMING=_flag('SQL_SERVER_TIMING')
+
+class ProfilingConfig:
+    # requests sending "X-Profile: <token>" are profiled, and profiles are only served with it; empty disables both
+    TOKEN=config.get('PROFILE_TOKEN') or ''
+    # fraction of all requests profiled without the header, 0 profiles none
+    SAMPLE_RATE=float(config.get('PROFILE_SAMPLE_RATE') or 0)
+    DIRECTORY=config.get('PROFILE_DIR') or 'profiles'
+    # newest profiles kept in the directory, older ones are removed
+    MAX_PROFILES=int(config.get('PROFILE_MAX_PROFILES') or 200)
+    # sampling interval of pyinstrument; without it cProfile traces every call
+    INTERVAL_SECONDS=float(config.get('PROFILE_INTERVAL') or 0.001)
+
+def _volumes(value):
+    # "name=path,name=path", a bare path is named after itself
+    volumes=[]
+    for entry in (value or 'UPLOADS').split(','):
+        if entry.strip():
+            name,separator,path=entry.strip().partition('=')
+            volumes.append((name.strip(),path.strip()) if separator else (name.strip(),name.strip()))
+    return volumes
+
+class StorageConfig:
+    # mount points blobs are spread over, the first one also holds the version chunk store
+    VOLUMES=_volumes(config.get('STORAGE_VOLUMES'))
+    # "free_space" picks a volume weighted by its free space, "hash" by rendezvous hashing the blob's path
+    PLACEMENT=(config.get('STORAGE_PLACEMENT') or 'free_space').lower()
+    # volumes with less free space get no new blobs while another volume has more
+    VOLUME_MIN_FREE_BYTES=int(config.get('STORAGE_VOLUME_MIN_FREE_BYTES') or 1024**3)
+    # volumes that get no new blobs and whose blobs are moved off in the background
+    DRAIN_VOLUMES={name.strip() for name in (config.get('STORAGE_DRAIN_VOLUMES') or '').split(',') if name.strip()}
+    # "zstd" compresses text-like uploads at rest (needs the zstandard package), empty stores uploads as-is
+    COMPRESSION=(config.get('STORAGE_COMPRESSION') or '').lower()
+    COMPRESSION_LEVEL=int(config.get('STORAGE_COMPRESSION_LEVEL') or 3)
+    # files of one upload request written to disk at the same time
+    UPLOAD_CONCURRENCY=int(config.get('UPLOAD_CONCURRENCY') or 4)
+    # parts accepted in one directory tree upload
+    UPLOAD_MAX_FILES=int(config.get('UPLOAD_MAX_FILES') or 10000)
+    # blobs superseded by a copy at another path are removed this long after, so readers that
+    # looked the old path up just before still find it; the sweep runs every interval, 0 disables it
+    RETIRED_GRACE_SECONDS=int(config.get('RETIRED_BLOB_GRACE_SECONDS') or 300)
+    RETIRED_SWEEP_INTERVAL_SECONDS=int(config.get('RETIRED_BLOB_SWEEP_INTERVAL') or 60)
+
+class TieringConfig:
+    # downloads are recorded in memory and written to last_accessed_at this often
+    ACCESS_FLUSH_SECONDS=float(config.get('ACCESS_FLUSH_INTERVAL') or 60)
+    # directory of the cold tier (slower disk or archive mount), empty disables tiering
+    COLD_PATH=config.get('COLD_TIER_PATH') or ''
+    # files neither downloaded nor changed for this long move to the cold tier
+    COLD_AFTER_DAYS=int(config.get('COLD_TIER_AFTER_DAYS') or 90)
+    # cold blobs are zstd compressed when that makes them smaller (needs the zstandard package)
+    COMPRESS=_flag('COLD_TIER_COMPRESSION',True)
+    INTERVAL_SECONDS=int(config.get('COLD_TIER_INTERVAL') or 3600)
+    BATCH_SIZE=int(config.get('COLD_TIER_BATCH_SIZE') or 100)
+    # disk I/O budget of the demotions, 0 disables a limit
+    FILES_PER_SECOND=float(config.get('COLD_TIER_FILES_PER_SECOND') or 50)
+    MB_PER_SECOND=float(config.get('COLD_TIER_MB_PER_SECOND') or 50)
+
+class CacheConfig:
+    # memory of every worker for the content of small hot files, 0 disables the cache
+    BYTES=int(config.get('BLOB_CACHE_BYTES') or 64*1024**2)
+    MAX_OBJECT_BYTES=int(config.get('BLOB_CACHE_MAX_OBJECT_BYTES') or 256*1024)
+
+class RebalanceConfig:
+    # moves blobs off draining volumes and from the fullest to the emptiest volume, 0 disables it
+    INTERVAL_SECONDS=int(config.get('STORAGE_REBALANCE_INTERVAL') or 600)
+    # difference in free space fraction between volumes that is left alone
+    THRESHOLD=float(config.get('STORAGE_REBALANCE_THRESHOLD') or 0.1)
+    BATCH_SIZE=int(config.get('STORAGE_REBALANCE_BATCH_SIZE') or 100)
+    # disk I/O budget of the moves, 0 disables a limit
+    FILES_PER_SECOND=float(config.get('STORAGE_REBALANCE_FILES_PER_SECOND') or 50)
+    MB_PER_SECOND=float(config.get('STORAGE_REBALANCE_MB_PER_SECOND') or 100)
+
+class JobConfig:
+    # pending and running jobs whose row was not updated for this long are taken for dead (worker
+    # restart or crash) and marked failed; running jobs refresh it with every progress report
+    STALE_SECONDS=int(config.get('JOB_STALE_SECONDS') or 900)
+    # finished jobs are deleted after this many days, 0 keeps them
+    RETENTION_DAYS=int(config.get('JOB_RETENTION_DAYS') or 7)
+    SWEEP_INTERVAL_SECONDS=int(config.get('JOB_SWEEP_INTERVAL') or 300)
+
+class CopyConfig:
+    # copies fall back to hard links when the filesystem has no reflinks, blobs are never modified in place
+    HARDLINKS=_flag('COPY_HARDLINKS',True)
+    # larger folder copies run as background jobs
+    INLINE_MAX_FILES=int(config.get('COPY_INLINE_MAX_FILES') or 200)
+    INLINE_MAX_BYTES=int(config.get('COPY_INLINE_MAX_BYTES') or 1024**3)
+
+class DeltaConfig:
+    # block size of the signatures served for delta uploads when the client does not ask for one
+    BLOCK_SIZE=int(config.get('DELTA_BLOCK_SIZE') or 64*1024)
+
+class ExtractConfig:
+    # limits of uploaded zip archives, checked against the central directory before extracting
+    MAX_ENTRIES=int(config.get('EXTRACT_MAX_ENTRIES') or 20000)
+    MAX_BYTES=int(config.get('EXTRACT_MAX_BYTES') or 10*1024**3)
+    # largest uncompressed/compressed ratio of an entry over 1 MiB and of the whole archive;
+    # smaller entries are not checked one by one, many of them are only bounded by MAX_BYTES
+    # and the ratio of the whole archive
+    MAX_RATIO=float(config.get('EXTRACT_MAX_RATIO') or 100)
+    # larger archives are extracted by a background job
+    INLINE_MAX_FILES=int(config.get('EXTRACT_INLINE_MAX_FILES') or 200)
+    INLINE_MAX_BYTES=int(config.get('EXTRACT_INLINE_MAX_BYTES') or 256*1024**2)
+
+class MediaConfig:
+    # sniffs content types and extracts dimensions, dates, durations and page counts in the background
+    ENABLED=_flag('MEDIA_EXTRACTION',True)
+    INTERVAL_SECONDS=int(config.get('MEDIA_EXTRACTION_INTERVAL') or 30)
+    # processes parsing files in every worker, and files claimed per batch
+    WORKERS=int(config.get('MEDIA_EXTRACTION_WORKERS') or 2)
+    BATCH_SIZE=int(config.get('MEDIA_EXTRACTION_BATCH_SIZE') or 50)
+    # a batch not analysed within this is recorded without attributes
+    TIMEOUT_SECONDS=int(config.get('MEDIA_EXTRACTION_TIMEOUT') or 60)
+
+class VersioningConfig:
+    # re-uploading a file with the same name in a folder keeps the previous content as a version
+    ENABLED=_flag('FILE_VERSIONING',True)
+    # archived versions kept per file, 0 keeps all of them
+    MAX_VERSIONS=int(config.get('FILE_VERSIONS_MAX') or 20)
+    # archived versions older than this are pruned, 0 keeps them regardless of age
+    MAX_AGE_DAYS=int(config.get('FILE_VERSIONS_MAX_AGE_DAYS') or 90)
+    PRUNE_INTERVAL_SECONDS=int(config.get('FILE_VERSIONS_PRUNE_INTERVAL') or 3600)
+
+class TrashConfig:
+    # trashed files and folders are purged for good after this many days, 0 keeps trash forever
+    RETENTION_DAYS=int(config.get('TRASH_RETENTION_DAYS') or 30)
+    PURGE_INTERVAL_SECONDS=int(config.get('TRASH_PURGE_INTERVAL') or 3600)
+    PURGE_BATCH_SIZE=int(config.get('TRASH_PURGE_BATCH_SIZE') or 200)
+    # disk I/O budget of the scheduled purge so it does not compete with foreground requests, 0 disables a limit
+    PURGE_FILES_PER_SECOND=float(config.get('TRASH_PURGE_FILES_PER_SECOND') or 100)
+    PURGE_MB_PER_SECOND=float(config.get('TRASH_PURGE_MB_PER_SECOND') or 200)
+
+class IdempotencyConfig:
+    # POST, PUT, PATCH and DELETE requests with an Idempotency-Key header run once, retries get the stored response
+    ENABLED=_flag('IDEMPOTENCY_KEYS',True)
+    # how long responses are kept for retries
+    TTL_SECONDS=int(config.get('IDEMPOTENCY_TTL') or 24*3600)
+    # a retry waits this long for the first request to finish, then gets a 409
+    WAIT_SECONDS=float(config.get('IDEMPOTENCY_WAIT_SECONDS') or 60)
+    # a request still running after this is taken for dead (killed worker) and may run again
+    LEASE_SECONDS=int(config.get('IDEMPOTENCY_LEASE_SECONDS') or 3600)
+    # larger responses are not stored, their retries run again
+    MAX_RESPONSE_BYTES=int(config.get('IDEMPOTENCY_MAX_RESPONSE_BYTES') or 1024**2)
+    PURGE_INTERVAL_SECONDS=int(config.get('IDEMPOTENCY_PURGE_INTERVAL') or 3600)
+
+class PartitionConfig:
+    # copies the rows of file_metadata and folder into their partitioned tables between
+    # migrations 0011 and 0012, a cheap no-op otherwise; 0 disables the job
+    BACKFILL_INTERVAL_SECONDS=int(config.get('PARTITION_BACKFILL_INTERVAL') or 60)
+    BACKFILL_BATCH_SIZE=int(config.get('PARTITION_BACKFILL_BATCH_SIZE') or 5000)
+    # write budget of the backfill, 0 disables a limit
+    BACKFILL_ROWS_PER_SECOND=float(config.get('PARTITION_BACKFILL_ROWS_PER_SECOND') or 20000)
+
+def _limits(name, user_concurrency, global_concurrency, user_rate, user_burst, global_rate, global_burst):
+    # ADMISSION_<NAME>_USER_CONCURRENCY etc, 0 disables a limit
+    def value(setting, default):
+        return float(config.get(f'ADMISSION_{name}_{setting}') or default)
+    return {
+        'user_concurrency':int(value('USER_CONCURRENCY',user_concurrency)),
+        'global_concurrency':int(value('GLOBAL_CONCURRENCY',global_concurrency)),
+        'user_rate':value('USER_RATE',user_rate),
+        'user_burst':value('USER_BURST',user_burst),
+        'global_rate':value('GLOBAL_RATE',global_rate),
+        'global_burst':value('GLOBAL_BURST',global_burst),
+    }
+
+class AdmissionConfig:
+    ENABLED=_flag('ADMISSION_CONTROL',True)
+    # sqlite file shared by the workers on this host
+    STATE_PATH=config.get('ADMISSION_STATE_PATH') or '/tmp/fileserver-admission.sqlite3'
+    # concurrency slots of requests that never finished (killed worker) are reclaimed after this
+    SLOT_TIMEOUT_SECONDS=int(config.get('ADMISSION_SLOT_TIMEOUT') or 3600)
+    # largest accepted upload request body, and total bytes of files per user (0 = unlimited)
+    MAX_UPLOAD_BYTES=int(config.get('MAX_UPLOAD_BYTES') or 5*1024**3)
+    USER_QUOTA_BYTES=int(config.get('USER_QUOTA_BYTES') or 0)
+    # rates are requests per second, bursts the bucket size
+    LIMITS={
+        'upload':_limits('UPLOAD',4,64,2,20,50,200),
+        'zip':_limits('ZIP',2,8,0.2,4,2,16),
+        'download':_limits('DOWNLOAD',16,256,20,100,500,1000),
+    }
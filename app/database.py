@@ -1,20 +1,48 @@
-from config import PostgresSQLConfig
+from config import PostgresSQLConfig, ReplicaConfig, SQLProfilingConfig
 from sqlalchemy.orm import sessionmaker
-from sqlmodel import SQLModel,create_engine,Session
+from sqlalchemy.pool import QueuePool
+from sqlmodel import create_engine,Session
+
+from utils.metrics import DB_POOL_CHECKOUT_SECONDS
+from utils.replicas import READ_ONLY, choose_replica, install_write_tracking
+from utils.sql_profiler import install_query_profiler
+
+import time
 
 DATABASE_URL = PostgresSQLConfig.DATABASE_URL
 
-engine = create_engine(DATABASE_URL,echo=True)
+
+class TimedQueuePool(QueuePool):
+    # records how long requests wait for a free connection when the pool is exhausted
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+
+
+engine = create_engine(DATABASE_URL,echo=SQLProfilingConfig.ECHO,poolclass=TimedQueuePool)
+install_query_profiler(engine)
+install_write_tracking(engine)
+# read-only connections, a write routed to a replica by mistake fails instead of diverging
+replica_engines = [
+    create_engine(
+        url,
+        echo=SQLProfilingConfig.ECHO,
+        poolclass=TimedQueuePool,
+        execution_options={"postgresql_readonly": True},
+    )
+    for url in ReplicaConfig.URLS
+]
+for replica_engine in replica_engines:
+    install_query_profiler(replica_engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 '''
 #use when using sqlalchmey models
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base() 
 '''
-def create_db_and_tables():
-    print("Creating tables")
-    SQLModel.metadata.create_all(engine)
-    print("Tables created")
 # def get_db():
 #     pg_db = SessionLocal()
 #     try:
@@ -24,3 +52,10 @@ def create_db_and_tables():
 def get_session():
     with Session(engine) as session:
         yield session
+
+def get_read_session():
+    # for endpoints that only read, on a replica unless the client just wrote or all replicas lag
+    replica = choose_replica(replica_engines)
+    with Session(replica or engine) as session:
+        session.info[READ_ONLY] = replica is not None
+        yield session
@@ -1,28 +1,133 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 
-from routers import auth,file,folder,user
-
-from database import create_db_and_tables
+from routers import auth,file,folder,job,metrics,profiles,user
 
 import os
 
-from config import CORSOrigins
+from config import (
+    CORSOrigins,
+    IdempotencyConfig,
+    JobConfig,
+    MediaConfig,
+    PartitionConfig,
+    ProfilingConfig,
+    RebalanceConfig,
+    ReplicaConfig,
+    StorageConfig,
+    TieringConfig,
+    TrashConfig,
+    VersioningConfig,
+)
+from database import replica_engines
+
+from utils.admission import AdmissionControlMiddleware
+from utils.background import run_periodically
+from utils.idempotency import IdempotencyMiddleware, purge_expired_keys
+from utils.jobs import sweep_jobs
+from utils.media import extract_pending_media, shutdown_pool
+from utils.partitioning import backfill_partitions
+from utils.rebalance import rebalance_volumes
+from utils.replicas import ReplicaRoutingMiddleware, measure_replica_lag
+from utils.retired_blobs import remove_retired_blobs
+from utils.storage import VOLUMES
+from utils.tiering import demote_cold_files, flush_access_times
+from utils.trash import purge_expired_trash
+from utils.versions import prune_versions
+
+from utils.metrics import MetricsMiddleware
+from utils.profiler import ProfilerMiddleware
+from utils.sql_profiler import QueryProfilerMiddleware
 
 UPLOAD_FOLDER="UPLOADS"
 
 origins=[CORSOrigins.FRONTEND_URL]
 
+@asynccontextmanager
+async def lifespan(app):
+    tasks=[]
+    if VersioningConfig.PRUNE_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("prune_versions",VersioningConfig.PRUNE_INTERVAL_SECONDS,prune_versions)
+        ))
+    if TrashConfig.RETENTION_DAYS>0 and TrashConfig.PURGE_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("purge_expired_trash",TrashConfig.PURGE_INTERVAL_SECONDS,purge_expired_trash)
+        ))
+    if IdempotencyConfig.ENABLED and IdempotencyConfig.PURGE_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("purge_expired_keys",IdempotencyConfig.PURGE_INTERVAL_SECONDS,purge_expired_keys)
+        ))
+    if JobConfig.SWEEP_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("sweep_jobs",JobConfig.SWEEP_INTERVAL_SECONDS,sweep_jobs)
+        ))
+    if MediaConfig.ENABLED and MediaConfig.INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("extract_pending_media",MediaConfig.INTERVAL_SECONDS,extract_pending_media)
+        ))
+    if len(VOLUMES)>1 and RebalanceConfig.INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("rebalance_volumes",RebalanceConfig.INTERVAL_SECONDS,rebalance_volumes)
+        ))
+    if StorageConfig.RETIRED_SWEEP_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("remove_retired_blobs",StorageConfig.RETIRED_SWEEP_INTERVAL_SECONDS,remove_retired_blobs)
+        ))
+    if TieringConfig.ACCESS_FLUSH_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("flush_access_times",TieringConfig.ACCESS_FLUSH_SECONDS,flush_access_times)
+        ))
+    if TieringConfig.COLD_PATH and TieringConfig.COLD_AFTER_DAYS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("demote_cold_files",TieringConfig.INTERVAL_SECONDS,demote_cold_files)
+        ))
+    if PartitionConfig.BACKFILL_INTERVAL_SECONDS>0:
+        tasks.append(asyncio.create_task(
+            run_periodically("backfill_partitions",PartitionConfig.BACKFILL_INTERVAL_SECONDS,backfill_partitions)
+        ))
+    if replica_engines:
+        # replicas get no reads before their lag is known
+        await run_in_threadpool(measure_replica_lag,replica_engines)
+        tasks.append(asyncio.create_task(
+            run_periodically(
+                "measure_replica_lag",
+                ReplicaConfig.LAG_CHECK_INTERVAL_SECONDS,
+                lambda: measure_replica_lag(replica_engines),
+            )
+        ))
+    yield
+    for task in tasks:
+        task.cancel()
+    shutdown_pool()
+    # access times recorded since the last flush are not lost on a restart
+    flush_access_times()
+
 def create_app():
     app=FastAPI(
-        openapi_prefix="/api"
+        openapi_prefix="/api",
+        lifespan=lifespan,
     )
     app.include_router(auth.router)
     app.include_router(file.router)
     app.include_router(folder.router)
     app.include_router(user.router)
+    app.include_router(job.router)
+    app.include_router(metrics.router)
+    app.include_router(profiles.router)
     
+    # innermost, so rejections still carry CORS headers and show up in the request metrics
+    app.add_middleware(AdmissionControlMiddleware)
+    # outside admission control, replayed and waiting retries take no slots
+    if IdempotencyConfig.ENABLED:
+        app.add_middleware(IdempotencyMiddleware)
+    if replica_engines:
+        app.add_middleware(ReplicaRoutingMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=origins,
@@ -30,10 +135,16 @@ def create_app():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(QueryProfilerMiddleware)
+    # only installed when profiling can be triggered, other deployments pay nothing
+    if ProfilingConfig.TOKEN or ProfilingConfig.SAMPLE_RATE>0:
+        app.add_middleware(ProfilerMiddleware)
+    # added last so it is the outermost middleware and times the whole request
+    app.add_middleware(MetricsMiddleware)
     
-    create_db_and_tables()
-    
-    os.makedirs(UPLOAD_FOLDER,exist_ok=True)
+    # the schema is managed by migrations (`alembic upgrade head`), workers do no DDL on boot
+    for volume in VOLUMES:
+        os.makedirs(volume.path,exist_ok=True)
     return app
 app=create_app()
 
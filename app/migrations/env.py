@@ -0,0 +1,72 @@
+import re
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+from sqlmodel import SQLModel
+
+from config import PostgresSQLConfig
+import models.postgres_models  # noqa: F401, registers the tables on SQLModel.metadata
+
+alembic_config = context.config
+alembic_config.set_main_option(
+    "sqlalchemy.url", PostgresSQLConfig.DATABASE_URL.replace("%", "%%")
+)
+
+if alembic_config.config_file_name is not None:
+    fileConfig(alembic_config.config_file_name)
+
+target_metadata = SQLModel.metadata
+
+# partitions of the partitioned tables and the copies kept while partitioning them
+# (revisions 0011 and 0012) have no model
+UNMODELED_TABLES = re.compile(r".+_(p\d+|partitioned|unpartitioned)$|partition_backfill$")
+
+
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return not UNMODELED_TABLES.match(name)
+    return True
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # postgres adds a copy of a foreign key into a partitioned table for each of its partitions
+    if type_ == "foreign_key_constraint" and reflected:
+        return not UNMODELED_TABLES.match(object.referred_table.name)
+    return True
+
+
+def run_migrations_offline():
+    context.configure(
+        url=alembic_config.get_main_option("sqlalchemy.url"),
+        target_metadata=target_metadata,
+        include_name=include_name,
+        include_object=include_object,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connectable = engine_from_config(
+        alembic_config.get_section(alembic_config.config_ini_section, {}),
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+            include_object=include_object,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,88 @@
+"""initial schema
+
+Matches the tables previously created by SQLModel.metadata.create_all on startup.
+Databases created that way should be marked with `alembic stamp 0001` before upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user",
+        sa.Column("uid", sa.Uuid(), nullable=False),
+        sa.Column("username", sa.String(length=50), nullable=False),
+        sa.Column("email", sa.String(length=320), nullable=False),
+        sa.Column("profile_picture", sa.LargeBinary(), nullable=True),
+        sa.Column("hashed_password", sa.String(), nullable=False),
+        sa.Column("is_verified", sa.Boolean(), nullable=False),
+        sa.Column("otp", sa.String(length=6), nullable=True),
+        sa.PrimaryKeyConstraint("uid"),
+    )
+    op.create_table(
+        "folder",
+        sa.Column("folder_id", sa.Uuid(), nullable=False),
+        sa.Column("user_id", sa.Uuid(), nullable=False),
+        sa.Column("folder_name", sa.String(length=255), nullable=False),
+        sa.Column("parent_folder", sa.Uuid(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.Column("is_trashed", sa.Boolean(), nullable=False),
+        sa.Column("trashed_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["user.uid"]),
+        sa.PrimaryKeyConstraint("folder_id"),
+    )
+    op.create_index("ix_folder_user_id", "folder", ["user_id"])
+    op.create_table(
+        "file_metadata",
+        sa.Column("file_id", sa.Uuid(), nullable=False),
+        sa.Column("folder_id", sa.Uuid(), nullable=False),
+        sa.Column("user_id", sa.Uuid(), nullable=False),
+        sa.Column("file_name", sa.String(length=255), nullable=False),
+        sa.Column("file_size", sa.Integer(), nullable=False),
+        sa.Column("file_type", sa.String(length=50), nullable=False),
+        sa.Column("storage_location", sa.String(), nullable=False),
+        sa.Column("uploaded_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.Column("is_trashed", sa.Boolean(), nullable=False),
+        sa.Column("trashed_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["folder_id"], ["folder.folder_id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["user.uid"]),
+        sa.PrimaryKeyConstraint("file_id"),
+    )
+    op.create_index("ix_file_metadata_user_id", "file_metadata", ["user_id"])
+    op.create_index("ix_file_metadata_folder_id", "file_metadata", ["folder_id"])
+    op.create_table(
+        "shared_file",
+        sa.Column("share_id", sa.Uuid(), nullable=False),
+        sa.Column("file_id", sa.Uuid(), nullable=False),
+        sa.Column("shared_with", sa.Uuid(), nullable=False),
+        sa.Column("shared_by", sa.Uuid(), nullable=False),
+        sa.Column("access_level", sa.String(length=20), nullable=False),
+        sa.Column("shared_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["file_id"], ["file_metadata.file_id"]),
+        sa.ForeignKeyConstraint(["shared_with"], ["user.uid"]),
+        sa.ForeignKeyConstraint(["shared_by"], ["user.uid"]),
+        sa.PrimaryKeyConstraint("share_id"),
+    )
+    op.create_index("ix_shared_file_file_id", "shared_file", ["file_id"])
+    op.create_index("ix_shared_file_shared_by", "shared_file", ["shared_by"])
+    op.create_index("ix_shared_file_shared_with", "shared_file", ["shared_with"])
+
+
+def downgrade():
+    op.drop_table("shared_file")
+    op.drop_table("file_metadata")
+    op.drop_table("folder")
+    op.drop_table("user")
@@ -0,0 +1,58 @@
+"""hot path indexes and root folder pointer
+
+Adds a unique index on user.email, partial indexes for the listing and trash
+queries, and user.root_folder_id so the root folder no longer has to be found
+with a folder_name = '/' scan. Indexes are built concurrently so the upgrade
+can run against a live database.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+ACTIVE = sa.text("is_trashed = false")
+TRASHED = sa.text("is_trashed = true")
+
+INDEXES = [
+    ("ix_user_email", "user", ["email"], {"unique": True}),
+    ("ix_folder_parent_folder_active", "folder", ["parent_folder"], {"postgresql_where": ACTIVE}),
+    ("ix_folder_user_id_trashed_at", "folder", ["user_id", "trashed_at"], {"postgresql_where": TRASHED}),
+    ("ix_folder_trashed_at", "folder", ["trashed_at"], {"postgresql_where": TRASHED}),
+    ("ix_file_metadata_folder_id_active", "file_metadata", ["folder_id"], {"postgresql_where": ACTIVE}),
+    ("ix_file_metadata_user_id_trashed_at", "file_metadata", ["user_id", "trashed_at"], {"postgresql_where": TRASHED}),
+    ("ix_file_metadata_trashed_at", "file_metadata", ["trashed_at"], {"postgresql_where": TRASHED}),
+]
+
+
+def upgrade():
+    op.add_column("user", sa.Column("root_folder_id", sa.Uuid(), nullable=True))
+    op.execute(
+        """
+        UPDATE "user" SET root_folder_id = folder.folder_id
+        FROM folder
+        WHERE folder.user_id = "user".uid
+          AND folder.folder_name = '/'
+          AND folder.parent_folder IS NULL
+        """
+    )
+    with op.get_context().autocommit_block():
+        for name, table, columns, options in INDEXES:
+            op.create_index(
+                name, table, columns, postgresql_concurrently=True, if_not_exists=True, **options
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    op.drop_column("user", "root_folder_id")
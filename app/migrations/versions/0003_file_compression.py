@@ -0,0 +1,28 @@
+"""compression at rest
+
+Records how each file is stored: file_size stays the uncompressed size,
+stored_size is what the blob takes on disk.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("file_metadata", sa.Column("compression", sa.String(length=16), nullable=True))
+    op.add_column("file_metadata", sa.Column("stored_size", sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("file_metadata", "stored_size")
+    op.drop_column("file_metadata", "compression")
@@ -0,0 +1,63 @@
+"""file versions and chunk store
+
+Adds file_metadata.version, the file_version table listing the chunks of
+every archived version and the reference counted chunk table.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "file_metadata",
+        sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+    )
+    op.create_table(
+        "chunk",
+        sa.Column("chunk_hash", sa.String(length=64), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("stored_size", sa.Integer(), nullable=False),
+        sa.Column("compression", sa.String(length=16), nullable=True),
+        sa.Column("ref_count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("chunk_hash"),
+    )
+    op.create_index(
+        "ix_chunk_unreferenced",
+        "chunk",
+        ["chunk_hash"],
+        postgresql_where=sa.text("ref_count <= 0"),
+    )
+    op.create_table(
+        "file_version",
+        sa.Column("version_id", sa.Uuid(), nullable=False),
+        sa.Column("file_id", sa.Uuid(), nullable=False),
+        sa.Column("version_number", sa.Integer(), nullable=False),
+        sa.Column("file_size", sa.BigInteger(), nullable=False),
+        sa.Column("file_type", sa.String(length=50), nullable=False),
+        sa.Column("chunks", sa.ARRAY(sa.String(length=64)), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("archived_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["file_id"], ["file_metadata.file_id"]),
+        sa.PrimaryKeyConstraint("version_id"),
+        sa.UniqueConstraint("file_id", "version_number", name="uq_file_version_file_id_version_number"),
+    )
+    op.create_index("ix_file_version_archived_at", "file_version", ["archived_at"])
+
+
+def downgrade():
+    op.drop_index("ix_file_version_archived_at", table_name="file_version")
+    op.drop_table("file_version")
+    op.drop_index("ix_chunk_unreferenced", table_name="chunk")
+    op.drop_table("chunk")
+    op.drop_column("file_metadata", "version")
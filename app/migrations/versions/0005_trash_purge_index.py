@@ -0,0 +1,41 @@
+"""index for purging trashed folder trees
+
+The purge deletes trashed folders leaves first and checks for remaining
+children, which are themselves trashed; the existing parent_folder index only
+covers active folders.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_folder_parent_folder_trashed",
+            "folder",
+            ["parent_folder"],
+            postgresql_where=sa.text("is_trashed = true"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_folder_parent_folder_trashed",
+            table_name="folder",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,63 @@
+"""media attributes of files
+
+Adds the columns filled in by the background media extraction (sniffed type,
+dimensions, capture date, duration, page count) and indexes for filtering on
+them. Existing files start out pending and are analysed by the job.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    (
+        "ix_file_metadata_media_pending",
+        ["file_id"],
+        sa.text("media_analyzed_at IS NULL AND is_trashed = false"),
+    ),
+    ("ix_file_metadata_user_id_detected_type", ["user_id", "detected_type"], None),
+    ("ix_file_metadata_user_id_taken_at", ["user_id", "taken_at"], sa.text("taken_at IS NOT NULL")),
+    ("ix_file_metadata_user_id_duration", ["user_id", "duration"], sa.text("duration IS NOT NULL")),
+)
+
+
+def upgrade():
+    op.add_column("file_metadata", sa.Column("detected_type", sa.String(length=100), nullable=True))
+    op.add_column("file_metadata", sa.Column("width", sa.Integer(), nullable=True))
+    op.add_column("file_metadata", sa.Column("height", sa.Integer(), nullable=True))
+    op.add_column("file_metadata", sa.Column("taken_at", sa.DateTime(), nullable=True))
+    op.add_column("file_metadata", sa.Column("duration", sa.Float(), nullable=True))
+    op.add_column("file_metadata", sa.Column("page_count", sa.Integer(), nullable=True))
+    op.add_column("file_metadata", sa.Column("media_analyzed_at", sa.DateTime(), nullable=True))
+    with op.get_context().autocommit_block():
+        for name, columns, where in INDEXES:
+            op.create_index(
+                name,
+                "file_metadata",
+                columns,
+                postgresql_where=where,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in INDEXES:
+            op.drop_index(
+                name,
+                table_name="file_metadata",
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+    for column in ("media_analyzed_at", "page_count", "duration", "taken_at", "height", "width", "detected_type"):
+        op.drop_column("file_metadata", column)
@@ -0,0 +1,48 @@
+"""access tracking and storage tiers of files
+
+Adds the last download time, written in batches by the workers, and the tier
+a file's blob lives in. Existing files are on the hot tier and have no
+recorded access, the tiering job falls back to updated_at for them.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("file_metadata", sa.Column("last_accessed_at", sa.DateTime(), nullable=True))
+    op.add_column(
+        "file_metadata",
+        sa.Column("storage_tier", sa.String(length=10), nullable=False, server_default="hot"),
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_file_metadata_hot_last_accessed_at",
+            "file_metadata",
+            ["last_accessed_at"],
+            postgresql_where=sa.text("storage_tier = 'hot'"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_file_metadata_hot_last_accessed_at",
+            table_name="file_metadata",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+    op.drop_column("file_metadata", "storage_tier")
+    op.drop_column("file_metadata", "last_accessed_at")
@@ -0,0 +1,27 @@
+"""64-bit file sizes
+
+file_metadata.file_size was a 32-bit integer, so files of 2 GiB and more could
+not be stored. Changing the type in place rewrites the whole table under an
+exclusive lock, so it is done by revision 0011 instead, on the empty
+partitioned table that replaces file_metadata in 0012. Until 0012 has run,
+files of 2 GiB and more still cannot be stored. This revision does nothing.
+Databases that already ran an earlier version of it, which changed the type
+in place, keep their 64-bit column.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19
+
+"""
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
@@ -0,0 +1,132 @@
+"""hash-partitioned file_metadata and folder, part 1: shadow tables
+
+Creates file_metadata_partitioned and folder_partitioned, hash partitioned by
+user_id into 16 partitions, next to the live tables. Their primary keys
+lead with user_id, the partition key has to be part of them. Row triggers on
+the live tables mirror every insert, update and delete into the new tables,
+and the backfill job (utils/partitioning.py) copies the rows that existed
+before, recording how far it got in partition_backfill. Revision 0012 swaps
+the tables once the backfill is complete.
+
+file_metadata.file_size becomes 64 bit on the new table (see revision 0009).
+
+Everything here is cheap and runs against a live database: the new tables are
+empty and creating the triggers only takes a short lock.
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0011"
+down_revision = "0010"
+branch_labels = None
+depends_on = None
+
+PARTITIONS = 16
+
+ACTIVE = "is_trashed = false"
+TRASHED = "is_trashed = true"
+
+# table: primary key, indexes (name, columns, predicate)
+TABLES = {
+    "folder": (
+        ("user_id", "folder_id"),
+        [
+            ("ix_folder_parent_folder_active", "parent_folder", ACTIVE),
+            ("ix_folder_parent_folder_trashed", "parent_folder", TRASHED),
+            ("ix_folder_user_id_trashed_at", "user_id, trashed_at", TRASHED),
+            ("ix_folder_trashed_at", "trashed_at", TRASHED),
+        ],
+    ),
+    "file_metadata": (
+        ("user_id", "file_id"),
+        [
+            ("ix_file_metadata_folder_id", "folder_id", None),
+            ("ix_file_metadata_folder_id_active", "folder_id", ACTIVE),
+            ("ix_file_metadata_user_id_trashed_at", "user_id, trashed_at", TRASHED),
+            ("ix_file_metadata_trashed_at", "trashed_at", TRASHED),
+            ("ix_file_metadata_media_pending", "file_id", "media_analyzed_at IS NULL AND is_trashed = false"),
+            ("ix_file_metadata_user_id_detected_type", "user_id, detected_type", None),
+            ("ix_file_metadata_user_id_taken_at", "user_id, taken_at", "taken_at IS NOT NULL"),
+            ("ix_file_metadata_user_id_duration", "user_id, duration", "duration IS NOT NULL"),
+            ("ix_file_metadata_hot_last_accessed_at", "last_accessed_at", "storage_tier = 'hot'"),
+        ],
+    ),
+}
+
+
+def _mirror_function(table, key, columns):
+    # runs after every write to the live table; the upsert also covers an update of a
+    # row the backfill copies concurrently, which locks the rows it copies FOR SHARE
+    match = " AND ".join(f"{column} = OLD.{column}" for column in key)
+    assignments = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key)
+    return f"""
+        CREATE FUNCTION {table}_mirror() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM {table}_partitioned WHERE {match};
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' AND ({", ".join(f"OLD.{column}" for column in key)})
+                    IS DISTINCT FROM ({", ".join(f"NEW.{column}" for column in key)}) THEN
+                DELETE FROM {table}_partitioned WHERE {match};
+            END IF;
+            INSERT INTO {table}_partitioned SELECT (NEW).*
+            ON CONFLICT ({", ".join(key)}) DO UPDATE SET {assignments};
+            RETURN NULL;
+        END
+        $$
+    """
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    op.create_table(
+        "partition_backfill",
+        sa.Column("table_name", sa.String(length=63), nullable=False),
+        sa.Column("last_id", sa.Uuid(), nullable=True),
+        sa.Column("completed_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("table_name"),
+    )
+    for table, (key, indexes) in TABLES.items():
+        shadow = f"{table}_partitioned"
+        # LIKE keeps the column order, so rows are copied with SELECT *
+        op.execute(
+            f"CREATE TABLE {shadow} ("
+            f"LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS, "
+            f"CONSTRAINT {table}_pkey_partitioned PRIMARY KEY ({', '.join(key)}), "
+            f'CONSTRAINT {table}_user_id_fkey FOREIGN KEY (user_id) REFERENCES "user" (uid)'
+            f") PARTITION BY HASH (user_id)"
+        )
+        if table == "file_metadata":
+            # no rows yet, so unlike on the live table this does not rewrite anything
+            op.execute(f"ALTER TABLE {shadow} ALTER COLUMN file_size TYPE bigint")
+        for remainder in range(PARTITIONS):
+            op.execute(
+                f"CREATE TABLE {table}_p{remainder} PARTITION OF {shadow} "
+                f"FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder})"
+            )
+        for name, columns, predicate in indexes:
+            where = f" WHERE {predicate}" if predicate else ""
+            op.execute(f"CREATE INDEX {name}_partitioned ON {shadow} ({columns}){where}")
+
+        columns = [column["name"] for column in inspector.get_columns(table)]
+        op.execute(_mirror_function(table, key, columns))
+        op.execute(
+            f"CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION {table}_mirror()"
+        )
+        op.execute(sa.text("INSERT INTO partition_backfill (table_name) VALUES (:table)").bindparams(table=table))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_mirror ON {table}")
+        op.execute(f"DROP FUNCTION IF EXISTS {table}_mirror()")
+        op.execute(f"DROP TABLE IF EXISTS {table}_partitioned")
+    op.drop_table("partition_backfill")
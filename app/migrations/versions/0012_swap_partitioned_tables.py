@@ -0,0 +1,191 @@
+"""hash-partitioned file_metadata and folder, part 2: swap
+
+Copies whatever the backfill job has not copied yet, then swaps the tables in
+one short transaction: the live tables and their indexes get the suffix
+_unpartitioned and stop receiving writes, the partitioned ones take their
+names. Let the backfill job finish first on large installations, the copy
+done here holds no lock but the swap waits for it.
+
+file_metadata.file_id is only unique together with user_id now, so the foreign
+keys of file_version and shared_file on it are dropped. The foreign key of
+file_metadata on its folder becomes (user_id, folder_id); it is added NOT
+VALID to every partition under the lock and validated after it, so writes
+are only blocked for the renames.
+
+The _unpartitioned tables are kept for the downgrade and can be dropped once
+the partitioned ones are trusted. The downgrade copies all rows back into
+them under an exclusive lock, run it in a maintenance window; it fails on
+files of 2 GiB and more, which the 32-bit file_size of the old table cannot hold.
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0012"
+down_revision = "0011"
+branch_labels = None
+depends_on = None
+
+PARTITIONS = 16
+BATCH_SIZE = 10000
+
+# table: primary key; the partition key user_id comes first
+TABLES = {"folder": ("user_id", "folder_id"), "file_metadata": ("user_id", "file_id")}
+# foreign keys on file_metadata.file_id alone
+FILE_FOREIGN_KEYS = {"file_version": "file_version_file_id_fkey", "shared_file": "shared_file_file_id_fkey"}
+FOLDER_FOREIGN_KEY = "file_metadata_user_id_folder_id_fkey"
+
+
+def _indexes(table):
+    return (
+        op.get_bind()
+        .execute(
+            sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table"),
+            {"table": table},
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _rename_indexes(table, suffix, new_suffix):
+    for index in _indexes(table):
+        op.execute(f"ALTER INDEX {index} RENAME TO {index.removesuffix(suffix)}{new_suffix}")
+
+
+def _copy_remaining(table, key, lock_rows=True):
+    # the rows the backfill job did not get to, the triggers mirrored all writes since 0011
+    bind = op.get_bind()
+    id_column = key[-1]
+    while True:
+        after = bind.execute(
+            sa.text("SELECT last_id FROM partition_backfill WHERE table_name = :table"), {"table": table}
+        ).scalar()
+        where = f"WHERE {id_column} > CAST(:after AS uuid) " if after else ""
+        count, last_id = bind.execute(
+            sa.text(
+                f"WITH batch AS (SELECT * FROM {table} {where}ORDER BY {id_column} LIMIT :limit"
+                f"{' FOR SHARE' if lock_rows else ''}), "
+                f"copied AS (INSERT INTO {table}_partitioned SELECT * FROM batch ON CONFLICT DO NOTHING) "
+                f"SELECT (SELECT count(*) FROM batch), (SELECT {id_column} FROM batch ORDER BY {id_column} DESC LIMIT 1)"
+            ),
+            {"after": str(after) if after else None, "limit": BATCH_SIZE},
+        ).one()
+        if not count:
+            return
+        bind.execute(
+            sa.text("UPDATE partition_backfill SET last_id = :last_id WHERE table_name = :table"),
+            {"last_id": last_id, "table": table},
+        )
+
+
+def upgrade():
+    bind = op.get_bind()
+    with op.get_context().autocommit_block():
+        for table, key in TABLES.items():
+            _copy_remaining(table, key)
+        orphans = bind.execute(
+            sa.text(
+                "SELECT count(*) FROM file_metadata_partitioned file WHERE NOT EXISTS ("
+                "  SELECT 1 FROM folder_partitioned folder"
+                "  WHERE folder.user_id = file.user_id AND folder.folder_id = file.folder_id)"
+            )
+        ).scalar()
+        if orphans:
+            raise RuntimeError(
+                f"{orphans} files are in a folder of another user, move them before partitioning"
+            )
+
+    op.execute("LOCK TABLE folder, file_metadata IN ACCESS EXCLUSIVE MODE")
+    for table, key in TABLES.items():
+        _copy_remaining(table, key, lock_rows=False)
+        op.execute(f"DROP TRIGGER {table}_mirror ON {table}")
+        op.execute(f"DROP FUNCTION {table}_mirror()")
+    for table, constraint in FILE_FOREIGN_KEYS.items():
+        op.drop_constraint(constraint, table, type_="foreignkey")
+    for table in TABLES:
+        _rename_indexes(table, "", "_unpartitioned")
+        op.rename_table(table, f"{table}_unpartitioned")
+        _rename_indexes(f"{table}_partitioned", "_partitioned", "")
+        op.rename_table(f"{table}_partitioned", table)
+    for remainder in range(PARTITIONS):
+        op.execute(
+            f"ALTER TABLE file_metadata_p{remainder} ADD CONSTRAINT {FOLDER_FOREIGN_KEY} "
+            "FOREIGN KEY (user_id, folder_id) REFERENCES folder (user_id, folder_id) NOT VALID"
+        )
+    op.drop_table("partition_backfill")
+
+    with op.get_context().autocommit_block():
+        # validating takes no lock that blocks writes; the constraint of the parent
+        # then adopts the validated ones of the partitions without checking again
+        for remainder in range(PARTITIONS):
+            op.execute(f"ALTER TABLE file_metadata_p{remainder} VALIDATE CONSTRAINT {FOLDER_FOREIGN_KEY}")
+        op.create_foreign_key(
+            FOLDER_FOREIGN_KEY, "file_metadata", "folder", ["user_id", "folder_id"], ["user_id", "folder_id"]
+        )
+
+
+def _mirror_function(table, key, columns):
+    # same as in revision 0011
+    match = " AND ".join(f"{column} = OLD.{column}" for column in key)
+    assignments = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key)
+    return f"""
+        CREATE FUNCTION {table}_mirror() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM {table}_partitioned WHERE {match};
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' AND ({", ".join(f"OLD.{column}" for column in key)})
+                    IS DISTINCT FROM ({", ".join(f"NEW.{column}" for column in key)}) THEN
+                DELETE FROM {table}_partitioned WHERE {match};
+            END IF;
+            INSERT INTO {table}_partitioned SELECT (NEW).*
+            ON CONFLICT ({", ".join(key)}) DO UPDATE SET {assignments};
+            RETURN NULL;
+        END
+        $$
+    """
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    op.execute("LOCK TABLE folder, file_metadata IN ACCESS EXCLUSIVE MODE")
+    op.drop_constraint(FOLDER_FOREIGN_KEY, "file_metadata", type_="foreignkey")
+    for table in TABLES:
+        _rename_indexes(table, "", "_partitioned")
+        op.rename_table(table, f"{table}_partitioned")
+        _rename_indexes(f"{table}_unpartitioned", "_unpartitioned", "")
+        op.rename_table(f"{table}_unpartitioned", table)
+    # the old tables stopped receiving writes at the upgrade
+    op.execute("TRUNCATE file_metadata, folder")
+    for table in TABLES:
+        op.execute(f"INSERT INTO {table} SELECT * FROM {table}_partitioned")
+    for table, constraint in FILE_FOREIGN_KEYS.items():
+        op.create_foreign_key(constraint, table, "file_metadata", ["file_id"], ["file_id"])
+
+    op.create_table(
+        "partition_backfill",
+        sa.Column("table_name", sa.String(length=63), nullable=False),
+        sa.Column("last_id", sa.Uuid(), nullable=True),
+        sa.Column("completed_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("table_name"),
+    )
+    for table, key in TABLES.items():
+        columns = [column["name"] for column in inspector.get_columns(table)]
+        op.execute(_mirror_function(table, key, columns))
+        op.execute(
+            f"CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION {table}_mirror()"
+        )
+        # both copies hold the same rows again
+        op.execute(
+            sa.text(
+                "INSERT INTO partition_backfill (table_name, completed_at) VALUES (:table, now())"
+            ).bindparams(table=table)
+        )
@@ -0,0 +1,27 @@
+"""media extraction claims
+
+Adds file_metadata.media_claimed_at. The media extraction job records its claim
+on a batch there and commits, instead of keeping the rows locked while they are
+analysed. Adding a nullable column without a default only changes the catalog.
+
+Revision ID: 0013
+Revises: 0012
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0013"
+down_revision = "0012"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("file_metadata", sa.Column("media_claimed_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("file_metadata", "media_claimed_at")
@@ -0,0 +1,35 @@
+"""retired blobs
+
+Adds the table blobs superseded by a copy at another path are recorded in when
+a file moves between volumes or tiers, or gets new content on another volume.
+They are removed by a background sweep after a grace period instead of right
+after the commit, so downloads that read the old path just before still find it.
+
+Revision ID: 0014
+Revises: 0013
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0014"
+down_revision = "0013"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "retired_blob",
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("retired_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("path"),
+    )
+    op.create_index("ix_retired_blob_retired_at", "retired_blob", ["retired_at"])
+
+
+def downgrade():
+    op.drop_index("ix_retired_blob_retired_at", table_name="retired_blob")
+    op.drop_table("retired_blob")
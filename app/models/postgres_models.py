@@ -1,23 +1,47 @@
 from sqlmodel import SQLModel, Field, Relationship, ForeignKey
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    ForeignKeyConstraint,
+    Index,
+    LargeBinary,
+    PrimaryKeyConstraint,
+    String,
+    UniqueConstraint,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB
 import uuid
 from datetime import datetime
 
+# partial index predicates, most queries only look at one side of the trash
+ACTIVE = text("is_trashed = false")
+TRASHED = text("is_trashed = true")
+
+# file_metadata and folder are hash partitioned by user_id, see migration 0011; every
+# query should filter on user_id so the planner only visits that user's partition
+PARTITION_BY_USER = "HASH (user_id)"
+
+# columns filled in by the media extraction job
+MEDIA_ATTRIBUTES = ("detected_type", "width", "height", "taken_at", "duration", "page_count", "media_analyzed_at")
+
 
 class User(SQLModel, table=True):
     uid: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     username: str = Field(max_length=50, nullable=False)
-    email: str = Field(max_length=320, nullable=False)
+    email: str = Field(max_length=320, nullable=False, unique=True, index=True)
     profile_picture: bytes = Field(default=None, nullable=True)
     hashed_password: str
     is_verified: bool = Field(default=False)
     otp: str = Field(default=None, max_length=6,nullable=True)
+    root_folder_id: uuid.UUID = Field(default=None, nullable=True)
     
 
     files: list["FileMetadata"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="user", sa_relationship_kwargs={"lazy": "select"}
     )
     folders: list["Folder"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="user", sa_relationship_kwargs={"lazy": "select"}
     )
 
     def __repr__(self) -> str:
@@ -26,45 +50,153 @@ class User(SQLModel, table=True):
 
 class FileMetadata(SQLModel, table=True):
     __tablename__ = "file_metadata"
-    file_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    folder_id: uuid.UUID = Field(
-        default=None, foreign_key="folder.folder_id", index=True
+    __table_args__ = (
+        # the partition key has to be part of the primary key; leading with it, the
+        # primary key also serves the lookups by user_id alone
+        PrimaryKeyConstraint("user_id", "file_id", name="file_metadata_pkey"),
+        ForeignKeyConstraint(
+            ["user_id", "folder_id"],
+            ["folder.user_id", "folder.folder_id"],
+            name="file_metadata_user_id_folder_id_fkey",
+        ),
+        Index("ix_file_metadata_folder_id_active", "folder_id", postgresql_where=ACTIVE),
+        Index("ix_file_metadata_user_id_trashed_at", "user_id", "trashed_at", postgresql_where=TRASHED),
+        Index("ix_file_metadata_trashed_at", "trashed_at", postgresql_where=TRASHED),
+        Index(
+            "ix_file_metadata_media_pending",
+            "file_id",
+            postgresql_where=text("media_analyzed_at IS NULL AND is_trashed = false"),
+        ),
+        Index("ix_file_metadata_user_id_detected_type", "user_id", "detected_type"),
+        Index(
+            "ix_file_metadata_user_id_taken_at",
+            "user_id",
+            "taken_at",
+            postgresql_where=text("taken_at IS NOT NULL"),
+        ),
+        Index(
+            "ix_file_metadata_user_id_duration",
+            "user_id",
+            "duration",
+            postgresql_where=text("duration IS NOT NULL"),
+        ),
+        Index(
+            "ix_file_metadata_hot_last_accessed_at",
+            "last_accessed_at",
+            postgresql_where=text("storage_tier = 'hot'"),
+        ),
+        {"postgresql_partition_by": PARTITION_BY_USER},
     )
-    user_id: uuid.UUID = Field(foreign_key="user.uid", nullable=False, index=True)
+    file_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    folder_id: uuid.UUID = Field(default=None, index=True)
+    user_id: uuid.UUID = Field(foreign_key="user.uid", primary_key=True)
     file_name: str = Field(max_length=255, nullable=False)
-    file_size: int = Field(nullable=False)
+    file_size: int = Field(nullable=False, sa_type=BigInteger)
     file_type: str = Field(max_length=50, nullable=False)
     storage_location: str = Field(nullable=False)
+    # "zstd" when stored compressed at rest, file_size stays the uncompressed size
+    compression: str = Field(default=None, max_length=16, nullable=True)
+    stored_size: int = Field(default=None, nullable=True, sa_type=BigInteger)
+    # number of the current version, older versions live in file_version
+    version: int = Field(default=1, nullable=False, sa_column_kwargs={"server_default": "1"})
     uploaded_at: datetime = Field(default_factory=datetime.now, nullable=False)
     updated_at: datetime = Field(default_factory=datetime.now, nullable=False)
     is_trashed: bool = Field(default=False, nullable=False)
     trashed_at: datetime = Field(default=None, nullable=True)
+    # sniffed from the content by the media extraction job, unlike file_type which the client claims
+    detected_type: str = Field(default=None, max_length=100, nullable=True)
+    width: int = Field(default=None, nullable=True)
+    height: int = Field(default=None, nullable=True)
+    # EXIF capture date of photos
+    taken_at: datetime = Field(default=None, nullable=True)
+    # seconds of audio and video
+    duration: float = Field(default=None, nullable=True)
+    page_count: int = Field(default=None, nullable=True)
+    # when the current content was analysed, NULL while the job has not seen it
+    media_analyzed_at: datetime = Field(default=None, nullable=True)
+    # when the job last claimed the file for analysis, claims older than its lease are taken over
+    media_claimed_at: datetime = Field(default=None, nullable=True)
+    # last download, written in batches; NULL when not downloaded since access tracking exists
+    last_accessed_at: datetime = Field(default=None, nullable=True)
+    # "hot" on a storage volume or "cold" in the cold tier, see utils/tiering.py
+    storage_tier: str = Field(
+        default="hot", max_length=10, nullable=False, sa_column_kwargs={"server_default": "hot"}
+    )
 
     user: "User" = Relationship(
-        back_populates="files", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="files", sa_relationship_kwargs={"lazy": "select"}
     )
+    # shares user_id with the user relationship, both always agree on it
     folder: "Folder" = Relationship(
-        back_populates="files", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="files", sa_relationship_kwargs={"lazy": "select", "overlaps": "files,user"}
     )
 
     def update_timestamp(self):
         self.updated_at = datetime.now()
 
+    def clear_media_attributes(self):
+        # the content changed, the media extraction job analyses it again
+        for attribute in MEDIA_ATTRIBUTES:
+            setattr(self, attribute, None)
+        self.media_claimed_at = None
+
     def __repr__(self) -> str:
         return f"<FileMetadata(file_name={self.file_name})>"
 
 
+class FileVersion(SQLModel, table=True):
+    __tablename__ = "file_version"
+    __table_args__ = (
+        UniqueConstraint("file_id", "version_number", name="uq_file_version_file_id_version_number"),
+    )
+    version_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    # no foreign key, file_metadata is only unique per (user_id, file_id)
+    file_id: uuid.UUID = Field(nullable=False)
+    version_number: int = Field(nullable=False)
+    file_size: int = Field(nullable=False, sa_type=BigInteger)
+    file_type: str = Field(max_length=50, nullable=False)
+    # ordered sha256 hashes of the content-defined chunks holding the content
+    chunks: list[str] = Field(sa_type=ARRAY(String(64)), nullable=False)
+    # when the content was uploaded and when it was replaced by a newer version
+    created_at: datetime = Field(nullable=False)
+    archived_at: datetime = Field(default_factory=datetime.now, nullable=False, index=True)
+
+    def __repr__(self) -> str:
+        return f"<FileVersion(file_id={self.file_id}, version_number={self.version_number})>"
+
+
+class Chunk(SQLModel, table=True):
+    __tablename__ = "chunk"
+    __table_args__ = (
+        Index("ix_chunk_unreferenced", "chunk_hash", postgresql_where=text("ref_count <= 0")),
+    )
+    chunk_hash: str = Field(max_length=64, primary_key=True)
+    size: int = Field(nullable=False)
+    stored_size: int = Field(nullable=False)
+    compression: str = Field(default=None, max_length=16, nullable=True)
+    # number of references from file_version.chunks, unreferenced chunks are swept
+    ref_count: int = Field(default=0, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<Chunk(chunk_hash={self.chunk_hash}, ref_count={self.ref_count})>"
+
+
 class SharedFile(SQLModel, table=True):
     __tablename__ = "shared_file"
     share_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    file_id: uuid.UUID = Field(foreign_key="file_metadata.file_id", nullable=False, index=True)
+    # no foreign key, file_metadata is only unique per (user_id, file_id)
+    file_id: uuid.UUID = Field(nullable=False, index=True)
     shared_with: uuid.UUID = Field(foreign_key="user.uid", nullable=False, index=True)
     shared_by: uuid.UUID = Field(foreign_key="user.uid", nullable=False, index=True)
     access_level: str = Field(max_length=20, nullable=False)
     shared_at: datetime = Field(default_factory=datetime.now, nullable=False)
 
     file: "FileMetadata" = Relationship(
-        sa_relationship_kwargs={"lazy": "selectin"}
+        sa_relationship_kwargs={
+            "lazy": "selectin",
+            "primaryjoin": "foreign(SharedFile.file_id) == FileMetadata.file_id",
+            "viewonly": True,
+        }
     )
     shared_with_user: "User" = Relationship(
         sa_relationship_kwargs={"lazy": "selectin","foreign_keys":"SharedFile.shared_with"}
@@ -79,8 +211,16 @@ class SharedFile(SQLModel, table=True):
 
 class Folder(SQLModel, table=True):
     __tablename__ = "folder"
+    __table_args__ = (
+        PrimaryKeyConstraint("user_id", "folder_id", name="folder_pkey"),
+        Index("ix_folder_parent_folder_active", "parent_folder", postgresql_where=ACTIVE),
+        Index("ix_folder_parent_folder_trashed", "parent_folder", postgresql_where=TRASHED),
+        Index("ix_folder_user_id_trashed_at", "user_id", "trashed_at", postgresql_where=TRASHED),
+        Index("ix_folder_trashed_at", "trashed_at", postgresql_where=TRASHED),
+        {"postgresql_partition_by": PARTITION_BY_USER},
+    )
     folder_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    user_id: uuid.UUID = Field(foreign_key="user.uid", nullable=False, index=True)
+    user_id: uuid.UUID = Field(foreign_key="user.uid", primary_key=True)
     folder_name: str = Field(max_length=255, nullable=False)
     parent_folder: uuid.UUID = Field(default=None,nullable=True)
     created_at: datetime = Field(default_factory=datetime.now, nullable=False)
@@ -89,13 +229,69 @@ class Folder(SQLModel, table=True):
     trashed_at: datetime = Field(default=None, nullable=True)
 
     user: "User" = Relationship(
-        back_populates="folders", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="folders", sa_relationship_kwargs={"lazy": "select"}
     )
     files: list["FileMetadata"] = Relationship(
-        back_populates="folder", sa_relationship_kwargs={"lazy": "selectin"}
+        back_populates="folder", sa_relationship_kwargs={"lazy": "select", "overlaps": "files,user"}
     )
 
     def update_timestamp(self):
         self.updated_at = datetime.now()
     def __repr__(self) -> str:
         return f"<Folder(folder_name={self.folder_name})>"
+
+
+class Job(SQLModel, table=True):
+    __tablename__ = "job"
+    __table_args__ = (
+        Index("ix_job_user_id_created_at", "user_id", "created_at"),
+    )
+    job_id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    user_id: uuid.UUID = Field(foreign_key="user.uid", nullable=False)
+    kind: str = Field(max_length=32, nullable=False)
+    # pending, running, done or failed
+    status: str = Field(default="pending", max_length=16, nullable=False)
+    # what the job works on and what it produced, e.g. the id of a copied folder
+    params: dict = Field(default=None, sa_type=JSONB, nullable=True)
+    result: dict = Field(default=None, sa_type=JSONB, nullable=True)
+    error: str = Field(default=None, nullable=True)
+    progress_done: int = Field(default=0, nullable=False)
+    progress_total: int = Field(default=None, nullable=True)
+    created_at: datetime = Field(default_factory=datetime.now, nullable=False)
+    # refreshed with every progress report, a running job that stops updating was interrupted
+    updated_at: datetime = Field(default_factory=datetime.now, nullable=False)
+    finished_at: datetime = Field(default=None, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<Job(kind={self.kind}, status={self.status})>"
+
+
+class IdempotencyKey(SQLModel, table=True):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        Index("ix_idempotency_key_expires_at", "expires_at"),
+    )
+    # email of the user who sent the key, keys of different users never collide
+    owner: str = Field(max_length=255, primary_key=True)
+    key: str = Field(max_length=255, primary_key=True)
+    # hash of method, path and query string, a key reused for another request is refused
+    fingerprint: str = Field(max_length=64, nullable=False)
+    # NULL while the first request with the key is still running
+    status_code: int = Field(default=None, nullable=True)
+    response_headers: list = Field(default=None, sa_type=JSONB, nullable=True)
+    response_body: bytes = Field(default=None, sa_type=LargeBinary, nullable=True)
+    created_at: datetime = Field(default_factory=datetime.now, nullable=False)
+    expires_at: datetime = Field(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<IdempotencyKey(key={self.key}, status_code={self.status_code})>"
+
+
+class RetiredBlob(SQLModel, table=True):
+    __tablename__ = "retired_blob"
+    # a blob superseded by a copy at another path, removed once readers had time to open it
+    path: str = Field(primary_key=True)
+    retired_at: datetime = Field(default_factory=datetime.now, nullable=False, index=True)
+
+    def __repr__(self) -> str:
+        return f"<RetiredBlob(path={self.path})>"
@@ -1,4 +1,4 @@
-from pydantic import BaseModel,EmailStr
+from pydantic import BaseModel,EmailStr,Field
 
 from datetime import datetime
 
@@ -41,6 +41,51 @@ class FileDetails(BaseModel):
     file_type:str
     updated_at:datetime
     
+class MediaFileDetails(FileDetails):
+    folder_id:UUID
+    file_size:int
+    detected_type:str | None=None
+    width:int | None=None
+    height:int | None=None
+    taken_at:datetime | None=None
+    duration:float | None=None
+    page_count:int | None=None
+
+class BlockSignature(BaseModel):
+    # Adler-32 of the block as zlib computes it, and its BLAKE2b-128 hash in hex
+    weak:int
+    strong:str
+
+class FileSignatures(BaseModel):
+    file_id:UUID
+    version:int
+    file_size:int
+    block_size:int
+    # one per block of block_size bytes, the last one may be shorter
+    blocks:list[BlockSignature]
+
+class DeltaInstruction(BaseModel):
+    # copy `count` stored blocks starting at `block`, or take the next `data` bytes of the upload
+    block:int | None=Field(default=None,ge=0)
+    count:int=Field(default=1,ge=1)
+    data:int | None=Field(default=None,ge=1)
+
+class DeltaRecipe(BaseModel):
+    # version the signatures were fetched for, the upload is refused if the file changed since
+    base_version:int
+    block_size:int
+    file_size:int=Field(ge=0)
+    # of the whole new content, checked before it replaces the file
+    sha256:str=Field(pattern="^[0-9a-fA-F]{64}$")
+    instructions:list[DeltaInstruction]
+
+class FileVersionDetails(BaseModel):
+    version_number:int
+    file_size:int
+    file_type:str
+    created_at:datetime
+    is_current:bool=False
+    
 class TrashFileDetails(BaseModel):
     file_id:UUID
     file_name:str
@@ -57,6 +102,38 @@ class FullFolderDetails(FolderDetails):
     subfolders:list[FolderDetails]
     files:list[FileDetails]
     
+class FolderTreeFolders(BaseModel):
+    ids:list[UUID]
+    names:list[str]
+    # index of the parent in these arrays, -1 for top level folders
+    parents:list[int]
+    updated_at:list[datetime]
+
+class FolderTreeFiles(BaseModel):
+    ids:list[UUID]
+    names:list[str]
+    # index of the containing folder in FolderTreeFolders
+    folders:list[int]
+    sizes:list[int]
+    types:list[str]
+    updated_at:list[datetime]
+
+class FolderTree(BaseModel):
+    version:str
+    folders:FolderTreeFolders
+    files:FolderTreeFiles | None=None
+    
+class JobDetails(BaseModel):
+    job_id:UUID
+    kind:str
+    status:str
+    progress_done:int
+    progress_total:int | None=None
+    result:dict | None=None
+    error:str | None=None
+    created_at:datetime
+    finished_at:datetime | None=None
+
 class TrashFolderDetails(BaseModel):
     folder_id:UUID
     folder_name:str
@@ -69,6 +69,8 @@ async def verify_otp(email: str, otp: str, db: Session = Depends(get_session)):
     
     folder = Folder(folder_name="/", user_id=user.uid)
     db.add(folder)
+    db.flush()
+    user.root_folder_id = folder.folder_id
     db.commit()
     db.refresh(folder)  
       
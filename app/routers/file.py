@@ -1,34 +1,74 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Request
-from fastapi import UploadFile
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, status, Depends, Request
+from fastapi import Form, UploadFile
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
-from models.postgres_models import FileMetadata, Folder
-from models.schemas import FileDetails, TrashFileDetails
+from models.postgres_models import FileMetadata, FileVersion, Folder
+from models.schemas import (
+    DeltaRecipe,
+    FileDetails,
+    FileSignatures,
+    FileVersionDetails,
+    JobDetails,
+    MediaFileDetails,
+    TrashFileDetails,
+)
 
 from utils.oauth import get_current_user
+from utils.blob_cache import blob_cache, cached_file_response
+from utils.archives import (
+    EXTRACT_ARCHIVE,
+    ArchiveError,
+    ArchiveLimitError,
+    extract_archive,
+    inspect_archive,
+)
+from utils.folders import check_name, ensure_folders, get_root_folder_id, split_relative_path
+from utils.sendfile import content_disposition, parse_range, stored_file_response
+from utils.storage import blob_directory, commit_blob, discard, should_compress, stage_chunks
+from utils.copying import copy_name, duplicate_file
+from utils.delta import MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, DeltaError, apply_delta, block_signatures
+from utils.export import (
+    MEDIA_TYPES,
+    available_formats,
+    negotiate_format,
+    stream_file_metadata,
+)
+from utils.tiering import COLD, promote_file, record_access
+from utils.trash import purge_trashed_files, purge_trashed_folders
+from utils.versions import archive_version, iter_version, lock_chunk_store
+from utils.jobs import create_job, run_job
+from utils.metrics import DOWNLOAD_BYTES, UPLOAD_BYTES
+from utils.uploads import commit_new_version, store_uploads
 
-from database import get_session
+from config import AdmissionConfig, DeltaConfig, ExtractConfig, StorageConfig
+from database import get_read_session, get_session
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from uuid import UUID
 
+import io
 import os
+import shutil
 from datetime import datetime
+from functools import partial
+from tempfile import NamedTemporaryFile
 
 router = APIRouter(
     prefix="/files",
     tags=["files"],
     responses={404: {"description": "Not found"}},
 )
-UPLOAD_FOLDER = "./UPLOADS"
 
 
 @router.get("/")
 async def get_user_files(
     request: Request,
     folder_id: UUID | None = None,
-    db: Session = Depends(get_session),
+    db: Session = Depends(get_read_session),
 ):
     """
     Retrieves all files for the authenticated user or files in a specific folder.
@@ -76,13 +116,131 @@ async def get_user_files(
     else:
         files = (
             db.query(FileMetadata)
-            .filter(FileMetadata.file_name=="/",FileMetadata.user_id == user.uid, FileMetadata.is_trashed == False)
+            .filter(
+                FileMetadata.folder_id == get_root_folder_id(db, user),
+                FileMetadata.user_id == user.uid,
+                FileMetadata.is_trashed == False,
+            )
             .all()
         )
     print("Files::", files)
     return files
 
 
+@router.get("/export")
+async def export_files(
+    request: Request,
+    format: str | None = None,
+    include_trashed: bool = False,
+    db: Session = Depends(get_read_session),
+):
+    """
+    Streams the metadata of all files of the authenticated user.
+
+    Meant for bulk clients (backup, sync, audit): rows are read with a server-side
+    cursor and encoded as they are sent, one JSON object per line (NDJSON) or one
+    MessagePack map per file, so the listing is never built in memory.
+
+    Args:
+        request (Request): The HTTP request object.
+        format (str | None): "ndjson" or "msgpack". Defaults to the Accept header, then NDJSON.
+        include_trashed (bool): Whether to include trashed files. Defaults to False.
+        db (Session): The database session dependency.
+
+    Returns:
+        StreamingResponse: The encoded file metadata.
+
+    Raises:
+        HTTPException: If the requested format is not available.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    export_format = negotiate_format(format, request.headers.get("accept", ""))
+    if export_format is None:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f"Available formats: {', '.join(available_formats())}",
+        )
+    return StreamingResponse(
+        stream_file_metadata(user.uid, export_format, include_trashed),
+        media_type=MEDIA_TYPES[export_format],
+    )
+
+
+@router.get("/media", response_model=list[MediaFileDetails])
+async def search_media(
+    request: Request,
+    type: str | None = None,
+    taken_after: datetime | None = None,
+    taken_before: datetime | None = None,
+    min_duration: float | None = None,
+    max_duration: float | None = None,
+    min_width: int | None = None,
+    min_height: int | None = None,
+    min_pages: int | None = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    db: Session = Depends(get_read_session),
+):
+    """
+    Filters the user's files by the media attributes extracted from their content.
+
+    The attributes are filled in by a background job, files it has not analysed
+    yet do not match any filter. E.g. photos from 2023 are
+    `?type=image/&taken_after=2023-01-01&taken_before=2024-01-01`, videos longer
+    than ten minutes `?type=video/&min_duration=600`.
+
+    Args:
+        request (Request): The HTTP request object.
+        type (str | None): A detected MIME type, or a prefix ending in "/" like "image/".
+        taken_after (datetime | None): Earliest EXIF capture date.
+        taken_before (datetime | None): Capture date before which photos were taken.
+        min_duration (float | None): Minimum audio/video duration in seconds.
+        max_duration (float | None): Maximum audio/video duration in seconds.
+        min_width (int | None): Minimum image width in pixels.
+        min_height (int | None): Minimum image height in pixels.
+        min_pages (int | None): Minimum number of PDF pages.
+        limit (int): Maximum number of files returned. Defaults to 100.
+        offset (int): Number of matching files skipped. Defaults to 0.
+        db (Session): The database session dependency.
+
+    Returns:
+        list[MediaFileDetails]: The matching non-trashed files, newest capture date first.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    query = db.query(FileMetadata).filter(
+        FileMetadata.user_id == user.uid, FileMetadata.is_trashed == False
+    )
+    if type:
+        if type.endswith("/"):
+            query = query.filter(FileMetadata.detected_type.startswith(type, autoescape=True))
+        else:
+            query = query.filter(FileMetadata.detected_type == type)
+    if taken_after:
+        query = query.filter(FileMetadata.taken_at >= taken_after)
+    if taken_before:
+        query = query.filter(FileMetadata.taken_at < taken_before)
+    if min_duration is not None:
+        query = query.filter(FileMetadata.duration >= min_duration)
+    if max_duration is not None:
+        query = query.filter(FileMetadata.duration <= max_duration)
+    if min_width is not None:
+        query = query.filter(FileMetadata.width >= min_width)
+    if min_height is not None:
+        query = query.filter(FileMetadata.height >= min_height)
+    if min_pages is not None:
+        query = query.filter(FileMetadata.page_count >= min_pages)
+    return (
+        query.order_by(
+            FileMetadata.taken_at.desc().nulls_last(), FileMetadata.uploaded_at.desc()
+        )
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+
+
 @router.post(
     "/upload/{folder_id}",
     status_code=status.HTTP_201_CREATED,
@@ -125,36 +283,172 @@ async def upload_files(
             status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found or trashed"
         )
 
-    file_metadata_list = []
-    folder_path = os.path.join(UPLOAD_FOLDER, str(user.uid), str(folder.folder_id))
+    return await store_uploads(
+        db, user.uid, [(folder.folder_id, file, file.filename) for file in files]
+    )
+
+
+@router.post(
+    "/upload-tree/{folder_id}",
+    status_code=status.HTTP_201_CREATED,
+    response_model=list[FileDetails],
+)
+async def upload_tree(
+    request: Request,
+    folder_id: UUID,
+    db: Session = Depends(get_session),
+):
+    """
+    Uploads a directory tree into a folder in one request.
 
-    # Ensure directory exists
-    os.makedirs(folder_path, exist_ok=True)
+    The multipart body carries the files as `files` parts whose filename is the
+    path relative to the folder ("src/app/main.py"), or alternatively one `paths`
+    field per file in the same order. Missing folders are created in one bulk
+    insert and files are stored like in upload_files.
 
-    for file in files:
-        file_path = os.path.join(folder_path, file.filename)
-        # Save the file to disk
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
+    Args:
+        request (Request): The HTTP request object.
+        folder_id (UUID): The UUID of the folder the paths are relative to.
+        db (Session): The database session dependency.
+
+    Returns:
+        List[FileDetails]: A list of metadata for the uploaded files.
 
-        file_metadata = FileMetadata(
-            file_name=file.filename,
-            file_size=os.path.getsize(file_path),
-            file_type=file.content_type,
-            storage_location=file_path,
-            user_id=user.uid,
-            folder_id=folder.folder_id,
+    Raises:
+        HTTPException: If the folder is not found or trashed, or a path is invalid.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    folder = (
+        db.query(Folder)
+        .filter(
+            Folder.folder_id == folder_id,
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+        .first()
+    )
+    if not folder:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found or trashed"
         )
-        file_metadata_list.append(file_metadata)
 
-    db.add_all(file_metadata_list)
-    db.commit()
+    async with request.form(
+        max_files=StorageConfig.UPLOAD_MAX_FILES, max_fields=StorageConfig.UPLOAD_MAX_FILES
+    ) as form:
+        files = [part for part in form.getlist("files") if not isinstance(part, str)]
+        paths = form.getlist("paths") or [file.filename for file in files]
+        if not files or len(paths) != len(files):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Expected one path for every file",
+            )
+        try:
+            parts = [split_relative_path(path) for path in paths]
+        except ValueError as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
 
-    # Refresh to get assigned file_id
-    for file_metadata in file_metadata_list:
-        db.refresh(file_metadata)
+        folder_ids = ensure_folders(db, user.uid, folder.folder_id, {path[:-1] for path in parts})
+        return await store_uploads(
+            db,
+            user.uid,
+            [(folder_ids[path[:-1]], file, path[-1]) for file, path in zip(files, parts)],
+        )
 
-    return file_metadata_list
+
+@router.post(
+    "/extract/{folder_id}",
+    status_code=status.HTTP_201_CREATED,
+    response_model=JobDetails,
+)
+async def upload_and_extract(
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    folder_id: UUID,
+    file: UploadFile,
+    db: Session = Depends(get_session),
+):
+    """
+    Uploads a zip archive and extracts its contents into a folder.
+
+    The archive is checked for path traversal and zip bomb limits before anything
+    is written. Its folders are created in bulk and the entries are streamed into
+    storage, files that already exist become new versions. Small archives are
+    extracted before the response is sent (201), larger ones by a background job
+    (202) that can be followed at GET /jobs/{job_id}.
+
+    Args:
+        request (Request): The HTTP request object.
+        response (Response): The response, its status tells whether the extraction is done.
+        background_tasks (BackgroundTasks): Runs large extractions after the response.
+        folder_id (UUID): The UUID of the folder to extract into.
+        file (UploadFile): The zip archive.
+        db (Session): The database session dependency.
+
+    Returns:
+        JobDetails: The extraction job.
+
+    Raises:
+        HTTPException: If the folder is not found, the upload is not a valid archive
+            or it exceeds the extraction limits.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    folder = (
+        db.query(Folder)
+        .filter(
+            Folder.folder_id == folder_id,
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+        .first()
+    )
+    if not folder:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found or trashed"
+        )
+    try:
+        entries, _, total_size = await run_in_threadpool(inspect_archive, file.file, file.size)
+    except ArchiveLimitError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(exc)
+        )
+    except ArchiveError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+    params = {"folder_id": str(folder.folder_id), "archive": file.filename}
+    job = create_job(db, user.uid, EXTRACT_ARCHIVE, params, total=len(entries))
+    if len(entries) > ExtractConfig.INLINE_MAX_FILES or total_size > ExtractConfig.INLINE_MAX_BYTES:
+        # the upload is closed with the request, the job reads its own copy
+        archive_path = await run_in_threadpool(_spool_archive, file.file)
+        work = partial(_extract_job, user.uid, folder.folder_id, archive_path, file.size)
+        background_tasks.add_task(run_job, job.job_id, work)
+        response.status_code = status.HTTP_202_ACCEPTED
+    else:
+        work = partial(_extract_upload, user.uid, folder.folder_id, file.file, file.size)
+        await run_in_threadpool(run_job, job.job_id, work)
+    db.refresh(job)
+    return job
+
+
+def _spool_archive(fileobj) -> str:
+    fileobj.seek(0)
+    with NamedTemporaryFile(suffix=".zip", delete=False) as archive:
+        shutil.copyfileobj(fileobj, archive, 1024 * 1024)
+    return archive.name
+
+
+def _extract_upload(user_id, folder_id, fileobj, archive_size, db, progress):
+    return extract_archive(db, user_id, folder_id, fileobj, archive_size, progress)
+
+
+def _extract_job(user_id, folder_id, archive_path, archive_size, db, progress):
+    try:
+        with open(archive_path, "rb") as archive:
+            return extract_archive(db, user_id, folder_id, archive, archive_size, progress)
+    finally:
+        os.remove(archive_path)
 
 
 @router.put(
@@ -196,6 +490,7 @@ async def rename_file(
     file.file_name = file_name
     file.update_timestamp()
     db.commit()
+    blob_cache.invalidate(file.file_id)
     return file
 
 
@@ -237,6 +532,7 @@ async def delete_file(
     file.is_trashed = True
     file.trashed_at = datetime.now()
     db.commit()
+    blob_cache.invalidate(file.file_id)
     return file
 
 
@@ -244,6 +540,7 @@ async def delete_file(
 async def download_file(
     request: Request,
     file_id: UUID,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_session),
 ):
     """
@@ -252,10 +549,16 @@ async def download_file(
     Args:
         request (Request): The HTTP request object.
         file_id (UUID): The UUID of the file to download.
+        background_tasks (BackgroundTasks): Promotes a cold file after the download.
         db (Session): The database session dependency.
 
     Returns:
-        FileResponse: The file response object containing the file.
+        FileResponse: The file response object containing the file, or an
+        X-Accel-Redirect/X-Sendfile response when download offloading is enabled.
+        Files compressed at rest are sent zstd encoded if the client accepts it,
+        otherwise decompressed as a stream (Range requests are supported either way).
+        Small files downloaded repeatedly are served from the worker's memory cache.
+        A file on the cold tier is served from there and moved back to a hot volume afterwards.
 
     Raises:
         HTTPException: If the file is not found or if the file is in trash.
@@ -276,7 +579,368 @@ async def download_file(
             status_code=status.HTTP_400_BAD_REQUEST, detail="File is in trash"
         )
 
-    return FileResponse(file.storage_location, filename=file.file_name)
+    record_access(file.user_id, file.file_id)
+    if file.storage_tier == COLD:
+        background_tasks.add_task(promote_file, file.user_id, file.file_id)
+    response = await cached_file_response(request, file)
+    if response is not None:
+        DOWNLOAD_BYTES.labels("cache").inc(file.file_size)
+        return response
+    response, mode = stored_file_response(request, file)
+    DOWNLOAD_BYTES.labels(mode).inc(file.file_size)
+    return response
+
+
+@router.get("/versions/{file_id}", response_model=list[FileVersionDetails])
+async def list_file_versions(
+    request: Request,
+    file_id: UUID,
+    db: Session = Depends(get_read_session),
+):
+    """
+    Lists the versions of a file, newest first.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file.
+        db (Session): The database session dependency.
+
+    Returns:
+        List[FileVersionDetails]: The current version followed by the archived ones.
+
+    Raises:
+        HTTPException: If the file is not found.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    file = (
+        db.query(FileMetadata)
+        .filter(FileMetadata.file_id == file_id, FileMetadata.user_id == user.uid)
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
+        )
+    # the chunk lists are not needed for the listing
+    versions = (
+        db.query(
+            FileVersion.version_number,
+            FileVersion.file_size,
+            FileVersion.file_type,
+            FileVersion.created_at,
+        )
+        .filter(FileVersion.file_id == file.file_id)
+        .order_by(FileVersion.version_number.desc())
+        .all()
+    )
+    current = FileVersionDetails(
+        version_number=file.version,
+        file_size=file.file_size,
+        file_type=file.file_type,
+        created_at=file.updated_at,
+        is_current=True,
+    )
+    return [current, *versions]
+
+
+@router.get("/versions/{file_id}/{version_number}")
+async def download_file_version(
+    request: Request,
+    file_id: UUID,
+    version_number: int,
+    db: Session = Depends(get_session),
+):
+    """
+    Downloads a specific version of a file.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file.
+        version_number (int): The version to download.
+        db (Session): The database session dependency.
+
+    Returns:
+        StreamingResponse: The content of the version, reassembled from the chunk store.
+        A single Range is supported.
+
+    Raises:
+        HTTPException: If the file is not found or trashed, or the version is not found.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    file = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.file_id == file_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found or trashed"
+        )
+    if version_number == file.version:
+        response, mode = stored_file_response(request, file)
+        DOWNLOAD_BYTES.labels(mode).inc(file.file_size)
+        return response
+    version = (
+        db.query(FileVersion)
+        .filter(
+            FileVersion.file_id == file.file_id,
+            FileVersion.version_number == version_number,
+        )
+        .first()
+    )
+    if not version:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Version not found"
+        )
+
+    byte_range = parse_range(request.headers.get("range"), version.file_size)
+    start, end = byte_range or (0, version.file_size)
+    headers = {
+        "Content-Disposition": content_disposition(file.file_name),
+        "Content-Length": str(end - start),
+        "Accept-Ranges": "bytes",
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{version.file_size}"
+    DOWNLOAD_BYTES.labels("version").inc(end - start)
+    return StreamingResponse(
+        iter_version(db, version, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        media_type=version.file_type,
+        headers=headers,
+    )
+
+
+@router.post("/versions/{file_id}/{version_number}/restore", response_model=FileDetails)
+async def restore_file_version(
+    request: Request,
+    file_id: UUID,
+    version_number: int,
+    db: Session = Depends(get_session),
+):
+    """
+    Makes an older version the current content of a file.
+
+    The content being replaced is archived as a version first, so a restore can be undone.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file.
+        version_number (int): The version to restore.
+        db (Session): The database session dependency.
+
+    Returns:
+        FileDetails: The file with the restored content.
+
+    Raises:
+        HTTPException: If the file is not found or trashed, or the version is not found.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    file = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.file_id == file_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+        .with_for_update()
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found or trashed"
+        )
+    if version_number == file.version:
+        return file
+    version = (
+        db.query(FileVersion)
+        .filter(
+            FileVersion.file_id == file.file_id,
+            FileVersion.version_number == version_number,
+        )
+        .first()
+    )
+    if not version:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Version not found"
+        )
+
+    await run_in_threadpool(_restore_version, db, file, version)
+    blob_cache.invalidate(file.file_id)
+    return file
+
+
+def _restore_version(db: Session, file: FileMetadata, version: FileVersion):
+    # run in the threadpool, it reads the version and archives the current content;
+    # the lock keeps the chunks of the version from being swept while they are read
+    lock_chunk_store(db)
+    staged = stage_chunks(
+        iter_version(db, version),
+        os.path.dirname(file.storage_location),
+        should_compress(version.file_type, file.file_name),
+    )
+    try:
+        archive_version(db, file)
+    except BaseException:
+        discard(staged)
+        raise
+    commit_blob(staged, file.storage_location)
+    file.file_size = staged.size
+    file.file_type = version.file_type
+    file.compression = staged.compression
+    file.stored_size = staged.stored_size
+    file.version += 1
+    file.update_timestamp()
+    file.clear_media_attributes()
+    db.commit()
+
+
+@router.get("/signature/{file_id}", response_model=FileSignatures)
+async def get_file_signature(
+    request: Request,
+    file_id: UUID,
+    block_size: int = Query(default=None, ge=MIN_BLOCK_SIZE, le=MAX_BLOCK_SIZE),
+    db: Session = Depends(get_session),
+):
+    """
+    Returns the block signatures of a file's current content for a delta upload.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file.
+        block_size (int): Bytes per block, DELTA_BLOCK_SIZE by default.
+        db (Session): The database session dependency.
+
+    Returns:
+        FileSignatures: The version the signatures belong to and the Adler-32 and
+        BLAKE2b-128 checksums of every block.
+
+    Raises:
+        HTTPException: If the file is not found or trashed.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    file = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.file_id == file_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found or trashed"
+        )
+    signatures = {
+        "file_id": file.file_id,
+        "version": file.version,
+        "file_size": file.file_size,
+        "block_size": block_size or DeltaConfig.BLOCK_SIZE,
+    }
+    storage_location, blob_compression = file.storage_location, file.compression
+    # the connection is not held while the blob is read
+    db.commit()
+    # a blob replaced meanwhile yields signatures of a newer version, the delta upload is then refused
+    signatures["blocks"] = await run_in_threadpool(
+        block_signatures, storage_location, blob_compression, signatures["block_size"]
+    )
+    return signatures
+
+
+@router.post("/delta/{file_id}", response_model=FileDetails)
+async def upload_file_delta(
+    request: Request,
+    file_id: UUID,
+    recipe: str = Form(...),
+    data: UploadFile | None = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Replaces a file's content by uploading only the blocks that changed.
+
+    The new content is rebuilt from runs of blocks of the stored content and the
+    uploaded data, in the order of the recipe's instructions, and stored as a new
+    version of the file like a full upload would be.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file.
+        recipe (str): A DeltaRecipe as JSON: base_version and block_size of the signatures
+            it was computed against, file_size and sha256 of the new content, and the
+            instructions, {"block": i, "count": n} to copy n stored blocks from block i or
+            {"data": n} to take the next n bytes of `data`.
+        data (UploadFile | None): The new bytes, concatenated in the order the instructions use them.
+        db (Session): The database session dependency.
+
+    Returns:
+        FileDetails: The file with its new content.
+
+    Raises:
+        HTTPException: If the file is not found or trashed, changed since base_version,
+        the new content is too large, or the recipe does not produce content matching
+        file_size and sha256.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    try:
+        delta = DeltaRecipe.model_validate_json(recipe)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
+    if delta.file_size > AdmissionConfig.MAX_UPLOAD_BYTES:
+        # copied blocks are not part of the request body the admission check saw
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Upload exceeds the limit of {AdmissionConfig.MAX_UPLOAD_BYTES} bytes",
+        )
+    file = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.file_id == file_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+        .with_for_update()
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found or trashed"
+        )
+    if file.version != delta.base_version:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"The file is at version {file.version}, fetch its signatures again",
+        )
+
+    # the row stays locked while the content is rebuilt, so the old blob cannot be replaced or moved
+    try:
+        staged = await run_in_threadpool(
+            apply_delta,
+            file.storage_location,
+            file.compression,
+            file.file_size,
+            delta,
+            data.file if data else io.BytesIO(),
+            blob_directory(user.uid, file.folder_id, file.file_name),
+            should_compress(file.file_type, file.file_name),
+        )
+    except DeltaError as exc:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exc))
+    # archiving the replaced content reads and hashes the whole old blob
+    details = await run_in_threadpool(commit_new_version, db, file, staged)
+    UPLOAD_BYTES.inc(staged.size)
+    return details
 
 
 @router.get("/untrash/{file_id}", response_model=FileDetails)
@@ -308,6 +972,8 @@ async def restore_file(
             FileMetadata.user_id == user.uid,
             FileMetadata.is_trashed == True,
         )
+        # waits for a purge deleting the file, which then is no longer found
+        .with_for_update()
         .first()
     )
     if not file:
@@ -321,7 +987,7 @@ async def restore_file(
 
 
 @router.get("/trash", response_model=list[TrashFileDetails])
-async def show_trash(request: Request, db: Session = Depends(get_session)):
+async def show_trash(request: Request, db: Session = Depends(get_read_session)):
     """
     Retrieves all trashed files for the authenticated user.
 
@@ -356,34 +1022,11 @@ async def empty_trash(request: Request, db: Session = Depends(get_session)):
     """
     token = request.headers.get("Authorization").split(" ")[1]
     user = await get_current_user(token, db)
-    folders = (
-        db.query(Folder)
-        .filter(Folder.user_id == user.uid, Folder.is_trashed == True)
-        .all()
-    )
-    files = (
-        db.query(FileMetadata)
-        .filter(FileMetadata.user_id == user.uid, FileMetadata.is_trashed == True)
-        .all()
-    )
-    if not folders and not files:
+    purged_files = purge_trashed_files(db, user_id=user.uid)
+    purged_folders = purge_trashed_folders(db, user_id=user.uid)
+    if not purged_files and not purged_folders:
         return {"message": "Trash is already empty"}
 
-    for file in files:
-        os.remove(file.storage_location)
-        db.delete(file)
-        db.commit()
-
-    for folder in folders:
-        try:
-            from scripts.delete_folder_recursive import delete_folder_recursive
-
-            delete_folder_recursive(f"{UPLOAD_FOLDER}/{user.uid}", folder.folder_id)
-        except FileNotFoundError:
-            pass
-        db.delete(folder)
-        db.commit()
-
     return {"message": "Trash cleaned successfully"}
 
 
@@ -420,7 +1063,11 @@ async def move_file(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
         )
-    folder = db.query(Folder).filter(Folder.folder_id == folder_id).first()
+    folder = (
+        db.query(Folder)
+        .filter(Folder.folder_id == folder_id, Folder.user_id == user.uid)
+        .first()
+    )
     if not folder:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found"
@@ -429,4 +1076,87 @@ async def move_file(
     folder.update_timestamp()
     file.update_timestamp()
     db.commit()
+    blob_cache.invalidate(file.file_id)
     return file
+
+
+@router.post(
+    "/copy/{file_id}", status_code=status.HTTP_201_CREATED, response_model=FileDetails
+)
+async def copy_file(
+    request: Request,
+    file_id: UUID,
+    folder_id: UUID | None = None,
+    file_name: str | None = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Copies a file on the server, without downloading and uploading it again.
+
+    The content is cloned with a reflink or hard link where the filesystem
+    allows it, so copies of large files are cheap. Versions are not copied.
+
+    Args:
+        request (Request): The HTTP request object.
+        file_id (UUID): The UUID of the file to copy.
+        folder_id (UUID | None): The folder to copy into. Defaults to the file's folder.
+        file_name (str | None): Name of the copy. Defaults to the file's name, with
+            " (copy)" appended if it is taken in the destination.
+        db (Session): The database session dependency.
+
+    Returns:
+        FileDetails: The new file.
+
+    Raises:
+        HTTPException: If the file or folder is not found, or the name is invalid or taken.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    if file_name is not None:
+        try:
+            check_name(file_name)
+        except ValueError as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    file = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.file_id == file_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+        .first()
+    )
+    if not file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
+        )
+    folder = (
+        db.query(Folder)
+        .filter(
+            Folder.folder_id == (folder_id or file.folder_id),
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+        .first()
+    )
+    if not folder:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found or trashed"
+        )
+    taken = {
+        name
+        for (name,) in db.query(FileMetadata.file_name).filter(
+            FileMetadata.folder_id == folder.folder_id,
+            FileMetadata.user_id == user.uid,
+            FileMetadata.is_trashed == False,
+        )
+    }
+    if file_name is None:
+        file_name = copy_name(file.file_name, taken)
+    elif file_name in taken:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A file with this name already exists in the folder",
+        )
+    folder.update_timestamp()
+    return await run_in_threadpool(duplicate_file, db, file, folder.folder_id, file_name)
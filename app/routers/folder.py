@@ -1,29 +1,42 @@
 import os
-from fastapi import APIRouter, HTTPException, Request, status, Depends
+import posixpath
+import zipfile
+from functools import partial
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status, Depends
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 
 from typing import Optional
 
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 
 from models.postgres_models import FileMetadata, Folder
 from models.schemas import (
     FolderDetails,
+    FolderTree,
     FullFolderDetails,
+    JobDetails,
     TrashFolderDetails,
     TrashFullFolderDetails,
 )
 
 from utils.oauth import get_current_user
+from utils.copying import COPY_FOLDER, copy_name, duplicate_folder, subtree_size
+from utils.folders import folder_tree, get_root_folder_id, tree_version
+from utils.jobs import create_job, run_job
+from utils.storage import iter_blob
+from utils.tiering import record_access
 
-from database import get_session
+from config import CopyConfig
+
+from database import get_read_session, get_session
 from sqlalchemy.orm import Session
 
 from uuid import UUID
 
 from datetime import datetime
 
-from tempfile import TemporaryDirectory
-from shutil import make_archive
+from tempfile import NamedTemporaryFile
 
 router = APIRouter(
     prefix="/folder",
@@ -58,12 +71,7 @@ async def create_folder(
     token = request.headers.get("Authorization").split(" ")[1]
     user = await get_current_user(token, db)
     if folder_name == "/" and parent_folder == None:
-        root_folder = (
-            db.query(Folder)
-            .filter(Folder.folder_name == "/", Folder.user_id == user.uid)
-            .first()
-        )
-        if root_folder:
+        if get_root_folder_id(db, user):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Root folder already exists",
@@ -73,16 +81,13 @@ async def create_folder(
                 folder_name=folder_name, parent_folder=parent_folder, user_id=user.uid
             )
             db.add(root_folder)
+            db.flush()
+            user.root_folder_id = root_folder.folder_id
             db.commit()
             db.refresh(root_folder)
             return root_folder
     if parent_folder == None:
-        parent_folder = (
-            db.query(Folder)
-            .filter(Folder.folder_name == "/", Folder.user_id == user.uid)
-            .first()
-            .folder_id
-        )
+        parent_folder = get_root_folder_id(db, user)
     folder = Folder(
         folder_name=folder_name, parent_folder=parent_folder, user_id=user.uid
     )
@@ -95,7 +100,7 @@ async def create_folder(
 @router.get("/",response_model=list[FolderDetails])
 async def get_user_folders(
     request: Request,
-    db: Session = Depends(get_session),
+    db: Session = Depends(get_read_session),
 ):
     """
     Retrieves all folders for the authenticated user.
@@ -120,7 +125,7 @@ async def get_user_folders(
 @router.get("/root", response_model=FolderDetails)
 async def get_root_folder(
     request: Request,
-    db: Session = Depends(get_session),
+    db: Session = Depends(get_read_session),
 ):
     """
     Retrieves the root folder for the authenticated user.
@@ -137,10 +142,13 @@ async def get_root_folder(
     """
     token = request.headers.get("Authorization").split(" ")[1]
     user = await get_current_user(token, db)
+    root_folder_id = get_root_folder_id(db, user)
     folder = (
         db.query(Folder)
-        .filter(Folder.folder_name == "/", Folder.user_id == user.uid)
+        .filter(Folder.folder_id == root_folder_id, Folder.user_id == user.uid)
         .first()
+        if root_folder_id
+        else None
     )
     if not folder:
         raise HTTPException(
@@ -148,11 +156,43 @@ async def get_root_folder(
         )
     return folder
 
+@router.get("/tree", response_model=FolderTree)
+async def get_folder_tree(
+    request: Request,
+    include_files: bool = False,
+    db: Session = Depends(get_read_session),
+):
+    """
+    Retrieves the authenticated user's whole folder tree in one request.
+
+    Folders (and files with `include_files`) are returned as parallel arrays where
+    parents are referenced by their index. The `version` is also sent as ETag, a
+    request with a matching If-None-Match gets a 304 without the tree being loaded.
+
+    Args:
+        request (Request): The HTTP request object.
+        include_files (bool): Whether to include the files of every folder. Defaults to False.
+        db (Session): The database session dependency.
+
+    Returns:
+        FolderTree: The encoded tree and its version stamp.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    version = tree_version(db, user.uid, include_files)
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    tree = folder_tree(db, user.uid, include_files)
+    return JSONResponse({"version": version, **tree}, headers=headers)
+
+
 @router.get("/{folder_id}", response_model=FolderDetails)
 async def get_folder_detail(
     request: Request,
     folder_id: UUID,
-    db: Session = Depends(get_session),
+    db: Session = Depends(get_read_session),
 ):
     """
     Retrieves details of a specific folder by its ID.
@@ -190,7 +230,7 @@ async def get_folder_detail(
 async def get_folder_contents(
     request: Request,
     folder_id: UUID,
-    db: Session = Depends(get_session),
+    db: Session = Depends(get_read_session),
 ):
     """
     Retrieves the contents of a specific folder, including subfolders and files.
@@ -223,12 +263,16 @@ async def get_folder_contents(
         )
     subfolders = (
         db.query(Folder)
-        .filter(Folder.parent_folder == folder_id, Folder.is_trashed == False)
+        .filter(Folder.user_id == user.uid, Folder.parent_folder == folder_id, Folder.is_trashed == False)
         .all()
     )
     files = (
         db.query(FileMetadata)
-        .filter(FileMetadata.folder_id == folder_id, FileMetadata.is_trashed == False)
+        .filter(
+            FileMetadata.user_id == user.uid,
+            FileMetadata.folder_id == folder_id,
+            FileMetadata.is_trashed == False,
+        )
         .all()
     )
     return {
@@ -321,7 +365,11 @@ async def trash_folder(
             status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found"
         )
     # trash all files in the folder
-    files = db.query(FileMetadata).filter(FileMetadata.folder_id == folder_id).all()
+    files = (
+        db.query(FileMetadata)
+        .filter(FileMetadata.user_id == user.uid, FileMetadata.folder_id == folder_id)
+        .all()
+    )
     trashed_files = []
     for file in files:
         file.is_trashed = True
@@ -336,7 +384,11 @@ async def trash_folder(
     db.commit()
 
     # trash all subfolders
-    subfolders = db.query(Folder).filter(Folder.parent_folder == folder_id).all()
+    subfolders = (
+        db.query(Folder)
+        .filter(Folder.user_id == user.uid, Folder.parent_folder == folder_id)
+        .all()
+    )
     trashed_subfolders = []
     for subfolder in subfolders:
         trashed_subfolder = await trash_folder(subfolder.folder_id, request, db)
@@ -357,7 +409,7 @@ async def trash_folder(
 
 
 @router.get("/trash/", response_model=list[TrashFolderDetails])
-async def get_trashed_folders(request: Request, db: Session = Depends(get_session)):
+async def get_trashed_folders(request: Request, db: Session = Depends(get_read_session)):
     """
     Retrieves all trashed folders for the authenticated user.
 
@@ -380,7 +432,7 @@ async def get_trashed_folders(request: Request, db: Session = Depends(get_sessio
 
 @router.get("/trash/{folder_id}", response_model=TrashFullFolderDetails)
 async def get_trash_folder_details(
-    folder_id: UUID, request: Request, db: Session = Depends(get_session)
+    folder_id: UUID, request: Request, db: Session = Depends(get_read_session)
 ):
     """
     Retrieves details of a specific trashed folder by its ID.
@@ -413,12 +465,16 @@ async def get_trash_folder_details(
         )
     subfolders = (
         db.query(Folder)
-        .filter(Folder.parent_folder == folder_id, Folder.is_trashed == True)
+        .filter(Folder.user_id == user.uid, Folder.parent_folder == folder_id, Folder.is_trashed == True)
         .all()
     )
     files = (
         db.query(FileMetadata)
-        .filter(FileMetadata.folder_id == folder_id, FileMetadata.is_trashed == True)
+        .filter(
+            FileMetadata.user_id == user.uid,
+            FileMetadata.folder_id == folder_id,
+            FileMetadata.is_trashed == True,
+        )
         .all()
     )
     return {
@@ -474,6 +530,135 @@ async def move_folder(
     return folder
 
 
+@router.post(
+    "/copy/{folder_id}", status_code=status.HTTP_201_CREATED, response_model=JobDetails
+)
+async def copy_folder(
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    folder_id: UUID,
+    parent_folder: Optional[UUID] = None,
+    folder_name: Optional[str] = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Copies a folder with all its subfolders and files on the server.
+
+    File contents are cloned with reflinks or hard links where the filesystem
+    allows it and all rows are inserted in bulk. Small folders are copied before
+    the response is sent (201), larger ones by a background job (202) whose
+    progress can be followed at GET /jobs/{job_id}. The finished job's result
+    holds the id of the new folder.
+
+    Args:
+        request (Request): The HTTP request object.
+        response (Response): The response, its status tells whether the copy is done.
+        background_tasks (BackgroundTasks): Runs large copies after the response.
+        folder_id (UUID): The UUID of the folder to copy.
+        parent_folder (Optional[UUID]): The folder to copy into. Defaults to the folder's parent.
+        folder_name (Optional[str]): Name of the copy. Defaults to the folder's name, with
+            " (copy)" appended if it is taken in the destination.
+        db (Session): The database session dependency.
+
+    Returns:
+        JobDetails: The copy job.
+
+    Raises:
+        HTTPException: If a folder is not found, the root folder is copied or the name is taken.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    folder = (
+        db.query(Folder)
+        .filter(
+            Folder.folder_id == folder_id,
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+        .first()
+    )
+    if not folder:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found"
+        )
+    if folder.parent_folder is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The root folder cannot be copied",
+        )
+    destination = (
+        db.query(Folder)
+        .filter(
+            Folder.folder_id == (parent_folder or folder.parent_folder),
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+        .first()
+    )
+    if not destination:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Parent folder not found or trashed"
+        )
+    taken = {
+        name
+        for (name,) in db.query(Folder.folder_name).filter(
+            Folder.parent_folder == destination.folder_id,
+            Folder.user_id == user.uid,
+            Folder.is_trashed == False,
+        )
+    }
+    if folder_name is None:
+        folder_name = copy_name(folder.folder_name, taken)
+    elif folder_name in taken:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A folder with this name already exists",
+        )
+
+    # the subtree is read when the job starts, a copy into the folder itself does not recurse
+    files, size = subtree_size(db, user.uid, folder.folder_id)
+    params = {
+        "folder_id": str(folder.folder_id),
+        "parent_folder": str(destination.folder_id),
+        "folder_name": folder_name,
+    }
+    job = create_job(db, user.uid, COPY_FOLDER, params, total=files)
+    work = partial(_copy_folder_job, user.uid, folder.folder_id, destination.folder_id, folder_name)
+    if files > CopyConfig.INLINE_MAX_FILES or size > CopyConfig.INLINE_MAX_BYTES:
+        background_tasks.add_task(run_job, job.job_id, work)
+        response.status_code = status.HTTP_202_ACCEPTED
+    else:
+        await run_in_threadpool(run_job, job.job_id, work)
+    db.refresh(job)
+    return job
+
+
+def _copy_folder_job(user_id, folder_id, parent_folder, folder_name, db, progress):
+    new_folder_id = duplicate_folder(db, user_id, folder_id, parent_folder, folder_name, progress)
+    return {"folder_id": str(new_folder_id)}
+
+
+def _build_folder_archive(archive_paths: dict, files: list) -> str:
+    # writes the zip to a temporary file and returns its path, removed again on failure
+    archive = NamedTemporaryFile(suffix=".zip", delete=False)
+    try:
+        with archive, zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for path in archive_paths.values():
+                if path:
+                    zip_file.writestr(path + "/", b"")
+            for file in files:
+                record_access(file.user_id, file.file_id)
+                name = posixpath.join(archive_paths[file.folder_id], file.file_name)
+                with zip_file.open(name, "w", force_zip64=True) as entry:
+                    for chunk in iter_blob(file.storage_location, file.compression):
+                        entry.write(chunk)
+    except BaseException:
+        os.remove(archive.name)
+        raise
+    return archive.name
+
+
 @router.get("/download/{folder_id}", response_class=FileResponse)
 async def download_folder(
     request: Request,
@@ -483,6 +668,9 @@ async def download_folder(
     """
     Download a folder as a zip file.
 
+    The archive is built from the file metadata, so subfolders keep their names
+    and files compressed at rest are added with their original content.
+
     Args:
         request (Request): The request object
         folder_id (UUID): The folder_id of the folder to download
@@ -503,21 +691,46 @@ async def download_folder(
             status_code=status.HTTP_404_NOT_FOUND, detail="Folder not found"
         )
     folder_name = folder.folder_name
-    folder_path = f"{UPLOAD_FOLDER}/{user.uid}/{folder.folder_id}"
 
-    try:
-        with TemporaryDirectory() as temp_folder:
-            zip_file_path = os.path.join(temp_folder, f"{folder_name}.zip")
-            make_archive(
-                base_name=zip_file_path[:-4], format="zip", root_dir=folder_path
-            )
-            return FileResponse(
-                path=zip_file_path,
-                filename=f"{folder_name}.zip",
-                media_type="application/zip",
+    # archive paths of the folder and all its non-trashed subfolders
+    children = {}
+    for subfolder in (
+        db.query(Folder)
+        .filter(Folder.user_id == user.uid, Folder.is_trashed == False)
+        .all()
+    ):
+        children.setdefault(subfolder.parent_folder, []).append(subfolder)
+    archive_paths = {folder.folder_id: ""}
+    pending = [folder.folder_id]
+    while pending:
+        parent_id = pending.pop()
+        for subfolder in children.get(parent_id, []):
+            archive_paths[subfolder.folder_id] = posixpath.join(
+                archive_paths[parent_id], subfolder.folder_name
             )
+            pending.append(subfolder.folder_id)
+
+    files = (
+        db.query(FileMetadata)
+        .filter(
+            FileMetadata.user_id == user.uid,
+            FileMetadata.folder_id.in_(archive_paths.keys()),
+            FileMetadata.is_trashed == False,
+        )
+        .all()
+    )
+
+    try:
+        # deflating and decompressing every blob is CPU and disk bound
+        archive_path = await run_in_threadpool(_build_folder_archive, archive_paths, files)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while preparing the folder for download: {str(e)}",
         )
+    return FileResponse(
+        path=archive_path,
+        filename=f"{folder_name}.zip",
+        media_type="application/zip",
+        background=BackgroundTask(os.remove, archive_path),
+    )
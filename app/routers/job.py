@@ -0,0 +1,76 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Request
+
+from models.postgres_models import Job
+from models.schemas import JobDetails
+
+from utils.oauth import get_current_user
+
+from database import get_session
+from sqlalchemy.orm import Session
+
+from uuid import UUID
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    responses={404: {"description": "Not found"}},
+)
+
+# most recent jobs listed by GET /jobs/
+JOB_LIST_LIMIT = 50
+
+
+@router.get("/", response_model=list[JobDetails])
+async def get_user_jobs(
+    request: Request,
+    db: Session = Depends(get_session),
+):
+    """
+    Retrieves the most recent background jobs of the authenticated user.
+
+    Args:
+        request (Request): The HTTP request object.
+        db (Session): The database session dependency.
+
+    Returns:
+        list[JobDetails]: The jobs, newest first.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    return (
+        db.query(Job)
+        .filter(Job.user_id == user.uid)
+        .order_by(Job.created_at.desc())
+        .limit(JOB_LIST_LIMIT)
+        .all()
+    )
+
+
+@router.get("/{job_id}", response_model=JobDetails)
+async def get_job(
+    request: Request,
+    job_id: UUID,
+    db: Session = Depends(get_session),
+):
+    """
+    Retrieves the status and progress of a background job.
+
+    Args:
+        request (Request): The HTTP request object.
+        job_id (UUID): The UUID of the job.
+        db (Session): The database session dependency.
+
+    Returns:
+        JobDetails: The job.
+
+    Raises:
+        HTTPException: If the job is not found.
+    """
+    token = request.headers.get("Authorization").split(" ")[1]
+    user = await get_current_user(token, db)
+    job = db.query(Job).filter(Job.job_id == job_id, Job.user_id == user.uid).first()
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job not found"
+        )
+    return job
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Response
+
+from utils.metrics import render_metrics
+
+router = APIRouter(
+    tags=["metrics"],
+)
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Exposes the application metrics for prometheus to scrape.
+
+    Returns:
+        Response: The metrics in the prometheus text exposition format.
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
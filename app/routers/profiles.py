@@ -0,0 +1,58 @@
+import os
+
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import FileResponse
+
+from utils.profiler import authorized, list_profiles, profile_path
+
+router = APIRouter(
+    prefix="/profiles",
+    tags=["profiles"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+def _check_token(request: Request):
+    # without the profiling token the endpoints do not exist
+    if not authorized(request.headers.get("X-Profile")):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+
+
+@router.get("/", include_in_schema=False)
+async def get_profiles(request: Request):
+    """
+    Lists the stored request profiles, newest first.
+
+    Args:
+        request (Request): The HTTP request object, carrying the profiling token in X-Profile.
+
+    Returns:
+        list[dict]: Id, format, trigger, method, path, route, status, duration and creation time of each profile.
+
+    Raises:
+        HTTPException: If the profiling token is missing or wrong.
+    """
+    _check_token(request)
+    return list_profiles()
+
+
+@router.get("/{profile_id}", include_in_schema=False)
+async def get_profile(profile_id: str, request: Request):
+    """
+    Downloads a stored request profile.
+
+    Args:
+        profile_id (str): The id returned in the X-Profile-Id header or listed by GET /profiles/.
+        request (Request): The HTTP request object, carrying the profiling token in X-Profile.
+
+    Returns:
+        FileResponse: The profile, speedscope JSON with pyinstrument or a pstats file with cProfile.
+
+    Raises:
+        HTTPException: If the profiling token is wrong or the profile does not exist.
+    """
+    _check_token(request)
+    path = profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
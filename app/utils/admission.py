@@ -0,0 +1,268 @@
+"""
+Admission control for the expensive paths: uploads, folder zips and downloads.
+
+Every request on one of these routes needs a concurrency slot and a token from
+a token bucket, both per user and globally, or it is turned away with a 429 and
+a Retry-After. Upload bodies over MAX_UPLOAD_BYTES or the user's quota are
+rejected from their Content-Length before anything is read. Slots and buckets
+live in a sqlite file so all workers on the host share the same limits.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import compile_path
+
+from config import AdmissionConfig
+from database import engine
+from models.postgres_models import FileMetadata, User
+
+from .jwttoken import decode_access_token
+from .metrics import ADMISSION_REJECTED
+
+UPLOAD = "upload"
+ZIP = "zip"
+DOWNLOAD = "download"
+
+ROUTE_CLASSES = {
+    ("POST", "/files/upload/{folder_id}"): UPLOAD,
+    ("POST", "/files/upload-tree/{folder_id}"): UPLOAD,
+    ("POST", "/files/extract/{folder_id}"): UPLOAD,
+    ("POST", "/files/delta/{file_id}"): UPLOAD,
+    ("GET", "/folder/download/{folder_id}"): ZIP,
+    ("GET", "/files/download/{file_id}"): DOWNLOAD,
+    ("GET", "/files/versions/{file_id}/{version_number}"): DOWNLOAD,
+    # reads the whole blob to checksum it
+    ("GET", "/files/signature/{file_id}"): DOWNLOAD,
+}
+# matched against the request path before routing, the first match wins
+ROUTE_PATTERNS = [
+    (method, compile_path(path)[0], kind) for (method, path), kind in ROUTE_CLASSES.items()
+]
+
+
+@dataclass
+class Limit:
+    key: str
+    concurrency: int = 0
+    rate: float = 0
+    burst: float = 0
+
+
+@dataclass
+class Admission:
+    token: str | None
+    reason: str | None = None
+    retry_after: float = 0
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StateStore:
+    """Concurrency slots and token buckets in a sqlite file shared by the workers of a host."""
+
+    def __init__(self, path: str, slot_timeout: float = AdmissionConfig.SLOT_TIMEOUT_SECONDS):
+        self.path = path
+        self.slot_timeout = slot_timeout
+        self.local = threading.local()
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS slot ("
+            " token TEXT NOT NULL, key TEXT NOT NULL, pid INTEGER NOT NULL, acquired_at REAL NOT NULL,"
+            " PRIMARY KEY (token, key))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_slot_key ON slot (key)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        # slots held by workers that died with requests in flight
+        dead = [(pid,) for (pid,) in connection.execute("SELECT DISTINCT pid FROM slot") if not _alive(pid)]
+        connection.executemany("DELETE FROM slot WHERE pid = ?", dead)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def acquire(self, limits: list[Limit]) -> Admission:
+        """
+        Takes a slot and a token for every limit, or nothing if any of them is exhausted.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM slot WHERE acquired_at < ?", (now - self.slot_timeout,))
+            for limit in limits:
+                if not limit.concurrency:
+                    continue
+                (in_flight,) = connection.execute(
+                    "SELECT count(*) FROM slot WHERE key = ?", (limit.key,)
+                ).fetchone()
+                if in_flight >= limit.concurrency:
+                    connection.execute("ROLLBACK")
+                    return Admission(None, "concurrency", 1)
+
+            buckets = []
+            for limit in limits:
+                if not limit.rate:
+                    continue
+                burst = max(limit.burst, 1)
+                row = connection.execute(
+                    "SELECT tokens, updated_at FROM bucket WHERE key = ?", (limit.key,)
+                ).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * limit.rate)
+                if tokens < 1:
+                    connection.execute("ROLLBACK")
+                    return Admission(None, "rate", (1 - tokens) / limit.rate)
+                buckets.append((limit.key, tokens - 1, now))
+
+            token = uuid.uuid4().hex
+            connection.executemany(
+                "INSERT INTO slot (token, key, pid, acquired_at) VALUES (?, ?, ?, ?)",
+                [(token, limit.key, os.getpid(), now) for limit in limits if limit.concurrency],
+            )
+            connection.executemany("INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)", buckets)
+            connection.execute("COMMIT")
+            return Admission(token)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def release(self, token: str):
+        self._connection().execute("DELETE FROM slot WHERE token = ?", (token,))
+
+
+def classify(scope) -> str | None:
+    """Returns the admission class of the route the request is for, if it has one."""
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    for method, pattern, kind in ROUTE_PATTERNS:
+        if scope["method"] == method and pattern.match(path):
+            return kind
+    return None
+
+
+def _identity(headers: dict, scope) -> tuple[str, str | None]:
+    """Returns the key limits are tracked by and the user's email if the request carries a token."""
+    scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        email = decode_access_token(token, None)
+        if email:
+            return f"user:{email}", email
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}", None
+
+
+def _limits(kind: str, identity: str) -> list[Limit]:
+    settings = AdmissionConfig.LIMITS[kind]
+    return [
+        Limit(
+            f"{kind}:{identity}",
+            settings["user_concurrency"],
+            settings["user_rate"],
+            settings["user_burst"],
+        ),
+        Limit(
+            f"{kind}:global",
+            settings["global_concurrency"],
+            settings["global_rate"],
+            settings["global_burst"],
+        ),
+    ]
+
+
+def _storage_used(email: str) -> int:
+    # size of the current version of every file, trashed ones included
+    with Session(engine) as db:
+        # user_id from a subquery rather than a join, so the partition is picked at execution time
+        return db.execute(
+            select(func.coalesce(func.sum(FileMetadata.file_size), 0)).where(
+                FileMetadata.user_id == select(User.uid).where(User.email == email).scalar_subquery()
+            )
+        ).scalar()
+
+
+class AdmissionControlMiddleware:
+    """
+    Plain ASGI middleware enforcing the admission limits before the endpoint runs,
+    so rejected uploads are answered without their body being read.
+    """
+
+    def __init__(self, app, store: StateStore | None = None):
+        self.app = app
+        self.store = store
+        if store is None and AdmissionConfig.ENABLED:
+            self.store = StateStore(AdmissionConfig.STATE_PATH)
+
+    async def reject(self, scope, receive, send, kind, reason, status_code, detail, headers=None):
+        ADMISSION_REJECTED.labels(kind, reason).inc()
+        response = JSONResponse({"detail": detail}, status_code=status_code, headers=headers)
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.store is None:
+            await self.app(scope, receive, send)
+            return
+        kind = classify(scope)
+        if kind is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        identity, email = _identity(headers, scope)
+        if kind == UPLOAD:
+            length = headers.get(b"content-length")
+            if length is None:
+                await self.reject(scope, receive, send, kind, "length_required", 411, "Content-Length required")
+                return
+            if not length.isdigit():
+                # malformed or negative
+                await self.reject(scope, receive, send, kind, "bad_length", 400, "Invalid Content-Length")
+                return
+            length = int(length)
+            if length > AdmissionConfig.MAX_UPLOAD_BYTES:
+                await self.reject(
+                    scope, receive, send, kind, "size", 413,
+                    f"Upload exceeds the limit of {AdmissionConfig.MAX_UPLOAD_BYTES} bytes",
+                )
+                return
+            if AdmissionConfig.USER_QUOTA_BYTES and email:
+                used = await run_in_threadpool(_storage_used, email)
+                if used + length > AdmissionConfig.USER_QUOTA_BYTES:
+                    await self.reject(scope, receive, send, kind, "quota", 413, "Storage quota exceeded")
+                    return
+
+        admission = await run_in_threadpool(self.store.acquire, _limits(kind, identity))
+        if admission.token is None:
+            await self.reject(
+                scope, receive, send, kind, admission.reason, 429, "Too many requests, retry later",
+                {"Retry-After": str(max(1, math.ceil(admission.retry_after)))},
+            )
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.store.release, admission.token)
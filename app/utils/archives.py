@@ -0,0 +1,157 @@
+"""
+Extraction of uploaded zip archives into folders.
+
+The central directory is checked against ExtractConfig before anything is
+written: entry count, total uncompressed size, compression ratios (zip bombs)
+and entry paths (no absolute paths, no "..", no symlinks). Entries are then
+streamed one by one into staged blobs, missing folders are created with one
+INSERT and the files are committed like a regular upload.
+"""
+import mimetypes
+import stat
+import zipfile
+from typing import BinaryIO
+
+from sqlalchemy.orm import Session
+
+from config import ExtractConfig
+
+from .folders import ensure_folders, split_relative_path
+from .jobs import Progress
+from .storage import blob_directory, discard, should_compress, stage_file
+from .uploads import commit_uploads
+
+# kind of the job extracting an archive
+EXTRACT_ARCHIVE = "extract_archive"
+
+# entries smaller than this are not checked for their compression ratio, tiny files compress very well
+RATIO_MIN_SIZE = 1024 * 1024
+# metadata directories added by archivers, not part of the content
+SKIPPED_FOLDERS = {"__MACOSX"}
+DEFAULT_TYPE = "application/octet-stream"
+
+
+class ArchiveError(ValueError):
+    """The upload is not a zip archive or contains entries that cannot be extracted."""
+
+
+class ArchiveLimitError(ArchiveError):
+    """The archive exceeds one of the ExtractConfig limits."""
+
+
+def _content_type(file_name: str) -> str:
+    content_type = mimetypes.guess_type(file_name)[0] or DEFAULT_TYPE
+    # file_type is a 50 character column
+    return content_type if len(content_type) <= 50 else DEFAULT_TYPE
+
+
+def inspect_archive(fileobj: BinaryIO, archive_size: int) -> tuple[list, set, int]:
+    """
+    Validates an archive from its central directory, without decompressing anything.
+
+    Args:
+        fileobj (BinaryIO): The seekable archive.
+        archive_size (int): Size of the archive in bytes.
+
+    Returns:
+        tuple[list, set, int]: The (ZipInfo, path) of every file entry, the folder paths
+        and the total uncompressed size.
+
+    Raises:
+        ArchiveError: If the file is not a zip archive, or an entry path is invalid or a symlink.
+        ArchiveLimitError: If the archive exceeds a limit.
+    """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ArchiveError("Not a zip archive")
+    infos = archive.infolist()
+    if len(infos) > ExtractConfig.MAX_ENTRIES:
+        raise ArchiveLimitError(f"Archive has more than {ExtractConfig.MAX_ENTRIES} entries")
+
+    entries = []
+    folders = set()
+    total_size = 0
+    for info in infos:
+        try:
+            path = split_relative_path(info.filename)
+        except ValueError as exc:
+            raise ArchiveError(str(exc))
+        if path[0] in SKIPPED_FOLDERS:
+            continue
+        if info.is_dir():
+            folders.add(path)
+            continue
+        if stat.S_ISLNK(info.external_attr >> 16):
+            raise ArchiveError(f"Symbolic link entry: {info.filename!r}")
+        if info.flag_bits & 0x1:
+            raise ArchiveError(f"Encrypted entry: {info.filename!r}")
+        if info.file_size > RATIO_MIN_SIZE and info.file_size > info.compress_size * ExtractConfig.MAX_RATIO:
+            raise ArchiveLimitError(f"Compression ratio of {info.filename!r} exceeds {ExtractConfig.MAX_RATIO:g}")
+        total_size += info.file_size
+        entries.append((info, path))
+        folders.add(path[:-1])
+
+    if total_size > ExtractConfig.MAX_BYTES:
+        raise ArchiveLimitError(f"Archive expands to more than {ExtractConfig.MAX_BYTES} bytes")
+    if total_size > RATIO_MIN_SIZE and total_size > archive_size * ExtractConfig.MAX_RATIO:
+        raise ArchiveLimitError(f"Compression ratio of the archive exceeds {ExtractConfig.MAX_RATIO:g}")
+    folders.discard(())
+    return entries, folders, total_size
+
+
+def extract_archive(
+    db: Session,
+    user_id,
+    folder_id,
+    fileobj: BinaryIO,
+    archive_size: int,
+    progress: Progress | None = None,
+) -> dict:
+    """
+    Extracts an archive into a folder, creating its folders and files.
+
+    Either the whole archive is extracted or, on any error, nothing is.
+
+    Args:
+        db (Session): The database session, committed at the end.
+        user_id (UUID): Owner of the folder.
+        folder_id (UUID): The folder the archive is extracted into.
+        fileobj (BinaryIO): The seekable archive.
+        archive_size (int): Size of the archive in bytes.
+        progress (Progress | None): Advanced by one for every extracted file.
+
+    Returns:
+        dict: The number of extracted files and folders.
+    """
+    entries, folders, _ = inspect_archive(fileobj, archive_size)
+    if progress:
+        progress.total = len(entries)
+    archive = zipfile.ZipFile(fileobj)
+    folder_ids = ensure_folders(db, user_id, folder_id, folders)
+
+    staged_files = []
+    try:
+        for info, path in entries:
+            entry_folder = folder_ids[path[:-1]]
+            content_type = _content_type(path[-1])
+            # ZipExtFile stops at the declared size and checks the CRC, so entries cannot expand further
+            with archive.open(info) as entry:
+                staged = stage_file(
+                    entry,
+                    blob_directory(user_id, entry_folder, path[-1]),
+                    should_compress(content_type, path[-1]),
+                )
+            staged_files.append((entry_folder, path[-1], content_type, staged))
+            if progress:
+                progress.advance()
+    except BaseException as exc:
+        db.rollback()
+        for _, _, _, staged in staged_files:
+            discard(staged)
+        if isinstance(exc, zipfile.BadZipFile):
+            raise ArchiveError(str(exc)) from exc
+        raise
+
+    files = commit_uploads(db, user_id, staged_files)
+    return {"files": len(files), "folders": len(folders)}
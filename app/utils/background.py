@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import engine
+
+logger = logging.getLogger("background")
+
+
+async def run_periodically(name: str, interval: float, job: Callable[[], object]):
+    """
+    Runs a blocking job in the threadpool every `interval` seconds until cancelled.
+
+    Failures are logged and retried on the next run, they never stop the loop.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(job)
+        except Exception:
+            logger.exception("background job %s failed", name)
+
+
+@contextmanager
+def exclusive_session(lock_key: int) -> Iterator[Session | None]:
+    """
+    Yields a session while holding a session-level pg advisory lock, so a job
+    scheduled in every worker only runs in one of them at a time.
+
+    Yields None without waiting when another worker holds the lock. The lock
+    outlives the commits of the session and is released on exit.
+    """
+    with engine.connect() as connection:
+        acquired = connection.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": lock_key}
+        ).scalar()
+        connection.commit()
+        if not acquired:
+            yield None
+            return
+        try:
+            with Session(bind=connection) as db:
+                yield db
+        finally:
+            connection.rollback()
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": lock_key})
+            connection.commit()
@@ -0,0 +1,129 @@
+"""
+In-memory cache of the content of small, frequently downloaded files.
+
+Entries are keyed by file id and stamped with the version, updated_at and
+storage location of the row they were read for, so an overwrite, restore,
+rename, move or blob move in any worker turns them into misses; the handlers
+changing a file in this worker also drop its entry right away. A file is only
+admitted on its second download within the doorkeeper window, one-off
+downloads do not push hot files out. Eviction is least recently used within
+CacheConfig.BYTES.
+"""
+import mimetypes
+import threading
+from collections import OrderedDict
+
+from fastapi import Request, status
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from config import CacheConfig, DownloadConfig
+
+from .metrics import BLOB_CACHE_BYTES, BLOB_CACHE_EVICTIONS, BLOB_CACHE_REQUESTS
+from .sendfile import content_disposition, parse_range
+from .storage import iter_blob
+
+# file ids downloaded once recently, bounded so it stays small next to the cache
+DOORKEEPER_SIZE = 4096
+
+
+def _stamp(file) -> tuple:
+    return (file.version, file.updated_at, file.storage_location)
+
+
+class BlobCache:
+    """Byte-budgeted LRU of file contents, shared by the threads of one worker."""
+
+    def __init__(self, budget: int, max_object_size: int):
+        self.budget = budget
+        self.max_object_size = max_object_size
+        self.size = 0
+        self.entries: OrderedDict = OrderedDict()
+        self.seen: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cacheable(self, file) -> bool:
+        return 0 < file.file_size <= self.max_object_size <= self.budget
+
+    def get(self, file) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(file.file_id)
+            if entry is None:
+                return None
+            stamp, content = entry
+            if stamp != _stamp(file):
+                self._drop(file.file_id)
+                return None
+            self.entries.move_to_end(file.file_id)
+            return content
+
+    def admit(self, file) -> bool:
+        """Records a miss, True when the file was already missed recently and should be cached."""
+        with self.lock:
+            if file.file_id in self.seen:
+                del self.seen[file.file_id]
+                return True
+            self.seen[file.file_id] = None
+            if len(self.seen) > DOORKEEPER_SIZE:
+                self.seen.popitem(last=False)
+            return False
+
+    def put(self, file, content: bytes):
+        with self.lock:
+            self._drop(file.file_id)
+            self.entries[file.file_id] = (_stamp(file), content)
+            self.size += len(content)
+            BLOB_CACHE_BYTES.inc(len(content))
+            while self.size > self.budget:
+                file_id, _ = next(iter(self.entries.items()))
+                self._drop(file_id)
+                BLOB_CACHE_EVICTIONS.inc()
+
+    def invalidate(self, file_id):
+        with self.lock:
+            self._drop(file_id)
+            self.seen.pop(file_id, None)
+
+    def _drop(self, file_id):
+        entry = self.entries.pop(file_id, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+            BLOB_CACHE_BYTES.dec(len(entry[1]))
+
+
+blob_cache = BlobCache(CacheConfig.BYTES, CacheConfig.MAX_OBJECT_BYTES)
+
+
+def _read(file) -> bytes:
+    return b"".join(iter_blob(file.storage_location, file.compression))
+
+
+async def cached_file_response(request: Request, file) -> Response | None:
+    """
+    Serves a small file from the cache, reading it into the cache on its second miss.
+
+    Returns None for files the cache does not handle: too large, offloaded to the
+    web server, or not admitted yet; they are served from disk as before.
+    """
+    if not blob_cache.cacheable(file) or (DownloadConfig.OFFLOAD_MODE and not file.compression):
+        return None
+    content = blob_cache.get(file)
+    if content is None:
+        BLOB_CACHE_REQUESTS.labels("miss").inc()
+        if not blob_cache.admit(file):
+            return None
+        content = await run_in_threadpool(_read, file)
+        blob_cache.put(file, content)
+    else:
+        BLOB_CACHE_REQUESTS.labels("hit").inc()
+
+    headers = {"Content-Disposition": content_disposition(file.file_name), "Accept-Ranges": "bytes"}
+    status_code = status.HTTP_200_OK
+    byte_range = parse_range(request.headers.get("range"), len(content))
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(content)}"
+        content = content[start:end]
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+    media_type = mimetypes.guess_type(file.file_name)[0] or "application/octet-stream"
+    return Response(content, status_code=status_code, media_type=media_type, headers=headers)
@@ -0,0 +1,80 @@
+"""
+Content-defined chunking (FastCDC) for the version chunk store.
+
+Chunk boundaries are picked by a rolling hash over the content instead of at
+fixed offsets, so an edit only changes the chunks around it and the rest of a
+new version deduplicates against the chunks of older ones. The C chunker of the
+`fastcdc` package is used when it is installed, otherwise a much slower port in
+pure python. The two use different gear tables, so chunks only deduplicate
+between blobs cut by the same implementation.
+"""
+import hashlib
+from typing import Iterable, Iterator
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # the pure python chunker is used instead
+    fastcdc_cy = None
+
+MIN_SIZE = 128 * 1024
+AVG_SIZE = 512 * 1024
+MAX_SIZE = 2 * 1024 * 1024
+# data handed to the chunker at once, the cut after the last boundary is carried over
+BUFFER_SIZE = 8 * MAX_SIZE
+
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(256)]
+_BITS = AVG_SIZE.bit_length() - 1
+MASK_S = (1 << (_BITS + 1)) - 1
+MASK_L = (1 << (_BITS - 1)) - 1
+CENTER_SIZE = AVG_SIZE - min(MIN_SIZE + (MIN_SIZE + 1) // 2, AVG_SIZE)
+
+
+def _cut_point(data: bytes, start: int) -> int:
+    # normalized chunking: a stricter mask below the average size, a looser one above
+    size = min(len(data) - start, MAX_SIZE)
+    pattern = 0
+    i = min(MIN_SIZE, size)
+    for barrier, mask in ((min(CENTER_SIZE, size), MASK_S), (size, MASK_L)):
+        while i < barrier:
+            pattern = ((pattern >> 1) + GEAR[data[start + i]]) & 0xFFFFFFFF
+            if not pattern & mask:
+                return i + 1
+            i += 1
+    return i
+
+
+def _lengths(data: bytes) -> Iterator[int]:
+    if fastcdc_cy is not None:
+        for chunk in fastcdc_cy(data, MIN_SIZE, AVG_SIZE, MAX_SIZE):
+            yield chunk.length
+        return
+    offset = 0
+    while offset < len(data):
+        length = _cut_point(data, offset)
+        yield length
+        offset += length
+
+
+def chunk_stream(blocks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Re-cuts a stream of arbitrarily sized blocks into content-defined chunks.
+    """
+    pending = bytearray()
+    for block in blocks:
+        pending += block
+        if len(pending) < BUFFER_SIZE:
+            continue
+        data = bytes(pending)
+        offset = 0
+        for length in _lengths(data):
+            if offset + length == len(data):
+                # the last cut is where the buffer ends, not necessarily a boundary
+                break
+            yield data[offset : offset + length]
+            offset += length
+        del pending[:offset]
+    data = bytes(pending)
+    offset = 0
+    for length in _lengths(data):
+        yield data[offset : offset + length]
+        offset += length
@@ -0,0 +1,115 @@
+"""
+Seekable zstd container used for compression at rest.
+
+Data is compressed in independent frames of FRAME_SIZE uncompressed bytes and
+a seek table is appended as a skippable frame, following the zstd seekable
+format. Any zstd decoder can read the file as a normal stream (skippable
+frames are ignored), while range reads only decompress the frames they touch.
+"""
+import bisect
+import os
+import struct
+
+try:
+    import zstandard
+except ImportError:  # compression at rest is optional
+    zstandard = None
+
+ZSTD = "zstd"
+FRAME_SIZE = 1024 * 1024
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER_SIZE = 9
+ENTRY_SIZE = 8
+
+
+def available() -> bool:
+    return zstandard is not None
+
+
+class SeekableWriter:
+    """Compresses everything written to it into `fileobj` as independent frames."""
+
+    def __init__(self, fileobj, level: int = 3, frame_size: int = FRAME_SIZE):
+        self.fileobj = fileobj
+        self.frame_size = frame_size
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.buffer = bytearray()
+        self.frames: list[tuple[int, int]] = []
+        self.size = 0
+        self.stored_size = 0
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.frame_size:
+            self._flush_frame(bytes(self.buffer[: self.frame_size]))
+            del self.buffer[: self.frame_size]
+
+    def _flush_frame(self, frame: bytes):
+        compressed = self.compressor.compress(frame)
+        self.fileobj.write(compressed)
+        self.frames.append((len(compressed), len(frame)))
+        self.stored_size += len(compressed)
+
+    def close(self):
+        if self.buffer or not self.frames:
+            self._flush_frame(bytes(self.buffer))
+            self.buffer.clear()
+        table = b"".join(struct.pack("<II", compressed, size) for compressed, size in self.frames)
+        table += struct.pack("<IBI", len(self.frames), 0, SEEKABLE_MAGIC)
+        seek_table = struct.pack("<II", SKIPPABLE_MAGIC, len(table)) + table
+        self.fileobj.write(seek_table)
+        self.stored_size += len(seek_table)
+
+
+class SeekableReader:
+    """Reads uncompressed byte ranges from a file written by SeekableWriter."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            f.seek(-FOOTER_SIZE, os.SEEK_END)
+            frame_count, descriptor, magic = struct.unpack("<IBI", f.read(FOOTER_SIZE))
+            if magic != SEEKABLE_MAGIC:
+                raise ValueError(f"{path} has no zstd seek table")
+            entry_size = ENTRY_SIZE + (4 if descriptor & 0x80 else 0)
+            f.seek(-(FOOTER_SIZE + frame_count * entry_size), os.SEEK_END)
+            table = f.read(frame_count * entry_size)
+
+        # cumulative offsets of every frame, compressed and uncompressed
+        self.compressed_offsets = [0]
+        self.offsets = [0]
+        for index in range(frame_count):
+            compressed, size = struct.unpack_from("<II", table, index * entry_size)
+            self.compressed_offsets.append(self.compressed_offsets[-1] + compressed)
+            self.offsets.append(self.offsets[-1] + size)
+        self.size = self.offsets[-1]
+
+    def iter_range(self, start: int = 0, end: int | None = None):
+        """
+        Yields the uncompressed bytes in [start, end), one frame at a time.
+        """
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        decompressor = zstandard.ZstdDecompressor()
+        frame = bisect.bisect_right(self.offsets, start) - 1
+        with open(self.path, "rb") as f:
+            f.seek(self.compressed_offsets[frame])
+            while frame < len(self.offsets) - 1 and self.offsets[frame] < end:
+                compressed = f.read(self.compressed_offsets[frame + 1] - self.compressed_offsets[frame])
+                data = decompressor.decompress(compressed)
+                frame_start = self.offsets[frame]
+                yield data[max(start - frame_start, 0) : end - frame_start]
+                frame += 1
+
+
+def compress(data: bytes, level: int = 3) -> bytes:
+    """Compresses `data` as a single frame, used for small blobs like version chunks."""
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
@@ -0,0 +1,236 @@
+"""
+Server-side copies of files and folder subtrees.
+
+Blobs are duplicated with clone_blob (reflink, hard link or in-kernel copy) and
+the metadata of a whole subtree is inserted with one statement per table, so a
+copy never moves file content through the application.
+"""
+import os
+import re
+import uuid
+from datetime import datetime
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from models.postgres_models import MEDIA_ATTRIBUTES, FileMetadata, Folder
+
+from .jobs import Progress
+from .storage import VOLUMES, clone_blob, folder_path, volume_of
+
+# kind of the job copying a folder subtree
+COPY_FOLDER = "copy_folder"
+
+COPY_SUFFIX = re.compile(r" \(copy(?: (\d+))?\)$")
+
+FILE_COLUMNS = (
+    FileMetadata.file_id,
+    FileMetadata.folder_id,
+    FileMetadata.file_name,
+    FileMetadata.file_size,
+    FileMetadata.file_type,
+    FileMetadata.storage_location,
+    FileMetadata.compression,
+    FileMetadata.stored_size,
+    *(getattr(FileMetadata, attribute) for attribute in MEDIA_ATTRIBUTES),
+)
+
+
+def copy_name(name: str, taken: set[str]) -> str:
+    """
+    Returns `name`, or "name (copy).ext", "name (copy 2).ext", ... if it is taken.
+    """
+    if name not in taken:
+        return name
+    stem, extension = os.path.splitext(name)
+    stem = COPY_SUFFIX.sub("", stem)
+    candidate = f"{stem} (copy){extension}"
+    number = 2
+    while candidate in taken:
+        candidate = f"{stem} (copy {number}){extension}"
+        number += 1
+    return candidate
+
+
+def _subtree(user_id, folder_id):
+    tree = (
+        select(Folder.folder_id, Folder.parent_folder, Folder.folder_name, Folder.user_id)
+        .where(Folder.folder_id == folder_id, Folder.user_id == user_id, Folder.is_trashed == False)
+        .cte("tree", recursive=True)
+    )
+    tree = tree.union_all(
+        select(Folder.folder_id, Folder.parent_folder, Folder.folder_name, Folder.user_id).where(
+            Folder.parent_folder == tree.c.folder_id,
+            # a constant rather than tree.c.user_id, so only the user's partition is scanned
+            Folder.user_id == user_id,
+            Folder.is_trashed == False,
+        )
+    )
+    return tree
+
+
+def subtree_size(db: Session, user_id, folder_id) -> tuple[int, int]:
+    """Returns the number and total size of the non-trashed files in a folder subtree."""
+    tree = _subtree(user_id, folder_id)
+    files, size = db.execute(
+        select(func.count(), func.coalesce(func.sum(FileMetadata.file_size), 0)).where(
+            FileMetadata.folder_id.in_(select(tree.c.folder_id)),
+            FileMetadata.user_id == user_id,
+            FileMetadata.is_trashed == False,
+        )
+    ).one()
+    return files, size
+
+
+def subtree(db: Session, user_id, folder_id) -> tuple[list, list]:
+    """
+    Loads the non-trashed folders below and including `folder_id` and their files.
+
+    Returns:
+        tuple[list, list]: Folder rows (folder_id, parent_folder, folder_name) and
+        file rows with the columns in FILE_COLUMNS.
+    """
+    tree = _subtree(user_id, folder_id)
+    folders = db.execute(select(tree.c.folder_id, tree.c.parent_folder, tree.c.folder_name)).all()
+    files = db.execute(
+        select(*FILE_COLUMNS).where(
+            FileMetadata.folder_id.in_(select(tree.c.folder_id)),
+            FileMetadata.user_id == user_id,
+            FileMetadata.is_trashed == False,
+        )
+    ).all()
+    return folders, files
+
+
+def _file_row(source, user_id, folder_id, file_name: str, storage_location: str, now: datetime) -> dict:
+    return {
+        "file_id": uuid.uuid4(),
+        "folder_id": folder_id,
+        "user_id": user_id,
+        "file_name": file_name,
+        "file_size": source.file_size,
+        "file_type": source.file_type,
+        "storage_location": storage_location,
+        "compression": source.compression,
+        "stored_size": source.stored_size,
+        "version": 1,
+        "uploaded_at": now,
+        "updated_at": now,
+        "is_trashed": False,
+        # the content is the same, so are its media attributes
+        **{attribute: getattr(source, attribute) for attribute in MEDIA_ATTRIBUTES},
+    }
+
+
+def _remove(paths: list[str], directories: list[str] = ()):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    for directory in directories:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+
+def duplicate_file(db: Session, file: FileMetadata, folder_id, file_name: str) -> dict:
+    """
+    Copies a file into a folder, the new row is committed.
+
+    Versions are not copied, the copy starts at version 1.
+
+    Returns:
+        dict: The new file's id, name, type and timestamp.
+    """
+    # on the volume of the source, where reflinks and hard links work; the name on
+    # disk is the source's with a fresh prefix, file_name only goes into the row
+    directory = folder_path(file.user_id, folder_id, volume_of(file.storage_location))
+    destination = os.path.join(directory, f"{uuid.uuid4()}-{os.path.basename(file.storage_location)}")
+    clone_blob(file.storage_location, destination)
+    try:
+        row = db.execute(
+            insert(FileMetadata).returning(
+                FileMetadata.file_id, FileMetadata.file_name, FileMetadata.file_type, FileMetadata.updated_at
+            ),
+            [_file_row(file, file.user_id, folder_id, file_name, destination, datetime.now())],
+        ).one()
+        db.commit()
+    except BaseException:
+        db.rollback()
+        _remove([destination])
+        raise
+    return row._asdict()
+
+
+def duplicate_folder(
+    db: Session,
+    user_id,
+    folder_id,
+    parent_folder,
+    folder_name: str,
+    progress: Progress | None = None,
+) -> uuid.UUID:
+    """
+    Copies a folder and all its non-trashed subfolders and files below `parent_folder`.
+
+    Blobs are cloned first, then all rows are inserted and committed in one
+    transaction; on failure the cloned blobs are removed again.
+
+    Args:
+        db (Session): The database session.
+        user_id (UUID): Owner of the source and destination.
+        folder_id (UUID): The folder to copy.
+        parent_folder (UUID): The folder the copy is created in.
+        folder_name (str): Name of the copy.
+        progress (Progress | None): Advanced by one for every copied file.
+
+    Returns:
+        UUID: The id of the new folder.
+    """
+    folders, files = subtree(db, user_id, folder_id)
+    if not folders:
+        raise LookupError("Folder not found or trashed")
+    if progress:
+        progress.total = len(files)
+
+    now = datetime.now()
+    new_ids = {row.folder_id: uuid.uuid4() for row in folders}
+    folder_rows = [
+        {
+            "folder_id": new_ids[row.folder_id],
+            "user_id": user_id,
+            "folder_name": folder_name if row.folder_id == folder_id else row.folder_name,
+            "parent_folder": parent_folder if row.folder_id == folder_id else new_ids[row.parent_folder],
+            "created_at": now,
+            "updated_at": now,
+            "is_trashed": False,
+        }
+        for row in folders
+    ]
+
+    file_rows = []
+    created = []
+    used = set()
+    directories = [folder_path(user_id, new_id, volume) for new_id in new_ids.values() for volume in VOLUMES]
+    try:
+        for row in files:
+            directory = folder_path(user_id, new_ids[row.folder_id], volume_of(row.storage_location))
+            destination = os.path.join(directory, os.path.basename(row.storage_location))
+            if destination in used:
+                # moved files keep their blob in the directory they were uploaded to
+                destination = os.path.join(directory, f"{uuid.uuid4()}-{row.file_name}")
+            used.add(destination)
+            clone_blob(row.storage_location, destination)
+            created.append(destination)
+            file_rows.append(_file_row(row, user_id, new_ids[row.folder_id], row.file_name, destination, now))
+            if progress:
+                progress.advance()
+        db.execute(insert(Folder), folder_rows)
+        if file_rows:
+            db.execute(insert(FileMetadata), file_rows)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        _remove(created, directories)
+        raise
+    return new_ids[folder_id]
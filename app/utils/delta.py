@@ -0,0 +1,155 @@
+"""
+Block-level delta uploads, rsync style.
+
+A client holding a modified copy of a stored file fetches the signatures of
+the stored content: per block of block_size bytes an Adler-32 checksum, which
+it can roll over its copy one byte at a time, and a BLAKE2b-128 hash to confirm
+a match. It then uploads only the bytes that match no block, along with a
+recipe listing in order the runs of stored blocks to copy and the lengths of
+uploaded data to take. The new content is streamed from the old blob and the
+upload into a staged blob and checked against the SHA-256 the client sent
+before it becomes the file's new version.
+"""
+import hashlib
+import zlib
+from typing import BinaryIO, Iterator
+
+from models.schemas import DeltaRecipe
+
+from . import compression
+from .metrics import DELTA_UPLOAD_BYTES
+from .storage import CHUNK_SIZE, StagedBlob, discard, iter_blob, stage_chunks
+
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+STRONG_DIGEST_SIZE = 16
+
+COPIED = "copied"
+UPLOADED = "uploaded"
+
+
+class DeltaError(ValueError):
+    """Raised when a recipe does not fit the stored content or the uploaded data."""
+
+
+def _blocks(path: str, blob_compression: str | None, block_size: int) -> Iterator[bytes]:
+    pending = b""
+    for chunk in iter_blob(path, blob_compression):
+        if pending:
+            chunk = pending + chunk
+        view = memoryview(chunk)
+        offset = 0
+        while len(chunk) - offset >= block_size:
+            yield view[offset:offset + block_size]
+            offset += block_size
+        pending = chunk[offset:]
+    if pending:
+        yield pending
+
+
+def block_signatures(path: str, blob_compression: str | None, block_size: int) -> list[dict]:
+    """
+    Computes the weak and strong checksum of every block of a stored blob.
+
+    Returns:
+        list[dict]: weak (Adler-32) and strong (BLAKE2b-128, hex) of each block, in order.
+    """
+    return [
+        {
+            "weak": zlib.adler32(block),
+            "strong": hashlib.blake2b(block, digest_size=STRONG_DIGEST_SIZE).hexdigest(),
+        }
+        for block in _blocks(path, blob_compression, block_size)
+    ]
+
+
+def _read_exactly(data: BinaryIO, length: int) -> Iterator[bytes]:
+    while length > 0:
+        chunk = data.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            raise DeltaError("The uploaded data is shorter than the recipe")
+        length -= len(chunk)
+        yield chunk
+
+
+def _content(
+    path: str, blob_compression: str | None, file_size: int, recipe: DeltaRecipe, data: BinaryIO, totals: dict
+) -> Iterator[bytes]:
+    block_count = -(-file_size // recipe.block_size)
+    # the seek table of a compressed blob is read once, not for every copied run
+    read_range = (
+        compression.SeekableReader(path).iter_range
+        if blob_compression == compression.ZSTD
+        else lambda start, end: iter_blob(path, None, start, end)
+    )
+    for instruction in recipe.instructions:
+        if (instruction.block is None) == (instruction.data is None):
+            raise DeltaError("Every instruction needs either block or data")
+        if instruction.data is not None:
+            source, chunks = UPLOADED, _read_exactly(data, instruction.data)
+        else:
+            if instruction.block + instruction.count > block_count:
+                raise DeltaError(f"Block {instruction.block + instruction.count - 1} does not exist")
+            start = instruction.block * recipe.block_size
+            end = min(start + instruction.count * recipe.block_size, file_size)
+            source, chunks = COPIED, read_range(start, end)
+        for chunk in chunks:
+            totals[source] += len(chunk)
+            if totals[COPIED] + totals[UPLOADED] > recipe.file_size:
+                raise DeltaError("The recipe produces more than file_size bytes")
+            totals["digest"].update(chunk)
+            yield chunk
+    if data.read(1):
+        raise DeltaError("The uploaded data is longer than the recipe")
+
+
+def _stage(path, blob_compression, file_size, recipe, data, directory, compress=False) -> tuple[StagedBlob, dict]:
+    totals = {COPIED: 0, UPLOADED: 0, "digest": hashlib.sha256()}
+    staged = stage_chunks(_content(path, blob_compression, file_size, recipe, data, totals), directory, compress)
+    return staged, totals
+
+
+def apply_delta(
+    path: str,
+    blob_compression: str | None,
+    file_size: int,
+    recipe: DeltaRecipe,
+    data: BinaryIO,
+    directory: str,
+    compress: bool = False,
+) -> StagedBlob:
+    """
+    Builds the new content of a file from its stored blob and the uploaded data.
+
+    Args:
+        path (str): The stored blob, which must not change meanwhile (the row is locked).
+        blob_compression (str | None): Compression of the stored blob.
+        file_size (int): Uncompressed size of the stored blob.
+        recipe (DeltaRecipe): The copy and data instructions.
+        data (BinaryIO): The uploaded data, read from its current position.
+        directory (str): Directory the new blob will be committed to.
+        compress (bool): Whether to store the new content zstd compressed.
+
+    Returns:
+        StagedBlob: The staged new content, to be committed or discarded.
+
+    Raises:
+        DeltaError: If the recipe or the data do not fit, or the result does not match its size or checksum.
+    """
+    if not MIN_BLOCK_SIZE <= recipe.block_size <= MAX_BLOCK_SIZE:
+        raise DeltaError(f"block_size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE}")
+    start = data.tell()
+    staged, totals = _stage(path, blob_compression, file_size, recipe, data, directory, compress)
+    if staged.compression and staged.stored_size >= staged.size:
+        discard(staged)
+        data.seek(start)
+        staged, totals = _stage(path, blob_compression, file_size, recipe, data, directory)
+    if staged.size != recipe.file_size:
+        discard(staged)
+        raise DeltaError(f"The recipe produces {staged.size} bytes instead of {recipe.file_size}")
+    if totals["digest"].hexdigest() != recipe.sha256.lower():
+        discard(staged)
+        raise DeltaError("The rebuilt content does not match sha256")
+    DELTA_UPLOAD_BYTES.labels(COPIED).inc(totals[COPIED])
+    DELTA_UPLOAD_BYTES.labels(UPLOADED).inc(totals[UPLOADED])
+    return staged
@@ -5,6 +5,10 @@ from models.schemas import EmailSchema
 from fastapi_mail import FastMail, MessageSchema,ConnectionConfig,MessageType
 from config import GmailConfig
 
+from .metrics import EMAIL_SEND_SECONDS
+
+import time
+
 conf=ConnectionConfig(
     MAIL_USERNAME=GmailConfig.MAIL_USERNAME,
     MAIL_PASSWORD=GmailConfig.MAIL_PASSWORD,
@@ -20,6 +24,18 @@ conf=ConnectionConfig(
 )
 
 
+async def send_templated_message(message:MessageSchema,template_name:str):
+    fm=FastMail(conf)
+    start=time.perf_counter()
+    outcome="error"
+    try:
+        result=await fm.send_message(message,template_name=template_name)
+        outcome="sent"
+        return result
+    finally:
+        EMAIL_SEND_SECONDS.labels(template_name,outcome).observe(time.perf_counter()-start)
+
+
 async def send_confirmation_email(email:EmailSchema = Depends())->JSONResponse:
     try:
         template_body={
@@ -37,8 +53,7 @@ async def send_confirmation_email(email:EmailSchema = Depends())->JSONResponse:
             template_body=template_body,
             subtype=MessageType.html,        
         )
-        fm=FastMail(conf)
-        await fm.send_message(message,template_name="otp_verification_email.html")
+        await send_templated_message(message,"otp_verification_email.html")
         return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "email has been sent"})
 
     except Exception as e:
@@ -62,8 +77,7 @@ async def send_thank_you_email(email:EmailSchema = Depends())->JSONResponse:
             template_body=template_body,
             subtype=MessageType.html,        
         )
-        fm=FastMail(conf)
-        print(await fm.send_message(message,template_name="thank_you_email.html"))
+        print(await send_templated_message(message,"thank_you_email.html"))
         return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "email has been sent"})
 
     except Exception as e:
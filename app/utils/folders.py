@@ -0,0 +1,233 @@
+import hashlib
+import posixpath
+import uuid
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import BigInteger, String, cast, func, insert, literal, null, select, union_all
+from sqlalchemy.orm import Session
+
+from models.postgres_models import FileMetadata, Folder, User
+
+from .replicas import READ_ONLY
+
+
+def get_root_folder_id(db: Session, user: User):
+    """
+    Returns the id of the user's root folder.
+
+    Reads the user.root_folder_id pointer and only looks the folder up by name for
+    users whose pointer is not set yet, storing it for the next request unless the
+    session is on a read replica.
+    """
+    if user.root_folder_id is None:
+        root_folder = (
+            db.query(Folder)
+            .filter(
+                Folder.folder_name == "/",
+                Folder.parent_folder == None,
+                Folder.user_id == user.uid,
+            )
+            .first()
+        )
+        if not root_folder:
+            return None
+        if db.info.get(READ_ONLY):
+            return root_folder.folder_id
+        user.root_folder_id = root_folder.folder_id
+        db.commit()
+    return user.root_folder_id
+
+
+def _stamp(model, id_column, user_id):
+    # the count and the sum of id hashes change when rows are added, trashed, restored
+    # or deleted, max(updated_at) when one is renamed, moved or gets a new version
+    return (
+        select(
+            func.concat_ws(
+                ":",
+                func.count(),
+                func.coalesce(func.sum(cast(func.hashtext(cast(id_column, String)), BigInteger)), 0),
+                func.max(model.updated_at),
+            )
+        )
+        .where(model.user_id == user_id, model.is_trashed == False)
+        .scalar_subquery()
+    )
+
+
+def tree_version(db: Session, user_id, include_files: bool = False) -> str:
+    """
+    Returns a stamp that changes whenever the user's folder tree changes.
+
+    Aggregates over the user's rows without transferring them, so clients can
+    revalidate a cached tree with a single cheap query.
+    """
+    stamps = [_stamp(Folder, Folder.folder_id, user_id)]
+    if include_files:
+        stamps.append(_stamp(FileMetadata, FileMetadata.file_id, user_id))
+    row = db.execute(select(*stamps)).one()
+    return hashlib.md5("|".join(row).encode()).hexdigest()
+
+
+def folder_tree(db: Session, user_id, include_files: bool = False) -> dict:
+    """
+    Loads the user's non-trashed folders, and optionally files, with one query.
+
+    The tree is encoded as parallel arrays: every folder refers to its parent and
+    every file to its folder by index, -1 for folders without a visible parent.
+    Parents are listed before their children.
+    """
+    folders = select(
+        literal("d").label("kind"),
+        Folder.folder_id.label("id"),
+        Folder.parent_folder.label("parent"),
+        Folder.folder_name.label("name"),
+        cast(null(), BigInteger).label("size"),
+        cast(null(), String).label("type"),
+        Folder.updated_at,
+    ).where(Folder.user_id == user_id, Folder.is_trashed == False)
+    statement = folders
+    if include_files:
+        statement = union_all(
+            folders,
+            select(
+                literal("f"),
+                FileMetadata.file_id,
+                FileMetadata.folder_id,
+                FileMetadata.file_name,
+                cast(FileMetadata.file_size, BigInteger),
+                cast(FileMetadata.file_type, String),
+                FileMetadata.updated_at,
+            ).where(FileMetadata.user_id == user_id, FileMetadata.is_trashed == False),
+        )
+    rows = db.execute(statement).all()
+
+    folder_rows = {row.id: row for row in rows if row.kind == "d"}
+    children = {}
+    for row in folder_rows.values():
+        parent = row.parent if row.parent in folder_rows else None
+        children.setdefault(parent, []).append(row)
+
+    ordered = []
+    pending = deque([None])
+    while pending:
+        for row in sorted(children.get(pending.popleft(), []), key=lambda row: row.name):
+            ordered.append(row)
+            pending.append(row.id)
+    index = {row.id: position for position, row in enumerate(ordered)}
+
+    tree = {
+        "folders": {
+            "ids": [str(row.id) for row in ordered],
+            "names": [row.name for row in ordered],
+            "parents": [index.get(row.parent, -1) for row in ordered],
+            "updated_at": [row.updated_at.isoformat() for row in ordered],
+        }
+    }
+    if include_files:
+        files = [row for row in rows if row.kind == "f"]
+        tree["files"] = {
+            "ids": [str(row.id) for row in files],
+            "names": [row.name for row in files],
+            "folders": [index.get(row.parent, -1) for row in files],
+            "sizes": [row.size for row in files],
+            "types": [row.type for row in files],
+            "updated_at": [row.updated_at.isoformat() for row in files],
+        }
+    return tree
+
+
+def split_relative_path(path: str) -> tuple[str, ...]:
+    """
+    Splits a client supplied relative file path ("photos/2024/a.jpg") into its parts.
+
+    Raises:
+        ValueError: If the path is absolute, empty or leaves its root folder, or a part
+        is not a valid name (see check_name).
+    """
+    parts = tuple(part for part in path.replace("\\", "/").split("/") if part not in ("", "."))
+    if not parts or path.startswith("/") or ".." in parts:
+        raise ValueError(f"Invalid relative path: {path!r}")
+    for part in parts:
+        check_name(part)
+    return parts
+
+
+def check_name(name: str) -> str:
+    """
+    Validates a client supplied file or folder name.
+
+    Raises:
+        ValueError: If the name is empty, "." or "..", too long or contains a slash or NUL.
+    """
+    if name in ("", ".", "..") or any(character in name for character in "/\\\0"):
+        raise ValueError(f"Invalid name: {name!r}")
+    if len(name) > 255:
+        raise ValueError(f"Name too long: {name!r}")
+    return name
+
+
+def ensure_folders(db: Session, user_id, folder_id, paths: set[tuple[str, ...]]) -> dict[tuple[str, ...], uuid.UUID]:
+    """
+    Resolves relative folder paths below `folder_id`, creating the missing folders.
+
+    Existing folders are looked up with one query per depth level, the missing
+    ones are added with a single INSERT that is committed by the caller.
+
+    Args:
+        db (Session): The database session.
+        user_id (UUID): Owner of the folders.
+        folder_id (UUID): The folder the paths are relative to.
+        paths (set[tuple[str, ...]]): Folder paths as split by split_relative_path.
+
+    Returns:
+        dict[tuple[str, ...], UUID]: The folder id of every path and its ancestors, () for `folder_id`.
+    """
+    needed = {path[:depth] for path in paths for depth in range(1, len(path) + 1)}
+    levels = {}
+    for path in needed:
+        levels.setdefault(len(path), []).append(path)
+
+    ids = {(): folder_id}
+    created = set()
+    now = datetime.now()
+    new_folders = []
+    for depth in sorted(levels):
+        level = levels[depth]
+        # children of new folders are new as well, only existing parents are looked up
+        parents = {ids[path[:-1]] for path in level if path[:-1] not in created}
+        found = {}
+        if parents:
+            for existing_id, parent, name in db.execute(
+                select(Folder.folder_id, Folder.parent_folder, Folder.folder_name)
+                .where(
+                    Folder.parent_folder.in_(parents),
+                    Folder.user_id == user_id,
+                    Folder.is_trashed == False,
+                    Folder.folder_name.in_({path[-1] for path in level}),
+                )
+                .order_by(Folder.created_at)
+            ):
+                found.setdefault((parent, name), existing_id)
+        for path in level:
+            parent = ids[path[:-1]]
+            if (parent, path[-1]) in found:
+                ids[path] = found[parent, path[-1]]
+                continue
+            ids[path] = uuid.uuid4()
+            created.add(path)
+            new_folders.append(
+                {
+                    "folder_id": ids[path],
+                    "user_id": user_id,
+                    "folder_name": path[-1],
+                    "parent_folder": parent,
+                    "created_at": now,
+                    "updated_at": now,
+                    "is_trashed": False,
+                }
+            )
+    if new_folders:
+        db.execute(insert(Folder), new_folders)
+    return ids
@@ -1,9 +1,13 @@
 from passlib.context import CryptContext
 
+from .metrics import PASSWORD_HASH_SECONDS
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def get_password_hash(password: str):
-    return pwd_context.hash(password)
+    with PASSWORD_HASH_SECONDS.labels("hash").time():
+        return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+    with PASSWORD_HASH_SECONDS.labels("verify").time():
+        return pwd_context.verify(plain_password, hashed_password)
@@ -0,0 +1,258 @@
+"""
+Idempotency keys for mutating requests.
+
+A POST, PUT, PATCH or DELETE sent with an Idempotency-Key header by a signed-in
+user is run once: the first request claims the key in the idempotency_key
+table, and its response is stored there for IdempotencyConfig.TTL_SECONDS.
+Retries with the same key get that response replayed, marked with an
+Idempotent-Replayed header, without the endpoint running again; retries
+arriving while the first request is still running wait for it. Responses that
+do not reflect a finished request (5xx, 408, 425, 429) are not stored, so the
+key is freed and a retry runs the request again.
+
+The key is bound to the method, path and query string of its first request; it
+is not compared against the body, which for uploads is only streamed later.
+"""
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+from config import IdempotencyConfig
+from database import engine
+from models.postgres_models import IdempotencyKey
+
+from .background import exclusive_session
+from .jwttoken import decode_access_token
+from .metrics import IDEMPOTENT_REQUESTS
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = b"idempotent-replayed"
+MUTATING_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+MAX_KEY_LENGTH = 255
+# the request did not run to completion, a retry has to run it
+TRANSIENT_STATUS_CODES = {408, 425, 429}
+
+IDEMPOTENCY_PURGE_LOCK = 0x69646D70
+PURGE_BATCH_SIZE = 1000
+
+EXECUTED = "executed"
+REPLAYED = "replayed"
+WAITED = "waited"
+IN_PROGRESS = "in_progress"
+MISMATCH = "mismatch"
+
+
+def _owner(headers: dict) -> str | None:
+    scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return decode_access_token(token, None)
+    return None
+
+
+def _fingerprint(scope) -> str:
+    request = f"{scope['method']} {scope['path']}?{scope.get('query_string', b'').decode('latin-1')}"
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def claim_key(owner: str, key: str, fingerprint: str) -> tuple[bool, IdempotencyKey | None]:
+    """
+    Claims a key for a request that is about to run.
+
+    An expired key, or one whose request has been running for longer than the
+    lease, is taken over.
+
+    Returns:
+        tuple[bool, IdempotencyKey | None]: Whether the key was claimed, and otherwise
+        the record of the request holding it; None if that one was just released.
+    """
+    now = datetime.now()
+    statement = insert(IdempotencyKey).values(
+        owner=owner,
+        key=key,
+        fingerprint=fingerprint,
+        created_at=now,
+        expires_at=now + timedelta(seconds=IdempotencyConfig.TTL_SECONDS),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[IdempotencyKey.owner, IdempotencyKey.key],
+        set_={
+            "fingerprint": statement.excluded.fingerprint,
+            "status_code": None,
+            "response_headers": None,
+            "response_body": None,
+            "created_at": statement.excluded.created_at,
+            "expires_at": statement.excluded.expires_at,
+        },
+        where=or_(
+            IdempotencyKey.expires_at < now,
+            and_(
+                IdempotencyKey.status_code == None,
+                IdempotencyKey.created_at < now - timedelta(seconds=IdempotencyConfig.LEASE_SECONDS),
+            ),
+        ),
+    ).returning(IdempotencyKey.key)
+    with Session(engine) as db:
+        claimed = db.execute(statement).first() is not None
+        db.commit()
+        if claimed:
+            return True, None
+        return False, db.get(IdempotencyKey, (owner, key))
+
+
+def store_response(owner: str, key: str, status_code: int, headers: list, body: bytes):
+    with Session(engine) as db:
+        db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.owner == owner, IdempotencyKey.key == key)
+            .values(
+                status_code=status_code,
+                response_headers=[[name.decode("latin-1"), value.decode("latin-1")] for name, value in headers],
+                response_body=body,
+            )
+        )
+        db.commit()
+
+
+def release_key(owner: str, key: str):
+    with Session(engine) as db:
+        db.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.owner == owner, IdempotencyKey.key == key, IdempotencyKey.status_code == None
+            )
+        )
+        db.commit()
+
+
+def purge_expired_keys() -> int:
+    """Background job deleting expired idempotency keys in batches."""
+    purged = 0
+    with exclusive_session(IDEMPOTENCY_PURGE_LOCK) as db:
+        if db is None:
+            return purged
+        while True:
+            expired = (
+                select(IdempotencyKey.owner, IdempotencyKey.key)
+                .where(IdempotencyKey.expires_at < datetime.now())
+                .limit(PURGE_BATCH_SIZE)
+            )
+            deleted = db.execute(
+                delete(IdempotencyKey).where(tuple_(IdempotencyKey.owner, IdempotencyKey.key).in_(expired))
+            ).rowcount
+            db.commit()
+            purged += deleted
+            if deleted < PURGE_BATCH_SIZE:
+                return purged
+
+
+class IdempotencyMiddleware:
+    """
+    Plain ASGI middleware running each mutating request with an Idempotency-Key
+    once and replaying its response to retries.
+
+    Sits outside admission control, so replayed retries and retries waiting for
+    the first request take no concurrency slots or rate limit tokens.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        key = headers.get(IDEMPOTENCY_HEADER)
+        owner = _owner(headers) if key else None
+        if owner is None:
+            # no key, or a request the endpoint turns away as unauthenticated anyway
+            await self.app(scope, receive, send)
+            return
+        key = key.decode("latin-1")
+        if len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse(
+                {"detail": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"}, status_code=400
+            )
+            await response(scope, receive, send)
+            return
+
+        fingerprint = _fingerprint(scope)
+        deadline = time.monotonic() + IdempotencyConfig.WAIT_SECONDS
+        delay = 0.05
+        waited = False
+        while True:
+            claimed, record = await run_in_threadpool(claim_key, owner, key, fingerprint)
+            if claimed:
+                break
+            if record is None:
+                # released by a failed first request between the two statements
+                continue
+            if record.fingerprint != fingerprint:
+                IDEMPOTENT_REQUESTS.labels(MISMATCH).inc()
+                response = JSONResponse(
+                    {"detail": "Idempotency-Key was already used for a different request"}, status_code=422
+                )
+                await response(scope, receive, send)
+                return
+            if record.status_code is not None:
+                IDEMPOTENT_REQUESTS.labels(WAITED if waited else REPLAYED).inc()
+                await self.replay(record, send)
+                return
+            if time.monotonic() >= deadline:
+                IDEMPOTENT_REQUESTS.labels(IN_PROGRESS).inc()
+                response = JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is still in progress, retry later"},
+                    status_code=409,
+                    headers={"Retry-After": "1"},
+                )
+                await response(scope, receive, send)
+                return
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        IDEMPOTENT_REQUESTS.labels(EXECUTED).inc()
+        status_code = 500
+        response_headers = []
+        body = bytearray()
+        storable = True
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_headers, storable
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body" and storable:
+                body.extend(message.get("body", b""))
+                if len(body) > IdempotencyConfig.MAX_RESPONSE_BYTES:
+                    storable = False
+                    body.clear()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            # a release lost to cancellation is made up for by the lease
+            await run_in_threadpool(release_key, owner, key)
+            raise
+        if storable and status_code < 500 and status_code not in TRANSIENT_STATUS_CODES:
+            await run_in_threadpool(store_response, owner, key, status_code, response_headers, bytes(body))
+        else:
+            await run_in_threadpool(release_key, owner, key)
+
+    async def replay(self, record: IdempotencyKey, send):
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in record.response_headers]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": record.status_code,
+                "headers": [*headers, (REPLAYED_HEADER, b"true")],
+            }
+        )
+        await send({"type": "http.response.body", "body": record.response_body or b""})
@@ -0,0 +1,148 @@
+"""
+Long running operations executed after the request that started them returns.
+
+A job row records status and progress so any worker can answer GET /jobs/{id}
+while the worker that accepted the request does the work in its threadpool.
+Jobs lost with a restarted or crashed worker stop updating their row; the
+expire_jobs sweep marks them failed after JobConfig.STALE_SECONDS and deletes
+finished jobs after JobConfig.RETENTION_DAYS.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session
+
+from config import JobConfig
+from database import engine
+from models.postgres_models import Job
+
+from .background import exclusive_session
+from .metrics import JOBS_EXPIRED, JOBS_FINISHED
+
+logger = logging.getLogger("jobs")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# progress is written at most this often, in its own transaction
+PROGRESS_INTERVAL_SECONDS = 1.0
+# held by the worker running the sweep
+JOB_SWEEP_LOCK = 0x6a6f6273
+
+
+class Progress:
+    """Counts the work done by a job and reports it to the job row now and then."""
+
+    def __init__(self, job_id, total: int | None = None):
+        self.job_id = job_id
+        self.total = total
+        self.done = 0
+        self.reported = time.monotonic()
+
+    def advance(self, count: int = 1):
+        self.done += count
+        if time.monotonic() - self.reported >= PROGRESS_INTERVAL_SECONDS:
+            self.report()
+
+    def report(self):
+        self.reported = time.monotonic()
+        with engine.begin() as connection:
+            connection.execute(
+                update(Job)
+                .where(Job.job_id == self.job_id)
+                .values(progress_done=self.done, progress_total=self.total, updated_at=datetime.now())
+            )
+
+
+def create_job(db: Session, user_id, kind: str, params: dict | None = None, total: int | None = None) -> Job:
+    job = Job(user_id=user_id, kind=kind, params=params, progress_total=total)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def run_job(job_id, work: Callable[[Session, Progress], dict | None]):
+    """
+    Runs a job created by create_job, recording its status, progress and result.
+
+    Args:
+        job_id (UUID): The job to run.
+        work (Callable): Called with a fresh session and the job's Progress, returns the job result.
+    """
+    with Session(engine) as db:
+        job = db.get(Job, job_id, with_for_update=True)
+        if job is None or job.status != PENDING:
+            # waited so long in the threadpool that the sweep gave up on it
+            db.rollback()
+            return
+        job.status = RUNNING
+        job.updated_at = datetime.now()
+        db.commit()
+        kind = job.kind
+        progress = Progress(job_id, job.progress_total)
+        try:
+            result = work(db, progress)
+        except Exception as exc:
+            logger.exception("job %s (%s) failed", job_id, kind)
+            db.rollback()
+            job = db.get(Job, job_id)
+            job.status = FAILED
+            job.error = str(exc) or type(exc).__name__
+        else:
+            job = db.get(Job, job_id)
+            job.status = DONE
+            job.result = result
+        job.progress_done = progress.done
+        job.progress_total = progress.total
+        job.updated_at = job.finished_at = datetime.now()
+        db.commit()
+        JOBS_FINISHED.labels(kind, job.status).inc()
+
+
+def expire_jobs(db: Session, now: datetime | None = None) -> tuple[int, int]:
+    """
+    Marks jobs nobody works on anymore as failed and deletes old finished jobs.
+
+    Returns:
+        tuple[int, int]: The number of jobs marked failed and of jobs deleted.
+    """
+    now = now or datetime.now()
+    expired = db.execute(
+        update(Job)
+        .where(
+            Job.status.in_((PENDING, RUNNING)),
+            Job.updated_at < now - timedelta(seconds=JobConfig.STALE_SECONDS),
+        )
+        .values(status=FAILED, error="Interrupted", updated_at=now, finished_at=now)
+        .returning(Job.kind)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    deleted = 0
+    if JobConfig.RETENTION_DAYS > 0:
+        deleted = db.execute(
+            delete(Job)
+            .where(
+                Job.status.in_((DONE, FAILED)),
+                Job.finished_at < now - timedelta(days=JobConfig.RETENTION_DAYS),
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.commit()
+    for kind in expired:
+        JOBS_EXPIRED.labels(kind).inc()
+        JOBS_FINISHED.labels(kind, FAILED).inc()
+    return len(expired), deleted
+
+
+def sweep_jobs():
+    """Background job failing interrupted jobs and removing old finished ones."""
+    with exclusive_session(JOB_SWEEP_LOCK) as db:
+        if db is None:
+            return
+        expire_jobs(db)
@@ -0,0 +1,383 @@
+"""
+Background extraction of media attributes from file content.
+
+The content type is sniffed from magic bytes, images get their dimensions and
+EXIF capture date, audio and video their duration and PDFs their page count.
+Parsing runs in a process pool so it neither holds the GIL of the web workers
+nor takes the server down on a malformed file. Pending files are claimed by
+stamping media_claimed_at with FOR UPDATE SKIP LOCKED and committing, so every
+worker can run the job and they share the work without keeping the rows locked
+while they are analysed; claims of a worker that died expire after CLAIM_SECONDS.
+Results are only written while the file still has the content that was analysed.
+
+Pillow, mutagen and pypdf are used when installed; without them PNG, GIF and
+JPEG dimensions, WAV and MP4 durations and PDF page counts are read directly.
+"""
+import logging
+import multiprocessing
+import re
+import struct
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+
+from config import MediaConfig
+from database import engine
+from models.postgres_models import MEDIA_ATTRIBUTES, FileMetadata
+
+from .metrics import MEDIA_ANALYZED
+from .storage import iter_blob
+
+try:
+    from PIL import Image
+except ImportError:  # dimensions of PNG, GIF and JPEG are parsed directly, no EXIF dates
+    Image = None
+
+try:
+    import mutagen
+except ImportError:  # only WAV and MP4 durations are parsed directly
+    mutagen = None
+
+try:
+    import pypdf
+except ImportError:  # pages are counted by scanning for page objects
+    pypdf = None
+
+logger = logging.getLogger("media")
+
+HEAD_SIZE = 64 * 1024
+# a batch is analysed within MediaConfig.TIMEOUT_SECONDS, older claims are taken over
+CLAIM_SECONDS = 2 * MediaConfig.TIMEOUT_SECONDS
+# PDFs are scanned for page objects up to this size when pypdf is not installed
+PDF_SCAN_LIMIT = 64 * 1024 * 1024
+
+MAGIC = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"BM", "image/bmp"),
+    (b"%PDF-", "application/pdf"),
+    (b"ID3", "audio/mpeg"),
+    (b"fLaC", "audio/flac"),
+    (b"OggS", "audio/ogg"),
+    (b"\x1aE\xdf\xa3", "video/webm"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"(\xb5/\xfd", "application/zstd"),
+    (b"7z\xbc\xaf'\x1c", "application/x-7z-compressed"),
+    (b"Rar!\x1a\x07", "application/vnd.rar"),
+)
+RIFF_TYPES = {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/x-msvideo"}
+FTYP_BRANDS = {
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"mif1": "image/heif",
+    b"avif": "image/avif",
+    b"qt  ": "video/quicktime",
+    b"M4A ": "audio/mp4",
+    b"M4B ": "audio/mp4",
+}
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+
+def sniff_type(head: bytes) -> str | None:
+    """Returns the MIME type the leading bytes of a file identify, or None."""
+    for magic, content_type in MAGIC:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] in RIFF_TYPES:
+        return RIFF_TYPES[head[8:12]]
+    if head[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(head[8:12], "video/mp4")
+    if len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return "audio/mpeg"
+    if head and b"\x00" not in head:
+        try:
+            head.decode("utf-8")
+        except UnicodeDecodeError as exc:
+            # a multi-byte character cut off at the end of the head is still text
+            if exc.start < len(head) - 3:
+                return None
+        return "text/plain"
+    return None
+
+
+def _image_size(head: bytes, content_type: str) -> tuple[int, int] | None:
+    if content_type == "image/png" and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if content_type == "image/gif" and len(head) >= 10:
+        return struct.unpack("<HH", head[6:10])
+    if content_type == "image/jpeg":
+        position = 2
+        while position + 9 < len(head):
+            if head[position] != 0xFF:
+                position += 1
+                continue
+            marker = head[position + 1]
+            # start of frame markers, except DHT, JPG and DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", head[position + 5:position + 9])
+                return width, height
+            position += 2 + struct.unpack(">H", head[position + 2:position + 4])[0]
+    return None
+
+
+def _image_attributes(path: str, head: bytes, content_type: str) -> dict:
+    if Image is None:
+        size = _image_size(head, content_type)
+        return {"width": size[0], "height": size[1]} if size else {}
+    with Image.open(path) as image:
+        attributes = {"width": image.width, "height": image.height}
+        exif = image.getexif()
+        # DateTimeOriginal in the Exif IFD, DateTime in IFD0
+        taken = exif.get_ifd(0x8769).get(0x9003) or exif.get(0x0132)
+    if taken:
+        try:
+            attributes["taken_at"] = datetime.strptime(str(taken).strip("\x00 "), EXIF_DATE_FORMAT)
+        except ValueError:
+            pass
+    return attributes
+
+
+def _mp4_duration(path: str) -> float | None:
+    # walks the top level boxes to moov and reads timescale and duration from its mvhd
+    with open(path, "rb") as f:
+        end = None
+        while end is None or f.tell() < end:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, box = struct.unpack(">I4s", header)
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0] - 8
+            if box == b"moov":
+                end = f.tell() + size - 8
+                continue
+            if box == b"mvhd":
+                version = f.read(4)[0]
+                if version == 1:
+                    timescale, duration = struct.unpack(">16xIQ", f.read(28))
+                else:
+                    timescale, duration = struct.unpack(">8xII", f.read(16))
+                return duration / timescale if timescale else None
+            if size < 8:
+                return None
+            f.seek(size - 8, 1)
+    return None
+
+
+def _wav_duration(head: bytes) -> float | None:
+    format_at = head.find(b"fmt ")
+    data_at = head.find(b"data")
+    if format_at < 0 or data_at < 0:
+        return None
+    byte_rate = struct.unpack("<I", head[format_at + 16:format_at + 20])[0]
+    data_size = struct.unpack("<I", head[data_at + 4:data_at + 8])[0]
+    return data_size / byte_rate if byte_rate else None
+
+
+def _av_attributes(path: str, head: bytes, content_type: str) -> dict:
+    duration = None
+    if mutagen is not None:
+        audio = mutagen.File(path)
+        if audio is not None and audio.info is not None:
+            duration = audio.info.length
+    if duration is None and content_type == "audio/wav":
+        duration = _wav_duration(head)
+    if duration is None and (content_type.startswith("video/mp4") or content_type in ("video/quicktime", "audio/mp4")):
+        duration = _mp4_duration(path)
+    return {"duration": duration} if duration else {}
+
+
+def _pdf_attributes(path: str) -> dict:
+    if pypdf is not None:
+        return {"page_count": len(pypdf.PdfReader(path).pages)}
+    with open(path, "rb") as f:
+        pages = len(PDF_PAGE.findall(f.read(PDF_SCAN_LIMIT)))
+    return {"page_count": pages} if pages else {}
+
+
+def analyze(path: str, blob_compression: str | None) -> dict:
+    """
+    Sniffs the type of a stored blob and extracts its media attributes.
+
+    Runs in the process pool. Compressed blobs are text-like and only get their
+    type sniffed.
+
+    Returns:
+        dict: detected_type and whichever of width, height, taken_at, duration and page_count apply.
+    """
+    head = b""
+    for chunk in iter_blob(path, blob_compression, 0, HEAD_SIZE):
+        head += chunk
+    content_type = sniff_type(head)
+    attributes = {"detected_type": content_type}
+    if content_type is None or blob_compression:
+        return attributes
+    try:
+        if content_type.startswith("image/"):
+            attributes.update(_image_attributes(path, head, content_type))
+        elif content_type.startswith(("audio/", "video/")):
+            attributes.update(_av_attributes(path, head, content_type))
+        elif content_type == "application/pdf":
+            attributes.update(_pdf_attributes(path))
+    except Exception:
+        # malformed content keeps its sniffed type
+        pass
+    return attributes
+
+
+_pool = None
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawned, forking a process running an event loop and a threadpool is not safe
+        _pool = ProcessPoolExecutor(MediaConfig.WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool(kill: bool = False):
+    """
+    Shuts the process pool down, the next batch starts a new one.
+
+    Args:
+        kill (bool): Also kills the worker processes, a running task cannot be cancelled otherwise.
+    """
+    global _pool
+    if _pool is not None:
+        # the executor has no public way to stop its processes before python 3.14
+        processes = list((_pool._processes or {}).values()) if kill else []
+        _pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.kill()
+        _pool = None
+
+
+def _submit(files) -> dict:
+    return {_executor().submit(analyze, file.storage_location, file.compression): file for file in files}
+
+
+def _claim(db: Session) -> list:
+    now = datetime.now()
+    pending = (
+        select(FileMetadata.user_id, FileMetadata.file_id)
+        .where(
+            FileMetadata.media_analyzed_at == None,
+            FileMetadata.is_trashed == False,
+            or_(
+                FileMetadata.media_claimed_at == None,
+                FileMetadata.media_claimed_at < now - timedelta(seconds=CLAIM_SECONDS),
+            ),
+        )
+        .limit(MediaConfig.BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    files = db.execute(
+        update(FileMetadata)
+        .where(tuple_(FileMetadata.user_id, FileMetadata.file_id).in_(pending))
+        .values(media_claimed_at=now)
+        .returning(
+            FileMetadata.user_id,
+            FileMetadata.file_id,
+            FileMetadata.storage_location,
+            FileMetadata.compression,
+            FileMetadata.version,
+        )
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return files
+
+
+def _store_results(db: Session, rows: list[dict]):
+    # skips files whose content was replaced or moved meanwhile, replaced ones are pending
+    # again and moved ones are claimed again once the claim expired
+    table = FileMetadata.__table__
+    db.execute(
+        update(table)
+        .where(
+            table.c.user_id == bindparam("claimed_user_id"),
+            table.c.file_id == bindparam("claimed_file_id"),
+            table.c.version == bindparam("claimed_version"),
+            table.c.storage_location == bindparam("claimed_location"),
+            table.c.media_analyzed_at == None,
+        )
+        .values({attribute: bindparam(attribute) for attribute in MEDIA_ATTRIBUTES}),
+        rows,
+    )
+    db.commit()
+
+
+def extract_pending_media() -> int:
+    """
+    Background job analysing files whose media attributes are not known yet.
+
+    Claims batches of pending files and analyses them in the process pool, no
+    row stays locked meanwhile. Files that cannot be read or time out are marked
+    as analysed without attributes, so they are not retried forever. A timeout
+    kills the pool, the parser stuck on the file would keep its process otherwise;
+    files the pool had not picked up yet are analysed again.
+
+    Returns:
+        int: The number of analysed files.
+    """
+    analyzed = 0
+    while True:
+        with Session(engine) as db:
+            files = _claim(db)
+            if not files:
+                return analyzed
+
+            try:
+                futures = _submit(files)
+            except BrokenProcessPool:
+                # a process of the pool died on an earlier batch, start a new pool
+                shutdown_pool()
+                futures = _submit(files)
+            done, _ = wait(futures, timeout=MediaConfig.TIMEOUT_SECONDS)
+            now = datetime.now()
+            rows = []
+            timed_out = False
+            for future, file in futures.items():
+                attributes = {}
+                if future in done and future.exception() is None:
+                    attributes = future.result()
+                    MEDIA_ANALYZED.labels("ok" if attributes["detected_type"] else "unknown").inc()
+                elif future in done:
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        shutdown_pool()
+                    elif not isinstance(future.exception(), FileNotFoundError):
+                        logger.warning("media extraction of %s failed: %r", file.file_id, future.exception())
+                    MEDIA_ANALYZED.labels("error").inc()
+                elif future.cancel():
+                    # not handed to a process yet, claimed again after CLAIM_SECONDS
+                    continue
+                else:
+                    timed_out = True
+                    logger.warning("media extraction of %s timed out", file.file_id)
+                    MEDIA_ANALYZED.labels("timeout").inc()
+                rows.append(
+                    {
+                        "claimed_user_id": file.user_id,
+                        "claimed_file_id": file.file_id,
+                        "claimed_version": file.version,
+                        "claimed_location": file.storage_location,
+                        **dict.fromkeys(MEDIA_ATTRIBUTES),
+                        **attributes,
+                        "media_analyzed_at": now,
+                    }
+                )
+            if timed_out:
+                shutdown_pool(kill=True)
+            if rows:
+                _store_results(db, rows)
+            analyzed += len(rows)
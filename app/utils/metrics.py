@@ -0,0 +1,263 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by route template",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+UPLOAD_BYTES = Counter(
+    "storage_upload_bytes_total", "Bytes written to storage by uploads"
+)
+DELTA_UPLOAD_BYTES = Counter(
+    "storage_delta_upload_bytes_total",
+    "Content of files rebuilt by delta uploads, copied from the stored blob or sent by the client",
+    ["source"],
+)
+DOWNLOAD_BYTES = Counter(
+    "storage_download_bytes_total",
+    "Bytes served by file downloads",
+    ["mode"],
+)
+UPLOAD_THROUGHPUT = Histogram(
+    "storage_upload_throughput_bytes_per_second",
+    "Throughput of a single upload request while writing to storage",
+    buckets=(2**20, 5 * 2**20, 10 * 2**20, 25 * 2**20, 50 * 2**20, 100 * 2**20, 250 * 2**20, 500 * 2**20, 2**30),
+)
+STORAGE_LOGICAL_BYTES = Counter(
+    "storage_logical_bytes_written_total",
+    "Uncompressed bytes of blobs written to storage",
+    ["compression"],
+)
+STORAGE_STORED_BYTES = Counter(
+    "storage_stored_bytes_written_total",
+    "Bytes of blobs actually written to disk after compression",
+    ["compression"],
+)
+STORAGE_COMPRESSION_SAVED_BYTES = Counter(
+    "storage_compression_saved_bytes_total",
+    "Bytes saved by compression at rest",
+    ["direction"],
+)
+VERSION_ARCHIVED_BYTES = Counter(
+    "storage_version_archived_bytes_total",
+    "Bytes of previous file versions archived to the chunk store, new or deduplicated against existing chunks",
+    ["storage"],
+)
+VERSIONS_PRUNED = Counter(
+    "storage_versions_pruned_total", "File versions removed by the retention policy"
+)
+VERSION_CHUNKS_SWEPT = Counter(
+    "storage_version_chunks_swept_total", "Unreferenced chunks removed from the chunk store"
+)
+TRASH_PURGED = Counter(
+    "storage_trash_purged_total",
+    "Trashed files and folders deleted permanently",
+    ["kind", "trigger"],
+)
+TRASH_PURGED_BYTES = Counter(
+    "storage_trash_purged_bytes_total",
+    "Bytes of trashed files deleted permanently",
+    ["trigger"],
+)
+VOLUME_FREE_BYTES = Gauge(
+    "storage_volume_free_bytes",
+    "Free space of a storage volume as last checked",
+    ["volume"],
+    multiprocess_mode="max",
+)
+BLOB_PLACEMENTS = Counter(
+    "storage_blob_placements_total",
+    "New blobs placed on a storage volume",
+    ["volume"],
+)
+BLOB_MOVES = Counter(
+    "storage_blob_moves_total",
+    "Blobs moved between storage volumes by the rebalancing job",
+    ["reason"],
+)
+RETIRED_BLOBS_REMOVED = Counter(
+    "storage_retired_blobs_removed_total",
+    "Blobs superseded by a copy at another path removed after their grace period",
+)
+BLOB_CACHE_REQUESTS = Counter(
+    "storage_blob_cache_requests_total",
+    "Downloads of cacheable files, by whether their content was in the memory cache",
+    ["result"],
+)
+BLOB_CACHE_BYTES = Gauge(
+    "storage_blob_cache_bytes",
+    "Bytes of file content held by the memory caches",
+    multiprocess_mode="livesum",
+)
+BLOB_CACHE_EVICTIONS = Counter(
+    "storage_blob_cache_evictions_total",
+    "Files evicted from the memory cache to stay within its budget",
+)
+TIER_MOVES = Counter(
+    "storage_tier_moves_total",
+    "Blobs moved between the hot and the cold tier",
+    ["direction"],
+)
+ACCESS_TIMES_WRITTEN = Counter(
+    "storage_access_times_written_total",
+    "File access times written to the database by the batched flush",
+)
+BLOB_COPIES = Counter(
+    "storage_blob_copies_total",
+    "Blobs copied on disk, by the primitive used",
+    ["method"],
+)
+MEDIA_ANALYZED = Counter(
+    "media_files_analyzed_total",
+    "Files analysed by the media extraction job",
+    ["result"],
+)
+REPLICA_LAG_SECONDS = Gauge(
+    "db_replica_lag_seconds",
+    "Replay lag of a read replica as last measured, +Inf when it cannot be reached",
+    ["replica"],
+    multiprocess_mode="max",
+)
+REPLICA_READS = Counter(
+    "db_read_sessions_total",
+    "Sessions of read-only endpoints, by the database they were routed to",
+    ["target"],
+)
+JOBS_FINISHED = Counter(
+    "jobs_finished_total",
+    "Background jobs finished",
+    ["kind", "status"],
+)
+JOBS_EXPIRED = Counter(
+    "jobs_expired_total",
+    "Pending or running jobs marked failed after their worker stopped updating them",
+    ["kind"],
+)
+ADMISSION_REJECTED = Counter(
+    "http_admission_rejected_total",
+    "Requests turned away by admission control",
+    ["kind", "reason"],
+)
+IDEMPOTENT_REQUESTS = Counter(
+    "http_idempotent_requests_total",
+    "Requests carrying an Idempotency-Key, by whether they ran, were replayed or refused",
+    ["outcome"],
+)
+PARTITION_BACKFILL_ROWS = Counter(
+    "db_partition_backfill_rows_total",
+    "Rows copied into the partitioned tables by the backfill job",
+    ["table"],
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "Number of SQL statements issued while handling a request",
+    ["route"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144),
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds",
+    "Total time spent executing SQL statements while handling a request",
+    ["route"],
+)
+DB_QUERY_BUDGET_EXCEEDED = Counter(
+    "db_query_budget_exceeded_total",
+    "Requests that exceeded the SQL query budget or repeated a statement like an N+1",
+    ["route", "reason"],
+)
+REQUESTS_PROFILED = Counter(
+    "requests_profiled_total",
+    "Requests profiled, by what triggered the profile",
+    ["trigger"],
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_duration_seconds",
+    "Time spent hashing or verifying passwords with bcrypt",
+    ["operation"],
+)
+EMAIL_SEND_SECONDS = Histogram(
+    "email_send_duration_seconds",
+    "Time spent sending transactional emails",
+    ["template", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Renders all metrics in the prometheus text format.
+
+    When several workers run with PROMETHEUS_MULTIPROC_DIR set, the values
+    of all workers are aggregated from the shared directory.
+
+    Returns:
+        tuple[bytes, str]: The encoded metrics and their content type.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware recording latency and in-flight requests per route template.
+
+    The route template (e.g. /files/download/{file_id}) is used as label instead of
+    the raw path so the number of series stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                method, getattr(route, "path", UNMATCHED_ROUTE), str(status_code)
+            ).observe(time.perf_counter() - start)
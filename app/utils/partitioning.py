@@ -0,0 +1,95 @@
+"""
+Online backfill of the hash-partitioned file_metadata and folder tables.
+
+Migration 0011 creates file_metadata_partitioned and folder_partitioned next to
+the live tables, with triggers mirroring every write into them. This job copies
+the rows that existed before, in primary key order and in batches, recording
+how far it got in partition_backfill so it resumes after a restart. Every batch
+locks the rows it copies FOR SHARE, so a concurrent update or delete of one of
+them waits for the copy and its trigger then sees the copied row. Once both
+tables are complete, migration 0012 swaps them in. Before 0011 and after 0012
+there is no partition_backfill table and the job does nothing.
+"""
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from config import PartitionConfig
+
+from .background import exclusive_session
+from .metrics import PARTITION_BACKFILL_ROWS
+from .trash import Throttle
+
+logger = logging.getLogger("background")
+
+PARTITION_BACKFILL_LOCK = 0x70617274
+
+# copied in this order, the id column the batches advance along
+TABLES = {"folder": "folder_id", "file_metadata": "file_id"}
+
+
+def backfill_table(db: Session, table: str, batch_size: int, throttle: Throttle | None = None) -> int:
+    """
+    Copies the rows of a live table its partitioned table does not have yet.
+
+    Args:
+        db (Session): The database session, committed after every batch.
+        table (str): "folder" or "file_metadata".
+        batch_size (int): Rows copied per transaction.
+        throttle (Throttle | None): Limits the rate batches are copied at.
+
+    Returns:
+        int: The number of rows read from the live table.
+    """
+    id_column = TABLES[table]
+    copied = 0
+    while True:
+        progress = db.execute(
+            text("SELECT last_id, completed_at FROM partition_backfill WHERE table_name = :table"),
+            {"table": table},
+        ).one()
+        if progress.completed_at is not None:
+            db.commit()
+            return copied
+        where = f"WHERE {id_column} > CAST(:after AS uuid) " if progress.last_id else ""
+        count, last_id = db.execute(
+            text(
+                f"WITH batch AS (SELECT * FROM {table} {where}ORDER BY {id_column} LIMIT :limit FOR SHARE), "
+                f"copied AS (INSERT INTO {table}_partitioned SELECT * FROM batch ON CONFLICT DO NOTHING) "
+                f"SELECT (SELECT count(*) FROM batch), (SELECT {id_column} FROM batch ORDER BY {id_column} DESC LIMIT 1)"
+            ),
+            {"after": str(progress.last_id) if progress.last_id else None, "limit": batch_size},
+        ).one()
+        # newer rows are mirrored by the trigger, rows with smaller ids inserted meanwhile too
+        db.execute(
+            text(
+                "UPDATE partition_backfill SET last_id = coalesce(:last_id, last_id), "
+                "completed_at = CASE WHEN :count < :limit THEN now() END WHERE table_name = :table"
+            ),
+            {"last_id": last_id, "count": count, "limit": batch_size, "table": table},
+        )
+        db.commit()
+        PARTITION_BACKFILL_ROWS.labels(table).inc(count)
+        copied += count
+        if count < batch_size:
+            logger.info("backfill of %s_partitioned complete", table)
+            return copied
+        if throttle:
+            throttle.wait(0)
+
+
+def backfill_partitions() -> int:
+    """Background job copying file_metadata and folder into their partitioned tables."""
+    with exclusive_session(PARTITION_BACKFILL_LOCK) as db:
+        if db is None:
+            return 0
+        pending = db.execute(text("SELECT to_regclass('partition_backfill') IS NOT NULL")).scalar()
+        db.commit()
+        if not pending:
+            return 0
+        # the throttle counts batches
+        throttle = Throttle(PartitionConfig.BACKFILL_ROWS_PER_SECOND / PartitionConfig.BACKFILL_BATCH_SIZE)
+        return sum(
+            backfill_table(db, table, PartitionConfig.BACKFILL_BATCH_SIZE, throttle) for table in TABLES
+        )
@@ -0,0 +1,209 @@
+"""
+Opt-in CPU profiling of single requests.
+
+A request is profiled when it sends "X-Profile: <PROFILE_TOKEN>" or is picked
+by PROFILE_SAMPLE_RATE. The profile is written to PROFILE_DIR next to a small
+JSON description, requests asking for it get its id in an X-Profile-Id header,
+and GET /profiles/ serves them to holders of the same token. Requests that are
+not profiled only pay a header lookup and, with sampling on, a random number;
+without a token and a sample rate the middleware is not installed at all.
+
+pyinstrument is used when installed: it samples the stack, follows the request
+across awaits, and its profiles are stored in the speedscope format, which
+speedscope.app and most flamegraph viewers open. Without it cProfile traces
+every call and the profile is a pstats file (snakeviz, `python -m pstats`).
+Only the event loop thread is profiled; time in the threadpool shows up as the
+await waiting for it. A worker profiles one request at a time, a profiler hooks
+the whole thread and would also record the other requests on the loop.
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+import uuid
+from datetime import datetime
+
+from starlette.concurrency import run_in_threadpool
+
+from config import ProfilingConfig
+
+from .metrics import REQUESTS_PROFILED, UNMATCHED_ROUTE
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # cProfile, which traces every call and has no flamegraph output
+    Profiler = None
+
+logger = logging.getLogger("profiler")
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_HEADER = b"x-profile-id"
+SPEEDSCOPE = "speedscope"
+PSTATS = "pstats"
+EXTENSIONS = {SPEEDSCOPE: ".speedscope.json", PSTATS: ".pstats"}
+# fetching profiles is not profiled, it would push the profiles being fetched out
+PROFILES_PATH = "/profiles/"
+PROFILE_ID = re.compile(r"^\d{20}-[0-9a-f]{8}$")
+
+# a profile is being recorded in this worker
+_active = False
+
+
+def authorized(token: str | None) -> bool:
+    """Whether a token is the configured profiling token, always False without one."""
+    return bool(ProfilingConfig.TOKEN) and token is not None and hmac.compare_digest(
+        token.encode(), ProfilingConfig.TOKEN.encode()
+    )
+
+
+def _trigger(scope) -> str | None:
+    if scope["path"].startswith(PROFILES_PATH):
+        return None
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return "header" if authorized(value.decode("latin-1")) else None
+    if ProfilingConfig.SAMPLE_RATE > 0 and random.random() < ProfilingConfig.SAMPLE_RATE:
+        return "sample"
+    return None
+
+
+def _description_path(profile_id: str) -> str:
+    return os.path.join(ProfilingConfig.DIRECTORY, f"{profile_id}.json")
+
+
+def profile_path(profile_id: str) -> str | None:
+    """Returns the path of a stored profile, None for unknown or malformed ids."""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        with open(_description_path(profile_id)) as f:
+            profile_format = json.load(f)["format"]
+    except (OSError, ValueError, KeyError):
+        return None
+    path = os.path.join(ProfilingConfig.DIRECTORY, profile_id + EXTENSIONS[profile_format])
+    return path if os.path.exists(path) else None
+
+
+def list_profiles() -> list[dict]:
+    """Returns the descriptions of the stored profiles, newest first."""
+    try:
+        names = sorted(
+            (name for name in os.listdir(ProfilingConfig.DIRECTORY) if PROFILE_ID.match(name.removesuffix(".json"))),
+            reverse=True,
+        )
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        try:
+            with open(os.path.join(ProfilingConfig.DIRECTORY, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # removed by another worker pruning, or still being written
+            continue
+    return profiles
+
+
+def _prune():
+    for description in list_profiles()[ProfilingConfig.MAX_PROFILES:]:
+        for path in (
+            os.path.join(ProfilingConfig.DIRECTORY, description["id"] + EXTENSIONS[description["format"]]),
+            _description_path(description["id"]),
+        ):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _save(profiler, description: dict):
+    os.makedirs(ProfilingConfig.DIRECTORY, exist_ok=True)
+    path = os.path.join(ProfilingConfig.DIRECTORY, description["id"] + EXTENSIONS[description["format"]])
+    if description["format"] == SPEEDSCOPE:
+        with open(path, "w") as f:
+            f.write(profiler.output(renderer=SpeedscopeRenderer()))
+    else:
+        profiler.dump_stats(path)
+    # the description is written last, listed profiles are complete
+    temporary = _description_path(description["id"]) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(description, f)
+    os.replace(temporary, _description_path(description["id"]))
+    _prune()
+
+
+class ProfilerMiddleware:
+    """
+    Plain ASGI middleware profiling the requests that ask for it or are sampled.
+
+    The profile covers everything inside this middleware and is written once the
+    response is sent, so its status and duration are part of the description.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _active
+        if scope["type"] != "http" or _active:
+            await self.app(scope, receive, send)
+            return
+        trigger = _trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        _active = True
+        profile_id = f"{datetime.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if trigger == "header":
+                    message = {
+                        **message,
+                        "headers": [*message.get("headers", []), (PROFILE_ID_HEADER, profile_id.encode())],
+                    }
+            await send(message)
+
+        if Profiler is not None:
+            profiler = Profiler(interval=ProfilingConfig.INTERVAL_SECONDS, async_mode="enabled")
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            if Profiler is not None:
+                profiler.stop()
+            else:
+                profiler.disable()
+            _active = False
+            description = {
+                "id": profile_id,
+                "format": SPEEDSCOPE if Profiler is not None else PSTATS,
+                "trigger": trigger,
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": getattr(scope.get("route"), "path", UNMATCHED_ROUTE),
+                "status": status_code,
+                "duration_ms": round(duration * 1000, 1),
+                "created_at": datetime.now().isoformat(),
+            }
+            try:
+                await run_in_threadpool(_save, profiler, description)
+            except OSError as exc:
+                # a full or read-only disk does not fail the request
+                logger.warning("profile %s could not be saved: %r", profile_id, exc)
+            else:
+                REQUESTS_PROFILED.labels(trigger).inc()
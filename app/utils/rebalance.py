@@ -0,0 +1,171 @@
+"""
+Moving blobs between storage volumes in the background.
+
+Draining volumes are emptied onto the others, and while the free space fraction
+of the fullest and the emptiest volume differs by more than the threshold, blobs
+move from one to the other. A blob is copied first and its row only switched
+over if the file did not get new content meanwhile: uploads and restores lock
+the row before they replace a blob, so the version check under the row lock is
+enough. The old blob is retired in the same transaction and only removed after
+a grace period, so downloads that looked up the old path just before still find
+it (see utils/retired_blobs.py).
+"""
+import os
+import uuid
+
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.orm import Session
+
+from config import RebalanceConfig, StorageConfig
+from models.postgres_models import FileMetadata
+
+from .background import exclusive_session
+from .metrics import BLOB_MOVES
+from .retired_blobs import retire_blob
+from .storage import VOLUMES, Volume, choose_volume, clone_blob, volume_of, volume_space
+from .trash import Throttle
+
+REBALANCE_LOCK = 0x72626C63
+
+DRAIN = "drain"
+BALANCE = "balance"
+
+
+def move_blob(db: Session, file, destination: Volume) -> bool:
+    """
+    Moves the blob of a file row to another volume, keeping its path below the volume.
+
+    Args:
+        db (Session): The database session, committed when the blob moved.
+        file: A row with user_id, file_id, version and storage_location.
+        destination (Volume): The volume to move the blob to.
+
+    Returns:
+        bool: Whether the blob moved, False if the file changed or vanished meanwhile.
+    """
+    source = file.storage_location
+    relative_path = os.path.relpath(source, volume_of(source).path)
+    target = os.path.join(destination.path, relative_path)
+    if os.path.exists(target):
+        target = os.path.join(os.path.dirname(target), f"{uuid.uuid4()}-{os.path.basename(target)}")
+    try:
+        clone_blob(source, target, hardlink=False)
+    except FileNotFoundError:
+        return False
+
+    current = db.execute(
+        select(FileMetadata.version, FileMetadata.storage_location)
+        .where(FileMetadata.user_id == file.user_id, FileMetadata.file_id == file.file_id)
+        .with_for_update()
+    ).first()
+    if current is None or (current.version, current.storage_location) != (file.version, source):
+        db.rollback()
+        os.remove(target)
+        return False
+    try:
+        # updated_at stays as it is, the content did not change
+        db.execute(
+            update(FileMetadata)
+            .where(FileMetadata.user_id == file.user_id, FileMetadata.file_id == file.file_id)
+            .values(storage_location=target)
+        )
+        retire_blob(db, source)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        os.remove(target)
+        raise
+    return True
+
+
+def _blobs_on(db: Session, volume: Volume, after, limit: int) -> list:
+    prefix = os.path.join(volume.path, "")
+    # in primary key order, which the partitions of file_metadata can each return from their index
+    query = (
+        select(
+            FileMetadata.user_id,
+            FileMetadata.file_id,
+            FileMetadata.version,
+            FileMetadata.storage_location,
+            FileMetadata.stored_size,
+        )
+        .where(FileMetadata.storage_location.startswith(prefix, autoescape=True))
+        .order_by(FileMetadata.user_id, FileMetadata.file_id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(tuple_(FileMetadata.user_id, FileMetadata.file_id) > after)
+    rows = db.execute(query).all()
+    db.commit()
+    return rows
+
+
+def drain_volume(db: Session, volume: Volume, throttle: Throttle | None = None) -> int:
+    """Moves every blob off a volume, onto the volumes picked by the placement policy."""
+    moved = 0
+    after = None
+    while True:
+        rows = _blobs_on(db, volume, after, RebalanceConfig.BATCH_SIZE)
+        if not rows:
+            return moved
+        for row in rows:
+            if move_blob(db, row, choose_volume(row.storage_location, exclude=volume)):
+                BLOB_MOVES.labels(DRAIN).inc()
+                moved += 1
+            if throttle:
+                throttle.wait(row.stored_size or 0)
+        after = (rows[-1].user_id, rows[-1].file_id)
+
+
+def _free_fraction(volume: Volume) -> float:
+    free, total = volume_space(volume, max_age=0)
+    return free / total if total else 1.0
+
+
+def balance_volumes(db: Session, throttle: Throttle | None = None) -> int:
+    """
+    Moves blobs from the fullest to the emptiest active volume until their free
+    space fractions are within RebalanceConfig.THRESHOLD of each other.
+    """
+    active = [volume for volume in VOLUMES if not volume.draining]
+    # volumes sharing a filesystem cannot be balanced against each other
+    filesystems = {}
+    for volume in active:
+        filesystems.setdefault(os.stat(volume.path).st_dev, volume)
+    active = list(filesystems.values())
+    if len(active) < 2:
+        return 0
+
+    moved = 0
+    cursors = {}
+    while True:
+        fullest = min(active, key=_free_fraction)
+        emptiest = max(active, key=_free_fraction)
+        if _free_fraction(emptiest) - _free_fraction(fullest) <= RebalanceConfig.THRESHOLD:
+            return moved
+        rows = _blobs_on(db, fullest, cursors.get(fullest), RebalanceConfig.BATCH_SIZE)
+        if not rows:
+            return moved
+        for row in rows:
+            if move_blob(db, row, emptiest):
+                BLOB_MOVES.labels(BALANCE).inc()
+                moved += 1
+            if throttle:
+                throttle.wait(row.stored_size or 0)
+        cursors[fullest] = (rows[-1].user_id, rows[-1].file_id)
+
+
+def rebalance_volumes():
+    """Background job draining volumes in StorageConfig.DRAIN_VOLUMES and balancing the others."""
+    if len(StorageConfig.VOLUMES) < 2:
+        return
+    with exclusive_session(REBALANCE_LOCK) as db:
+        if db is None:
+            return
+        throttle = Throttle(
+            RebalanceConfig.FILES_PER_SECOND, RebalanceConfig.MB_PER_SECOND * 1024 * 1024
+        )
+        for volume in VOLUMES:
+            if volume.draining:
+                drain_volume(db, volume, throttle)
+        balance_volumes(db, throttle)
@@ -0,0 +1,208 @@
+"""
+Routing of read-only endpoints to Postgres read replicas.
+
+Endpoints that only list or look things up take their session from
+get_read_session, which hands out a replica whose measured lag is within
+MAX_LAG_SECONDS; replicas are only used once they have been measured. A user
+who just wrote something is kept on the primary for STICKY_SECONDS, so they
+read their own writes: every request whose primary connection committed an
+INSERT, UPDATE or DELETE records the user of its bearer token in a sqlite file
+shared by the workers of the host, and sets a cookie for clients that send one
+back to another host.
+"""
+import math
+import random
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from http.cookies import SimpleCookie
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+from config import ReplicaConfig
+
+from .jwttoken import decode_access_token
+from .metrics import REPLICA_LAG_SECONDS, REPLICA_READS
+
+STICKY_COOKIE = "primary_until"
+# marks sessions bound to a replica, code that writes opportunistically checks it
+READ_ONLY = "read_only"
+
+# 0 on a server that is not a standby, so a primary listed as replica is not demoted
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+@dataclass
+class RoutingState:
+    # the client wrote within the sticky window
+    sticky: bool = False
+    # a primary connection committed a write during this request
+    wrote: bool = False
+
+
+_current_state: ContextVar[RoutingState | None] = ContextVar("replica_routing", default=None)
+
+# last measured lag per replica engine, replicas not measured yet get no reads
+_lag: dict[Engine, float] = {}
+
+
+def replica_name(engine: Engine) -> str:
+    url = engine.url
+    return f"{url.host or 'localhost'}:{url.port or 5432}/{url.database}"
+
+
+def install_write_tracking(engine: Engine):
+    """
+    Registers hooks on the primary engine that flag the current request once one
+    of its transactions commits a write.
+    """
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+            conn.info["replica_wrote"] = True
+
+    @event.listens_for(engine, "commit")
+    def _commit(conn):
+        state = _current_state.get()
+        if conn.info.pop("replica_wrote", False) and state is not None:
+            state.wrote = True
+
+    @event.listens_for(engine, "rollback")
+    def _rollback(conn):
+        conn.info.pop("replica_wrote", None)
+
+
+def choose_replica(engines: list[Engine]) -> Engine | None:
+    """
+    Returns a random replica within the lag limit, or None when the request should
+    use the primary: no replicas, a sticky client, all replicas behind, or no request.
+    """
+    state = _current_state.get()
+    if not engines or state is None or state.sticky:
+        REPLICA_READS.labels("primary").inc()
+        return None
+    usable = [engine for engine in engines if _lag.get(engine, math.inf) <= ReplicaConfig.MAX_LAG_SECONDS]
+    if not usable:
+        REPLICA_READS.labels("primary").inc()
+        return None
+    REPLICA_READS.labels("replica").inc()
+    return random.choice(usable)
+
+
+def measure_replica_lag(engines: list[Engine]):
+    """
+    Background job measuring the replay lag of every replica.
+
+    A replica that cannot be reached is recorded with an infinite lag and gets no
+    reads until it answers again.
+    """
+    for engine in engines:
+        try:
+            with engine.connect() as connection:
+                lag = float(connection.execute(LAG_QUERY).scalar() or 0.0)
+        except Exception:
+            lag = math.inf
+        _lag[engine] = lag
+        REPLICA_LAG_SECONDS.labels(replica_name(engine)).set(lag)
+
+
+class WriteLog:
+    """Until when users stay on the primary, in a sqlite file shared by the workers of a host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS sticky_user (user TEXT PRIMARY KEY, until REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS ix_sticky_user_until ON sticky_user (until)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def record(self, user: str, until: float):
+        connection = self._connection()
+        connection.execute("DELETE FROM sticky_user WHERE until < ?", (time.time(),))
+        connection.execute("INSERT OR REPLACE INTO sticky_user (user, until) VALUES (?, ?)", (user, until))
+
+    def sticky(self, user: str) -> bool:
+        row = self._connection().execute("SELECT until FROM sticky_user WHERE user = ?", (user,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+
+def _sticky_cookie(headers: dict) -> bool:
+    cookie = headers.get(b"cookie")
+    if cookie is not None:
+        morsel = SimpleCookie(cookie.decode("latin-1")).get(STICKY_COOKIE)
+        if morsel is not None:
+            try:
+                return float(morsel.value) > time.time()
+            except ValueError:
+                return False
+    return False
+
+
+def _user(headers: dict) -> str | None:
+    scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return decode_access_token(token, None)
+    return None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Plain ASGI middleware keeping users that just wrote on the primary.
+
+    Looks the user of the bearer token up in the write log, and reads the sticky
+    cookie of clients without a token, into the request's routing state. Requests
+    that committed a write record their user and set the cookie.
+    """
+
+    def __init__(self, app, write_log: WriteLog | None = None):
+        self.app = app
+        self.write_log = write_log or WriteLog(ReplicaConfig.STATE_PATH)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        user = _user(headers)
+        sticky = _sticky_cookie(headers)
+        if not sticky and user:
+            sticky = await run_in_threadpool(self.write_log.sticky, user)
+        state = RoutingState(sticky=sticky)
+        token = _current_state.set(state)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and state.wrote:
+                until = time.time() + ReplicaConfig.STICKY_SECONDS
+                if user:
+                    # before the response, so the user's next request already sees it
+                    await run_in_threadpool(self.write_log.record, user, until)
+                cookie = (
+                    f"{STICKY_COOKIE}={until:.0f}; Max-Age={ReplicaConfig.STICKY_SECONDS:.0f}; "
+                    "Path=/; HttpOnly; SameSite=Lax"
+                )
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_state.reset(token)
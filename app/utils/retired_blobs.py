@@ -0,0 +1,65 @@
+"""
+Deferred removal of blobs superseded by a copy at another path.
+
+When a file's blob moves to another volume or tier, or new content is stored on
+another volume, the row points at the new path once the transaction commits.
+A download that loaded the row just before still has the old path and has not
+necessarily opened it yet, an offloaded one is only opened by the web server
+after the response. The old blob is therefore recorded in retired_blob in the
+same transaction and only removed by sweep_retired_blobs once it is older than
+StorageConfig.RETIRED_GRACE_SECONDS; a rolled back move leaves nothing behind.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from config import StorageConfig
+from models.postgres_models import RetiredBlob
+
+from .background import exclusive_session
+from .metrics import RETIRED_BLOBS_REMOVED
+
+RETIRED_SWEEP_LOCK = 0x72746264
+SWEEP_BATCH_SIZE = 500
+
+
+def retire_blob(db: Session, path: str):
+    """Schedules the removal of a blob, committed together with the row that stops referencing it."""
+    db.execute(insert(RetiredBlob).values(path=path, retired_at=datetime.now()).on_conflict_do_nothing())
+
+
+def sweep_retired_blobs(db: Session, now: datetime | None = None) -> int:
+    """
+    Removes the blobs retired more than StorageConfig.RETIRED_GRACE_SECONDS ago.
+
+    Returns:
+        int: The number of removed blobs.
+    """
+    cutoff = (now or datetime.now()) - timedelta(seconds=StorageConfig.RETIRED_GRACE_SECONDS)
+    removed = 0
+    while True:
+        expired = select(RetiredBlob.path).where(RetiredBlob.retired_at < cutoff).limit(SWEEP_BATCH_SIZE)
+        paths = db.execute(
+            delete(RetiredBlob).where(RetiredBlob.path.in_(expired)).returning(RetiredBlob.path)
+        ).scalars().all()
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        db.commit()
+        removed += len(paths)
+        RETIRED_BLOBS_REMOVED.inc(len(paths))
+        if len(paths) < SWEEP_BATCH_SIZE:
+            return removed
+
+
+def remove_retired_blobs() -> int:
+    """Background job removing retired blobs after their grace period."""
+    with exclusive_session(RETIRED_SWEEP_LOCK) as db:
+        if db is None:
+            return 0
+        return sweep_retired_blobs(db)
@@ -0,0 +1,173 @@
+import os
+import mimetypes
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from config import DownloadConfig
+
+from .metrics import STORAGE_COMPRESSION_SAVED_BYTES
+from .storage import VOLUMES, iter_blob, volume_of
+
+X_ACCEL_REDIRECT = "x-accel-redirect"
+X_SENDFILE = "x-sendfile"
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def offload_response(
+    path: str, filename: str, media_type: str | None = None, root: str | None = None
+) -> Response | None:
+    """
+    Builds a header-only response that hands the actual transfer to the web server.
+
+    With "x-accel-redirect" nginx serves the file from an `internal` location
+    mapped onto the storage root, with "x-sendfile" the server opens the absolute path itself.
+    Volumes after the first are mapped below the prefix by their name.
+
+    Args:
+        path (str): Location of the file on disk.
+        filename (str): Name the client should save the file as.
+        media_type (str | None): Content type of the file. Guessed from the filename if not given.
+        root (str | None): Storage root the internal location is mapped onto. Defaults to
+            the volume the file lives on.
+
+    Returns:
+        Response | None: The offload response, or None if offloading is disabled
+        or the file lives outside the storage root.
+    """
+    mode = DownloadConfig.OFFLOAD_MODE
+    if mode not in (X_ACCEL_REDIRECT, X_SENDFILE):
+        return None
+    prefix = DownloadConfig.OFFLOAD_PREFIX.rstrip("/")
+    if root is None:
+        volume = volume_of(path)
+        root = volume.path
+        if volume != VOLUMES[0]:
+            prefix = f"{prefix}/{quote(volume.name)}"
+    relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    if relative_path.startswith(os.pardir):
+        return None
+
+    if mode == X_ACCEL_REDIRECT:
+        target = f"{prefix}/{quote(relative_path.replace(os.sep, '/'))}"
+        header = "X-Accel-Redirect"
+    else:
+        target = os.path.abspath(path)
+        header = "X-Sendfile"
+
+    return Response(
+        media_type=media_type or mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        headers={
+            header: target,
+            "Content-Disposition": content_disposition(filename),
+        },
+    )
+
+
+def file_response(
+    path: str, filename: str, media_type: str | None = None, root: str | None = None
+) -> Response:
+    """
+    Returns the file either through the configured web server offload or streamed by python.
+    """
+    response = offload_response(path, filename, media_type, root)
+    if response is None:
+        response = FileResponse(path, filename=filename, media_type=media_type)
+    return response
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single-range `Range: bytes=...` header into a [start, end) pair.
+
+    Returns:
+        tuple[int, int] | None: The requested range, or None to send the whole file
+        (no header, or several ranges which are not supported).
+
+    Raises:
+        HTTPException: 416 if the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            start = max(size - int(last), 0)
+            end = size
+    except ValueError:
+        return None
+    end = min(end, size)
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def stored_file_response(request: Request, file) -> tuple[Response, str]:
+    """
+    Builds the download response for a stored file, taking compression at rest into account.
+
+    Uncompressed files are offloaded or streamed by FileResponse. Compressed files are
+    passed through as-is with `Content-Encoding` when the client accepts the encoding and
+    did not ask for a range, otherwise the requested range is decompressed as a stream.
+
+    Args:
+        request (Request): The download request.
+        file (FileMetadata): Metadata of the file to send.
+
+    Returns:
+        tuple[Response, str]: The response and how it is served, for metrics.
+    """
+    if not file.compression:
+        response = file_response(file.storage_location, filename=file.file_name)
+        return response, "python" if isinstance(response, FileResponse) else "offload"
+
+    media_type = mimetypes.guess_type(file.file_name)[0] or "application/octet-stream"
+    byte_range = parse_range(request.headers.get("range"), file.file_size)
+    if byte_range is None and accepts_encoding(request, file.compression):
+        STORAGE_COMPRESSION_SAVED_BYTES.labels("read").inc(file.file_size - file.stored_size)
+        response = FileResponse(
+            file.storage_location,
+            filename=file.file_name,
+            media_type=media_type,
+            headers={"Content-Encoding": file.compression, "Vary": "Accept-Encoding"},
+        )
+        return response, f"{file.compression}_passthrough"
+
+    start, end = byte_range or (0, file.file_size)
+    headers = {
+        "Content-Disposition": content_disposition(file.file_name),
+        "Content-Length": str(end - start),
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{file.file_size}"
+    response = StreamingResponse(
+        iter_blob(file.storage_location, file.compression, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        media_type=media_type,
+        headers=headers,
+    )
+    return response, f"{file.compression}_decompress"
@@ -0,0 +1,214 @@
+import heapq
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import SQLProfilingConfig
+
+from .metrics import (
+    DB_QUERIES_PER_REQUEST,
+    DB_QUERY_BUDGET_EXCEEDED,
+    DB_TIME_PER_REQUEST,
+    UNMATCHED_ROUTE,
+)
+
+logger = logging.getLogger("sql_profiler")
+
+# collapses expanded IN lists so selectin loads of different sizes count as one statement
+_IN_LIST = re.compile(r"\bIN \([^()]*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in strict mode when a request goes over the query budget or looks like an N+1."""
+
+
+@dataclass
+class QueryStats:
+    route: str = UNMATCHED_ROUTE
+    count: int = 0
+    total_time: float = 0.0
+    slowest: list[tuple[float, str]] = field(default_factory=list)
+    statements: Counter = field(default_factory=Counter)
+    scope: dict | None = field(default=None, repr=False)
+
+    def current_route(self) -> str:
+        if self.scope is not None:
+            return getattr(self.scope.get("route"), "path", self.route)
+        return self.route
+
+    def record(self, statement: str, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        normalized = normalize_statement(statement)
+        self.statements[normalized] += 1
+
+        entry = (elapsed, normalized)
+        if len(self.slowest) < SQLProfilingConfig.SLOWEST_STATEMENTS:
+            heapq.heappush(self.slowest, entry)
+        elif SQLProfilingConfig.SLOWEST_STATEMENTS:
+            heapq.heappushpop(self.slowest, entry)
+
+        if SQLProfilingConfig.STRICT:
+            problem = self.problems()
+            if problem:
+                raise QueryBudgetExceeded(f"{self.current_route()}: {problem}")
+
+    def repeated_statements(self) -> list[tuple[str, int]]:
+        return [
+            (statement, executions)
+            for statement, executions in self.statements.items()
+            if executions >= SQLProfilingConfig.N_PLUS_ONE_THRESHOLD
+        ]
+
+    def problems(self) -> str | None:
+        if self.count > SQLProfilingConfig.QUERY_BUDGET:
+            return f"{self.count} statements exceed the budget of {SQLProfilingConfig.QUERY_BUDGET}"
+        repeated = self.repeated_statements()
+        if repeated:
+            statement, executions = repeated[0]
+            return f"possible N+1, executed {executions} times: {statement[:200]}"
+        return None
+
+
+_current_stats: ContextVar[QueryStats | None] = ContextVar("sql_query_stats", default=None)
+
+
+def normalize_statement(statement: str) -> str:
+    return _WHITESPACE.sub(" ", _IN_LIST.sub("IN (...)", statement)).strip()
+
+
+def install_query_profiler(engine: Engine):
+    """
+    Registers cursor execution hooks that attribute every statement to the current request.
+
+    Statements issued outside a request (startup, background jobs) are not recorded.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start_time"].pop()
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.record(statement, time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_time"):
+            connection.info["query_start_time"].pop()
+
+
+@contextmanager
+def capture_queries(route: str = UNMATCHED_ROUTE):
+    """
+    Records the statements issued inside the block, independent of any request.
+
+    Meant for tests and benchmarks, e.g. to compare the query count of an
+    endpoint for a folder with 10 and with 1000 files.
+
+    Yields:
+        QueryStats: The statistics collected so far.
+    """
+    stats = QueryStats(route=route)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def assert_constant_query_count(counts: dict[int, int]):
+    """
+    Fails when the number of statements grows with the size of the result.
+
+    Args:
+        counts (dict[int, int]): Statements issued, keyed by the number of rows in the result.
+
+    Raises:
+        QueryBudgetExceeded: If a larger result issued more statements than a smaller one.
+    """
+    sizes = sorted(counts)
+    for smaller, larger in zip(sizes, sizes[1:]):
+        if counts[larger] > counts[smaller]:
+            raise QueryBudgetExceeded(
+                f"query count grows with result size: {counts[smaller]} statements for "
+                f"{smaller} rows but {counts[larger]} for {larger} rows"
+            )
+
+
+class QueryProfilerMiddleware:
+    """
+    Plain ASGI middleware collecting per-request query count, total DB time and the slowest statements.
+
+    The totals are exported as metrics, added as a Server-Timing header when enabled, and requests over
+    the query budget or repeating a statement N+1 style are logged with their slowest statements.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(scope=scope)
+        token = _current_stats.set(stats)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and SQLProfilingConfig.SERVER_TIMING:
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (
+                        b"server-timing",
+                        f'db;dur={stats.total_time * 1000:.1f};desc="{stats.count} queries"'.encode(),
+                    )
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_stats.reset(token)
+            route = stats.route = stats.current_route()
+            DB_QUERIES_PER_REQUEST.labels(route).observe(stats.count)
+            DB_TIME_PER_REQUEST.labels(route).observe(stats.total_time)
+            self._report(scope, stats)
+
+    def _report(self, scope, stats: QueryStats):
+        reasons = []
+        if stats.count > SQLProfilingConfig.QUERY_BUDGET:
+            reasons.append("budget")
+        if stats.repeated_statements():
+            reasons.append("n_plus_one")
+        if not reasons:
+            return
+        for reason in reasons:
+            DB_QUERY_BUDGET_EXCEEDED.labels(stats.route, reason).inc()
+        slowest = "; ".join(
+            f"{elapsed * 1000:.1f}ms {statement[:200]}"
+            for elapsed, statement in sorted(stats.slowest, reverse=True)
+        )
+        logger.warning(
+            "%s %s issued %d statements in %.1fms (%s). %s Slowest: %s",
+            scope["method"],
+            stats.route,
+            stats.count,
+            stats.total_time * 1000,
+            ", ".join(reasons),
+            stats.problems() or "",
+            slowest,
+        )
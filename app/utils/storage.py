@@ -0,0 +1,384 @@
+import asyncio
+import errno
+import fcntl
+import hashlib
+import os
+import random
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator
+
+from starlette.concurrency import run_in_threadpool
+
+from config import CopyConfig, StorageConfig
+
+from . import compression
+from .metrics import (
+    BLOB_COPIES,
+    BLOB_PLACEMENTS,
+    STORAGE_COMPRESSION_SAVED_BYTES,
+    STORAGE_LOGICAL_BYTES,
+    STORAGE_STORED_BYTES,
+    VOLUME_FREE_BYTES,
+)
+
+FREE_SPACE = "free_space"
+HASH = "hash"
+# statvfs results are reused for this long when placing blobs
+FREE_SPACE_TTL_SECONDS = 10
+CHUNK_SIZE = 1024 * 1024
+TEMP_SUFFIX = ".part"
+# ioctl cloning a whole file into another (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/xml",
+    "application/javascript",
+    "application/csv",
+    "application/sql",
+    "application/yaml",
+    "application/x-yaml",
+    "image/svg+xml",
+}
+COMPRESSIBLE_EXTENSIONS = {
+    ".txt", ".csv", ".tsv", ".log", ".json", ".ndjson", ".xml", ".md",
+    ".yaml", ".yml", ".sql", ".html", ".htm", ".css", ".js", ".svg",
+}
+
+
+@dataclass
+class StagedBlob:
+    temp_path: str
+    size: int
+    stored_size: int
+    compression: str | None = None
+
+
+@dataclass(frozen=True)
+class Volume:
+    name: str
+    path: str
+    draining: bool = False
+
+
+VOLUMES = [
+    Volume(name, path, name in StorageConfig.DRAIN_VOLUMES) for name, path in StorageConfig.VOLUMES
+]
+# the volume of the version chunk store and of blobs stored before there were several volumes
+UPLOAD_FOLDER = VOLUMES[0].path
+
+_free_space: dict[str, tuple[float, int, int]] = {}
+
+
+def volume_of(path: str) -> Volume:
+    """Returns the volume a stored blob lives on, the first volume for paths outside all of them."""
+    path = os.path.abspath(path)
+    matches = [
+        volume for volume in VOLUMES
+        if path.startswith(os.path.join(os.path.abspath(volume.path), ""))
+    ]
+    return max(matches, key=lambda volume: len(volume.path), default=VOLUMES[0])
+
+
+def volume_space(volume: Volume, max_age: float = FREE_SPACE_TTL_SECONDS) -> tuple[int, int]:
+    """Returns the free and total bytes of a volume, cached for `max_age` seconds."""
+    checked, free, total = _free_space.get(volume.name, (0.0, 0, 0))
+    if time.monotonic() - checked > max_age:
+        os.makedirs(volume.path, exist_ok=True)
+        stats = os.statvfs(volume.path)
+        free, total = stats.f_bavail * stats.f_frsize, stats.f_blocks * stats.f_frsize
+        _free_space[volume.name] = (time.monotonic(), free, total)
+        VOLUME_FREE_BYTES.labels(volume.name).set(free)
+    return free, total
+
+
+def writable_volumes(exclude: Volume | None = None) -> list[Volume]:
+    """Volumes that may get new blobs: not draining and above the free space minimum, if any is."""
+    active = [volume for volume in VOLUMES if not volume.draining and volume != exclude]
+    if not active:
+        return [volume for volume in VOLUMES if volume != exclude] or VOLUMES
+    roomy = [volume for volume in active if volume_space(volume)[0] >= StorageConfig.VOLUME_MIN_FREE_BYTES]
+    return roomy or active
+
+
+def choose_volume(key: str, exclude: Volume | None = None) -> Volume:
+    """
+    Picks the volume for a new blob with the configured placement policy.
+
+    "hash" ranks the volumes by a hash of the volume name and `key` (rendezvous
+    hashing), so only the blobs of a removed volume move. "free_space" picks a
+    random volume weighted by its free bytes, so volumes fill up evenly.
+    """
+    volumes = writable_volumes(exclude)
+    if len(volumes) == 1:
+        volume = volumes[0]
+    elif StorageConfig.PLACEMENT == HASH:
+        volume = max(volumes, key=lambda volume: hashlib.blake2b(f"{volume.name}\0{key}".encode()).digest())
+    else:
+        weights = [volume_space(volume)[0] for volume in volumes]
+        volume = random.choices(volumes, weights)[0] if any(weights) else random.choice(volumes)
+    BLOB_PLACEMENTS.labels(volume.name).inc()
+    return volume
+
+
+def folder_path(user_id, folder_id, volume: Volume | None = None) -> str:
+    return os.path.join((volume or VOLUMES[0]).path, str(user_id), str(folder_id))
+
+
+def blob_directory(user_id, folder_id, file_name: str) -> str:
+    # directory a new blob is staged and stored in, on the volume picked by the placement policy
+    return folder_path(user_id, folder_id, choose_volume(f"{user_id}/{folder_id}/{file_name}"))
+
+
+def should_compress(content_type: str | None, filename: str) -> bool:
+    if StorageConfig.COMPRESSION != compression.ZSTD or not compression.available():
+        return False
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES:
+        return True
+    return os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def _temp_path(directory: str) -> str:
+    # staged next to the final location so the commit is an atomic rename on the same filesystem
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f".{uuid.uuid4().hex}{TEMP_SUFFIX}")
+
+
+def stage_chunks(chunks: Iterable[bytes], directory: str, compress: bool = False) -> StagedBlob:
+    """
+    Writes a stream of chunks to a temporary file in `directory`.
+
+    Args:
+        chunks (Iterable[bytes]): The uncompressed content.
+        directory (str): Directory the blob will be committed to.
+        compress (bool): Whether to store the content zstd compressed.
+
+    Returns:
+        StagedBlob: The staged blob, to be passed to commit_blob or discard.
+    """
+    temp_path = _temp_path(directory)
+    try:
+        with open(temp_path, "wb") as f:
+            if compress:
+                writer = compression.SeekableWriter(f, level=StorageConfig.COMPRESSION_LEVEL)
+                for chunk in chunks:
+                    writer.write(chunk)
+                writer.close()
+                return StagedBlob(temp_path, writer.size, writer.stored_size, compression.ZSTD)
+            size = 0
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+            return StagedBlob(temp_path, size, size)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _read_chunks(fileobj: BinaryIO) -> Iterator[bytes]:
+    while chunk := fileobj.read(CHUNK_SIZE):
+        yield chunk
+
+
+def stage_file(fileobj: BinaryIO, directory: str, compress: bool = False) -> StagedBlob:
+    """
+    Stages a seekable file, e.g. the spooled file behind an UploadFile.
+
+    Compressed content that did not get smaller is staged again uncompressed.
+    """
+    staged = stage_chunks(_read_chunks(fileobj), directory, compress)
+    if staged.compression and staged.stored_size >= staged.size:
+        discard(staged)
+        fileobj.seek(0)
+        staged = stage_chunks(_read_chunks(fileobj), directory)
+    return staged
+
+
+async def stage_uploads(
+    files: list, directories: list[str], concurrency: int = StorageConfig.UPLOAD_CONCURRENCY
+) -> list[StagedBlob]:
+    """
+    Stages the files of one upload request in the threadpool, at most
+    `concurrency` of them at a time.
+
+    Either all files are staged or, if one fails, none: the others are discarded
+    and the error is raised.
+
+    Args:
+        files (list[UploadFile]): The uploaded files.
+        directories (list[str]): Directory every file will be committed to.
+        concurrency (int): Files written at the same time.
+
+    Returns:
+        list[StagedBlob]: The staged blobs, in the order of `files`.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def stage(file, directory) -> StagedBlob:
+        async with semaphore:
+            return await run_in_threadpool(
+                stage_file, file.file, directory, should_compress(file.content_type, file.filename)
+            )
+
+    results = await asyncio.gather(*(stage(file, directory) for file, directory in zip(files, directories)), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for result in results:
+            if isinstance(result, StagedBlob):
+                discard(result)
+        raise errors[0]
+    return results
+
+
+def commit_blob(staged: StagedBlob, final_path: str):
+    os.replace(staged.temp_path, final_path)
+    label = staged.compression or "none"
+    STORAGE_LOGICAL_BYTES.labels(label).inc(staged.size)
+    STORAGE_STORED_BYTES.labels(label).inc(staged.stored_size)
+    if staged.compression:
+        STORAGE_COMPRESSION_SAVED_BYTES.labels("write").inc(staged.size - staged.stored_size)
+
+
+def discard(staged: StagedBlob):
+    if os.path.exists(staged.temp_path):
+        os.remove(staged.temp_path)
+
+
+class BlobBatch:
+    """
+    Commits several staged blobs as one unit.
+
+    Blobs that get replaced are kept as hard links until the batch is finished,
+    so rolling back after a failed database commit puts every path back the way
+    it was: new blobs are removed and replaced ones restored. Blobs superseded
+    by a blob at another path are retired in the database transaction instead,
+    see utils/retired_blobs.py.
+    """
+
+    def __init__(self):
+        self.pending: list[tuple[StagedBlob, str]] = []
+        self.committed: list[tuple[str, str | None]] = []
+
+    def add(self, staged: StagedBlob, final_path: str):
+        self.pending.append((staged, final_path))
+
+    def commit(self):
+        while self.pending:
+            staged, final_path = self.pending[0]
+            backup = None
+            if os.path.exists(final_path):
+                backup = _temp_path(os.path.dirname(final_path))
+                os.link(final_path, backup)
+            self.committed.append((final_path, backup))
+            commit_blob(staged, final_path)
+            self.pending.pop(0)
+
+    def finish(self):
+        for _, backup in self.committed:
+            if backup:
+                os.remove(backup)
+        self.committed = []
+
+    def rollback(self):
+        for final_path, backup in reversed(self.committed):
+            if backup:
+                os.replace(backup, final_path)
+            elif os.path.exists(final_path):
+                os.remove(final_path)
+        for staged, _ in self.pending:
+            discard(staged)
+        self.committed = []
+        self.pending = []
+
+
+def _reflink(source: str, destination: str) -> bool:
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as exc:
+            if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+
+
+def _copy_range(source: str, destination: str):
+    # copy_file_range stays in the kernel and may still share extents (NFS, CIFS)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), CHUNK_SIZE * 64):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            dst.seek(0)
+            dst.truncate()
+            src.seek(0)
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def clone_blob(source: str, destination: str, hardlink: bool = CopyConfig.HARDLINKS) -> str:
+    """
+    Copies a stored blob with the cheapest primitive the filesystem supports.
+
+    Tries a reflink, then a hard link, then copy_file_range. Hard links are safe
+    because blobs are only ever replaced by renaming a new file over them.
+
+    Returns:
+        str: The primitive used, "reflink", "hardlink" or "copy".
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.exists(destination):
+        raise FileExistsError(destination)
+    temp_path = _temp_path(os.path.dirname(destination))
+    try:
+        if _reflink(source, temp_path):
+            method = "reflink"
+        elif hardlink:
+            os.remove(temp_path)
+            try:
+                os.link(source, destination)
+                BLOB_COPIES.labels("hardlink").inc()
+                return "hardlink"
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+            _copy_range(source, temp_path)
+            method = "copy"
+        else:
+            _copy_range(source, temp_path)
+            method = "copy"
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    BLOB_COPIES.labels(method).inc()
+    return method
+
+
+def iter_blob(
+    path: str, blob_compression: str | None, start: int = 0, end: int | None = None
+) -> Iterator[bytes]:
+    """
+    Yields the uncompressed content of a stored blob in [start, end).
+    """
+    if blob_compression == compression.ZSTD:
+        yield from compression.SeekableReader(path).iter_range(start, end)
+        return
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
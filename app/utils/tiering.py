@@ -0,0 +1,228 @@
+"""
+Access tracking and the cold storage tier.
+
+Downloads only note the file id and time in the worker's memory, a background
+job writes them to last_accessed_at with one UPDATE per flush. Files neither
+downloaded nor changed for TieringConfig.COLD_AFTER_DAYS are moved to the cold
+tier directory, zstd compressed when that makes them smaller, and storage_tier
+records where they are. A cold file is still served from the cold tier; its
+download moves it back onto a hot volume afterwards, so clients never notice.
+
+Moves follow the rebalancing job: the blob is written first and the row only
+switched over if the file did not get new content meanwhile. The old blob is
+retired and removed after a grace period, a burst of downloads of a cold file
+triggers its promotion while the other downloads still read the cold copy.
+"""
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, text, update
+from sqlalchemy.orm import Session
+
+from config import TieringConfig
+from database import engine
+from models.postgres_models import FileMetadata
+
+from . import compression
+from .background import exclusive_session
+from .metrics import ACCESS_TIMES_WRITTEN, TIER_MOVES
+from .retired_blobs import retire_blob
+from .storage import (
+    StagedBlob,
+    blob_directory,
+    commit_blob,
+    discard,
+    iter_blob,
+    should_compress,
+    stage_chunks,
+    volume_of,
+)
+from .trash import Throttle
+
+HOT = "hot"
+COLD = "cold"
+
+TIERING_LOCK = 0x74696572
+
+_accessed: dict = {}
+_accessed_lock = threading.Lock()
+# cold files being promoted by this worker, a burst of downloads promotes them once
+_promoting: set = set()
+
+
+def record_access(user_id, file_id):
+    with _accessed_lock:
+        _accessed[user_id, file_id] = datetime.now()
+
+
+def flush_access_times() -> int:
+    """
+    Writes the access times recorded since the last flush with one UPDATE.
+
+    Returns:
+        int: The number of files whose access time was written.
+    """
+    with _accessed_lock:
+        accessed = dict(_accessed)
+        _accessed.clear()
+    if not accessed:
+        return 0
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    "UPDATE file_metadata SET last_accessed_at = GREATEST(last_accessed_at, accessed.at) "
+                    "FROM unnest(CAST(:user_ids AS uuid[]), CAST(:file_ids AS uuid[]), CAST(:accessed_at AS timestamp[])) "
+                    "AS accessed(user_id, file_id, at) "
+                    "WHERE file_metadata.user_id = accessed.user_id AND file_metadata.file_id = accessed.file_id"
+                ),
+                {
+                    "user_ids": [str(user_id) for user_id, _ in accessed],
+                    "file_ids": [str(file_id) for _, file_id in accessed],
+                    "accessed_at": list(accessed.values()),
+                },
+            )
+    except Exception:
+        # kept for the next flush, accesses recorded meanwhile are newer
+        with _accessed_lock:
+            for key, accessed_at in accessed.items():
+                _accessed.setdefault(key, accessed_at)
+        raise
+    ACCESS_TIMES_WRITTEN.inc(len(accessed))
+    return len(accessed)
+
+
+def _free_path(path: str) -> str:
+    if os.path.exists(path):
+        return os.path.join(os.path.dirname(path), f"{uuid.uuid4()}-{os.path.basename(path)}")
+    return path
+
+
+def _stage(file, directory: str, compress: bool) -> StagedBlob:
+    staged = stage_chunks(iter_blob(file.storage_location, file.compression), directory, compress)
+    if staged.compression and staged.stored_size >= staged.size:
+        discard(staged)
+        staged = stage_chunks(iter_blob(file.storage_location, file.compression), directory)
+    return staged
+
+
+def _relocate(db: Session, file, staged: StagedBlob, target: str, tier: str) -> bool:
+    # read before the commit expires an ORM instance
+    source = file.storage_location
+    current = db.execute(
+        select(FileMetadata.version, FileMetadata.storage_location)
+        .where(FileMetadata.user_id == file.user_id, FileMetadata.file_id == file.file_id)
+        .with_for_update()
+    ).first()
+    if current is None or (current.version, current.storage_location) != (file.version, source):
+        db.rollback()
+        discard(staged)
+        return False
+    commit_blob(staged, target)
+    try:
+        # updated_at stays as it is, the content did not change
+        db.execute(
+            update(FileMetadata)
+            .where(FileMetadata.user_id == file.user_id, FileMetadata.file_id == file.file_id)
+            .values(
+                storage_location=target,
+                storage_tier=tier,
+                compression=staged.compression,
+                stored_size=staged.stored_size,
+            )
+        )
+        retire_blob(db, source)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        os.remove(target)
+        raise
+    return True
+
+
+def demote_file(db: Session, file) -> bool:
+    """
+    Moves a hot file's blob to the cold tier, keeping its path below the volume.
+
+    Args:
+        db (Session): The database session, committed when the blob moved.
+        file: A row with user_id, file_id, version, storage_location and compression.
+
+    Returns:
+        bool: Whether the file moved, False if it changed or vanished meanwhile.
+    """
+    relative_path = os.path.relpath(file.storage_location, volume_of(file.storage_location).path)
+    target = _free_path(os.path.join(TieringConfig.COLD_PATH, relative_path))
+    compress = TieringConfig.COMPRESS and not file.compression and compression.available()
+    try:
+        staged = _stage(file, os.path.dirname(target), compress)
+    except FileNotFoundError:
+        return False
+    return _relocate(db, file, staged, target, COLD)
+
+
+def promote_file(user_id, file_id):
+    """
+    Moves a cold file back onto the hot volume the placement policy picks.
+
+    Runs after the download of a cold file, the content is stored the way a
+    new upload would be.
+    """
+    with _accessed_lock:
+        if file_id in _promoting:
+            return
+        _promoting.add(file_id)
+    try:
+        with Session(engine) as db:
+            file = db.get(FileMetadata, {"user_id": user_id, "file_id": file_id})
+            if file is None or file.storage_tier != COLD:
+                return
+            directory = blob_directory(file.user_id, file.folder_id, file.file_name)
+            staged = _stage(file, directory, should_compress(file.file_type, file.file_name))
+            if _relocate(db, file, staged, _free_path(os.path.join(directory, file.file_name)), HOT):
+                TIER_MOVES.labels("promote").inc()
+    finally:
+        with _accessed_lock:
+            _promoting.discard(file_id)
+
+
+def demote_cold_files():
+    """Background job moving files not downloaded or changed for COLD_AFTER_DAYS to the cold tier."""
+    if not TieringConfig.COLD_PATH or TieringConfig.COLD_AFTER_DAYS <= 0:
+        return
+    with exclusive_session(TIERING_LOCK) as db:
+        if db is None:
+            return
+        cutoff = datetime.now() - timedelta(days=TieringConfig.COLD_AFTER_DAYS)
+        throttle = Throttle(TieringConfig.FILES_PER_SECOND, TieringConfig.MB_PER_SECOND * 1024 * 1024)
+        skipped = set()
+        while True:
+            query = select(
+                FileMetadata.user_id,
+                FileMetadata.file_id,
+                FileMetadata.version,
+                FileMetadata.storage_location,
+                FileMetadata.compression,
+                FileMetadata.stored_size,
+            ).where(
+                FileMetadata.storage_tier == HOT,
+                or_(
+                    FileMetadata.last_accessed_at < cutoff,
+                    and_(FileMetadata.last_accessed_at == None, FileMetadata.updated_at < cutoff),
+                ),
+                FileMetadata.updated_at < cutoff,
+            )
+            if skipped:
+                query = query.where(FileMetadata.file_id.not_in(skipped))
+            rows = db.execute(query.limit(TieringConfig.BATCH_SIZE)).all()
+            db.commit()
+            if not rows:
+                return
+            for row in rows:
+                if demote_file(db, row):
+                    TIER_MOVES.labels("demote").inc()
+                else:
+                    skipped.add(row.file_id)
+                throttle.wait(row.stored_size or 0)
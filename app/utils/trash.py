@@ -0,0 +1,192 @@
+"""
+Permanent deletion of trashed files and folders.
+
+Used by the empty trash endpoint and by the scheduled purge of trash older than
+TrashConfig.RETENTION_DAYS. Rows are deleted in batches walking the partial
+trashed_at indexes, and blobs are only removed after their rows are committed,
+so a failure leaves orphaned files behind rather than rows without content.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, text, tuple_
+from sqlalchemy.orm import Session
+
+from config import TrashConfig
+from models.postgres_models import FileMetadata
+
+from .background import exclusive_session
+from .metrics import TRASH_PURGED, TRASH_PURGED_BYTES
+from .storage import VOLUMES, folder_path
+from .versions import release_file_versions
+
+# held by the worker running the scheduled purge
+TRASH_PURGE_LOCK = 0x74727368
+
+
+class Throttle:
+    """Spaces out deletions to stay below a files and bytes per second budget."""
+
+    def __init__(self, files_per_second: float = 0, bytes_per_second: float = 0):
+        self.files_per_second = files_per_second
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+
+    def wait(self, size: int):
+        self.files += 1
+        self.bytes += size
+        target = max(
+            self.files / self.files_per_second if self.files_per_second else 0,
+            self.bytes / self.bytes_per_second if self.bytes_per_second else 0,
+        )
+        delay = target - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def purge_trashed_files(
+    db: Session,
+    user_id=None,
+    before: datetime | None = None,
+    batch_size: int = TrashConfig.PURGE_BATCH_SIZE,
+    throttle: Throttle | None = None,
+    trigger: str = "user",
+) -> int:
+    """
+    Deletes trashed files, their versions and blobs.
+
+    Args:
+        db (Session): The database session, committed after every batch.
+        user_id (UUID | None): Only purge the trash of this user.
+        before (datetime | None): Only purge files trashed before this time.
+        batch_size (int): Files deleted per transaction.
+        throttle (Throttle | None): Limits the rate blobs are removed at.
+        trigger (str): Metrics label, "user" or "schedule".
+
+    Returns:
+        int: The number of purged files.
+    """
+    filters = [FileMetadata.is_trashed == True]
+    if user_id is not None:
+        filters.append(FileMetadata.user_id == user_id)
+    if before is not None:
+        filters.append(FileMetadata.trashed_at < before)
+
+    purged = 0
+    while True:
+        # files being restored are locked and skipped, and the filters are checked again on
+        # delete, so a file restored since it was selected is never purged
+        batch = (
+            select(FileMetadata.user_id, FileMetadata.file_id)
+            .where(*filters)
+            .order_by(FileMetadata.trashed_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        files = db.execute(
+            delete(FileMetadata)
+            .where(tuple_(FileMetadata.user_id, FileMetadata.file_id).in_(batch), *filters)
+            .returning(
+                FileMetadata.file_id,
+                FileMetadata.storage_location,
+                FileMetadata.stored_size,
+                FileMetadata.file_size,
+            )
+            .execution_options(synchronize_session=False)
+        ).all()
+        if not files:
+            db.commit()
+            return purged
+
+        blobs = [(file.storage_location, file.stored_size or file.file_size) for file in files]
+        release_file_versions(db, [file.file_id for file in files])
+        db.commit()
+
+        for path, size in blobs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            TRASH_PURGED_BYTES.labels(trigger).inc(size)
+            if throttle:
+                throttle.wait(size)
+        TRASH_PURGED.labels("file", trigger).inc(len(files))
+        purged += len(files)
+
+
+def purge_trashed_folders(
+    db: Session,
+    user_id=None,
+    before: datetime | None = None,
+    batch_size: int = TrashConfig.PURGE_BATCH_SIZE,
+    throttle: Throttle | None = None,
+    trigger: str = "user",
+) -> int:
+    """
+    Deletes trashed folders that no longer contain files or subfolders.
+
+    Trees are removed leaves first, one level per batch. Folders still holding a
+    file that was restored on its own, and root folders, are kept.
+
+    Returns:
+        int: The number of purged folders.
+    """
+    filters = ""
+    params = {"limit": batch_size}
+    if user_id is not None:
+        filters += " AND folder.user_id = :user_id"
+        params["user_id"] = user_id
+    if before is not None:
+        filters += " AND folder.trashed_at < :before"
+        params["before"] = before
+
+    purged = 0
+    while True:
+        rows = db.execute(
+            text(
+                "DELETE FROM folder WHERE (user_id, folder_id) IN ("
+                "  SELECT user_id, folder_id FROM folder"
+                "  WHERE folder.is_trashed = true AND folder.parent_folder IS NOT NULL"
+                f"{filters}"
+                "    AND NOT EXISTS (SELECT 1 FROM file_metadata"
+                "      WHERE file_metadata.user_id = folder.user_id AND file_metadata.folder_id = folder.folder_id)"
+                "    AND NOT EXISTS (SELECT 1 FROM folder child WHERE child.user_id = folder.user_id"
+                "      AND child.parent_folder = folder.folder_id AND child.is_trashed = false)"
+                "    AND NOT EXISTS (SELECT 1 FROM folder child WHERE child.user_id = folder.user_id"
+                "      AND child.parent_folder = folder.folder_id AND child.is_trashed = true)"
+                "  ORDER BY folder.trashed_at LIMIT :limit"
+                ") RETURNING folder_id, user_id"
+            ),
+            params,
+        ).all()
+        db.commit()
+        if not rows:
+            return purged
+
+        for folder_id, folder_user_id in rows:
+            for volume in VOLUMES:
+                try:
+                    os.rmdir(folder_path(folder_user_id, folder_id, volume))
+                except OSError:
+                    # never created, or still holds files nothing references
+                    pass
+            if throttle:
+                throttle.wait(0)
+        TRASH_PURGED.labels("folder", trigger).inc(len(rows))
+        purged += len(rows)
+
+
+def purge_expired_trash():
+    """Background job purging trash older than TrashConfig.RETENTION_DAYS."""
+    with exclusive_session(TRASH_PURGE_LOCK) as db:
+        if db is None:
+            return
+        before = datetime.now() - timedelta(days=TrashConfig.RETENTION_DAYS)
+        throttle = Throttle(
+            TrashConfig.PURGE_FILES_PER_SECOND, TrashConfig.PURGE_MB_PER_SECOND * 1024 * 1024
+        )
+        purge_trashed_files(db, before=before, throttle=throttle, trigger="schedule")
+        purge_trashed_folders(db, before=before, throttle=throttle, trigger="schedule")
@@ -0,0 +1,223 @@
+"""
+Storing uploaded files, shared by the folder, tree, archive and delta uploads.
+
+All files of a request are staged concurrently, then committed together: new
+files with one INSERT ... RETURNING, files whose name already exists in the
+folder as a new version of that file. Blobs are renamed into place right before
+the database commit and rolled back with it.
+"""
+import os
+import time
+from uuid import UUID, uuid4
+
+from fastapi import UploadFile
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from config import VersioningConfig
+from models.postgres_models import FileMetadata
+
+from .blob_cache import blob_cache
+from .metrics import UPLOAD_BYTES, UPLOAD_THROUGHPUT
+from .retired_blobs import retire_blob
+from .storage import BlobBatch, StagedBlob, blob_directory, discard, stage_uploads, volume_of
+from .tiering import HOT
+from .versions import archive_version
+
+DETAIL_COLUMNS = (
+    FileMetadata.file_id,
+    FileMetadata.folder_id,
+    FileMetadata.file_name,
+    FileMetadata.file_type,
+    FileMetadata.updated_at,
+)
+
+
+def _details(row) -> dict:
+    return {
+        "file_id": row.file_id,
+        "file_name": row.file_name,
+        "file_type": row.file_type,
+        "updated_at": row.updated_at,
+    }
+
+
+def _blob_path(directory: str, file_name: str) -> str:
+    file_path = os.path.join(directory, file_name)
+    if os.path.exists(file_path):
+        # the name is still taken on disk by a trashed or renamed file
+        file_path = os.path.join(directory, f"{uuid4()}-{file_name}")
+    return file_path
+
+
+def _replace_content(
+    db: Session, blobs: BlobBatch, file_metadata: FileMetadata, content_type: str, staged: StagedBlob
+):
+    # the row must be locked, the replaced blob is archived as a version first
+    if VersioningConfig.ENABLED:
+        archive_version(db, file_metadata)
+    if file_metadata.storage_tier == HOT and volume_of(staged.temp_path) == volume_of(
+        file_metadata.storage_location
+    ):
+        blobs.add(staged, file_metadata.storage_location)
+    else:
+        # the new content was placed on another volume or the file is cold, a rename cannot cross it
+        file_path = _blob_path(os.path.dirname(staged.temp_path), file_metadata.file_name)
+        blobs.add(staged, file_path)
+        retire_blob(db, file_metadata.storage_location)
+        file_metadata.storage_location = file_path
+        file_metadata.storage_tier = HOT
+    file_metadata.file_size = staged.size
+    file_metadata.file_type = content_type
+    file_metadata.compression = staged.compression
+    file_metadata.stored_size = staged.stored_size
+    file_metadata.version += 1
+    file_metadata.update_timestamp()
+    file_metadata.clear_media_attributes()
+
+
+async def store_uploads(db: Session, user_id, uploads: list[tuple[UUID, UploadFile, str]]) -> list[dict]:
+    """
+    Writes uploaded files into folders and commits their metadata.
+
+    Args:
+        db (Session): The database session, committed on success and rolled back on failure.
+        user_id (UUID): Owner of the files and folders.
+        uploads (list[tuple[UUID, UploadFile, str]]): Folder id, file and file name of every upload.
+
+    Returns:
+        list[dict]: Id, name, type and timestamp of the stored files. The last file
+        wins when a name is uploaded to the same folder more than once.
+    """
+    start = time.perf_counter()
+    # Stream the files to disk concurrently, compressed at rest if they are text-like
+    staged_blobs = await stage_uploads(
+        [file for _, file, _ in uploads],
+        [blob_directory(user_id, folder_id, file_name) for folder_id, _, file_name in uploads],
+    )
+    # archiving replaced content reads and hashes the old blobs, off the event loop
+    details = await run_in_threadpool(
+        commit_uploads,
+        db,
+        user_id,
+        [
+            (folder_id, file_name, file.content_type, staged)
+            for (folder_id, file, file_name), staged in zip(uploads, staged_blobs)
+        ],
+    )
+
+    uploaded_bytes = sum(staged.size for staged in staged_blobs)
+    UPLOAD_BYTES.inc(uploaded_bytes)
+    elapsed = time.perf_counter() - start
+    if elapsed > 0:
+        UPLOAD_THROUGHPUT.observe(uploaded_bytes / elapsed)
+    return details
+
+
+def commit_uploads(
+    db: Session, user_id, uploads: list[tuple[UUID, str, str, StagedBlob]]
+) -> list[dict]:
+    """
+    Moves staged blobs into their folders and commits the file rows.
+
+    Args:
+        db (Session): The database session, committed on success and rolled back on failure.
+        user_id (UUID): Owner of the files and folders.
+        uploads (list[tuple[UUID, str, str, StagedBlob]]): Folder id, file name, content type
+            and staged content of every file. All staged blobs are committed or discarded.
+
+    Returns:
+        list[dict]: Id, name, type and timestamp of the stored files.
+    """
+    # uploading a name that already exists in the folder creates a new version of that file
+    existing_files = {}
+    if uploads:
+        for existing in db.query(FileMetadata).filter(
+            FileMetadata.folder_id.in_({folder_id for folder_id, _, _, _ in uploads}),
+            FileMetadata.user_id == user_id,
+            FileMetadata.is_trashed == False,
+            FileMetadata.file_name.in_({file_name for _, file_name, _, _ in uploads}),
+        ).order_by(FileMetadata.file_id).with_for_update():
+            # locked until the commit, so the rebalancing job cannot move a blob that is being replaced
+            existing_files[existing.folder_id, existing.file_name] = existing
+
+    latest = {}
+    for folder_id, file_name, content_type, staged in uploads:
+        if (folder_id, file_name) in latest:
+            discard(latest[folder_id, file_name][1])
+        latest[folder_id, file_name] = (content_type, staged)
+
+    details = {}
+    new_files = []
+    blobs = BlobBatch()
+    try:
+        for (folder_id, file_name), (content_type, staged) in latest.items():
+            file_metadata = existing_files.get((folder_id, file_name))
+            if file_metadata:
+                _replace_content(db, blobs, file_metadata, content_type, staged)
+                details[folder_id, file_name] = _details(file_metadata)
+            else:
+                file_path = _blob_path(os.path.dirname(staged.temp_path), file_name)
+                blobs.add(staged, file_path)
+                new_files.append(
+                    FileMetadata(
+                        file_name=file_name,
+                        file_size=staged.size,
+                        file_type=content_type,
+                        storage_location=file_path,
+                        compression=staged.compression,
+                        stored_size=staged.stored_size,
+                        user_id=user_id,
+                        folder_id=folder_id,
+                    ).model_dump()
+                )
+        if new_files:
+            # one INSERT ... RETURNING for all new files instead of a refresh per row
+            inserted = db.execute(
+                insert(FileMetadata).returning(*DETAIL_COLUMNS, sort_by_parameter_order=True),
+                new_files,
+            )
+            for row in inserted:
+                details[row.folder_id, row.file_name] = _details(row)
+        blobs.commit()
+        db.commit()
+    except BaseException:
+        db.rollback()
+        blobs.rollback()
+        for _, staged in latest.values():
+            discard(staged)
+        raise
+    blobs.finish()
+    for file_metadata in existing_files.values():
+        blob_cache.invalidate(file_metadata.file_id)
+    return [details[key] for key in latest]
+
+
+def commit_new_version(db: Session, file_metadata: FileMetadata, staged: StagedBlob) -> dict:
+    """
+    Makes staged content the new version of an existing file, the way an upload
+    of the same name would.
+
+    Args:
+        db (Session): The database session, committed on success and rolled back on failure.
+        file_metadata (FileMetadata): The file, locked FOR UPDATE by the caller.
+        staged (StagedBlob): The new content, committed or discarded.
+
+    Returns:
+        dict: Id, name, type and timestamp of the file.
+    """
+    blobs = BlobBatch()
+    try:
+        _replace_content(db, blobs, file_metadata, file_metadata.file_type, staged)
+        details = _details(file_metadata)
+        blobs.commit()
+        db.commit()
+    except BaseException:
+        db.rollback()
+        blobs.rollback()
+        discard(staged)
+        raise
+    blobs.finish()
+    blob_cache.invalidate(file_metadata.file_id)
+    return details
@@ -0,0 +1,305 @@
+"""
+File versions kept in a content-addressed, deduplicated chunk store.
+
+The current content of a file stays a plain blob at file.storage_location so
+downloads, offloading and Range requests keep working as before. When a file is
+overwritten its previous content is cut into content-defined chunks which are
+stored once under UPLOADS/.chunks by their sha256 and reference counted, so a
+small edit to a large file only adds the chunks around the edit.
+
+The current content is not chunked, so the first overwrite of a file stores all
+of its previous content in new chunks, next to the new plain blob. Every later
+overwrite only adds the chunks the edit changed. Archiving reads and hashes the
+whole replaced blob, callers run it in the threadpool or a background job.
+
+Chunk files are written under a shared advisory lock and only removed by
+sweep_unreferenced_chunks under the exclusive one, so a chunk being reused by a
+new version can never be deleted underneath it.
+"""
+import hashlib
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from config import StorageConfig, VersioningConfig
+from models.postgres_models import Chunk, FileMetadata, FileVersion
+
+from . import compression
+from .background import exclusive_session
+from .chunking import chunk_stream
+from .metrics import VERSION_ARCHIVED_BYTES, VERSION_CHUNKS_SWEPT, VERSIONS_PRUNED
+from .storage import UPLOAD_FOLDER, iter_blob
+
+CHUNK_FOLDER = os.path.join(UPLOAD_FOLDER, ".chunks")
+# pg advisory lock key guarding chunk files against the sweeper
+CHUNK_STORE_LOCK = 0x636B7374
+# held by the worker running the scheduled pruning
+VERSION_PRUNE_LOCK = 0x70727576
+PRUNE_BATCH_SIZE = 500
+
+
+def chunk_path(chunk_hash: str, chunk_compression: str | None = None) -> str:
+    name = chunk_hash + (".zst" if chunk_compression == compression.ZSTD else "")
+    return os.path.join(CHUNK_FOLDER, chunk_hash[:2], chunk_hash[2:4], name)
+
+
+def lock_chunk_store(db: Session, exclusive: bool = False):
+    """Takes the chunk store lock until the end of the current transaction."""
+    function = "pg_advisory_xact_lock" if exclusive else "pg_advisory_xact_lock_shared"
+    db.execute(text(f"SELECT {function}(:key)"), {"key": CHUNK_STORE_LOCK})
+
+
+def _store_chunk(chunk_hash: str, data: bytes) -> dict:
+    """Writes a chunk file unless it exists already and returns its chunk row."""
+    for chunk_compression in (compression.ZSTD, None):
+        path = chunk_path(chunk_hash, chunk_compression)
+        if os.path.exists(path):
+            return {
+                "chunk_hash": chunk_hash,
+                "size": len(data),
+                "stored_size": os.path.getsize(path),
+                "compression": chunk_compression,
+                "written": False,
+            }
+
+    chunk_compression = None
+    stored = data
+    if StorageConfig.COMPRESSION == compression.ZSTD and compression.available():
+        compressed = compression.compress(data, StorageConfig.COMPRESSION_LEVEL)
+        if len(compressed) < len(data):
+            chunk_compression, stored = compression.ZSTD, compressed
+
+    path = chunk_path(chunk_hash, chunk_compression)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.part"
+    with open(temp_path, "wb") as f:
+        f.write(stored)
+    os.replace(temp_path, path)
+    return {
+        "chunk_hash": chunk_hash,
+        "size": len(data),
+        "stored_size": len(stored),
+        "compression": chunk_compression,
+        "written": True,
+    }
+
+
+def _add_references(db: Session, rows: dict, references: Counter):
+    statement = insert(Chunk).values(
+        [
+            {
+                "chunk_hash": chunk_hash,
+                "size": rows[chunk_hash]["size"],
+                "stored_size": rows[chunk_hash]["stored_size"],
+                "compression": rows[chunk_hash]["compression"],
+                "ref_count": references[chunk_hash],
+            }
+            # sorted so concurrent writers lock the rows in the same order
+            for chunk_hash in sorted(references)
+        ]
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Chunk.chunk_hash],
+            set_={"ref_count": Chunk.__table__.c.ref_count + statement.excluded.ref_count},
+        )
+    )
+
+
+def _release_references(db: Session, references: Counter):
+    hashes = sorted(references)
+    db.execute(
+        text(
+            "SELECT chunk_hash FROM chunk WHERE chunk_hash = ANY(:hashes) "
+            "ORDER BY chunk_hash FOR UPDATE"
+        ),
+        {"hashes": hashes},
+    )
+    db.execute(
+        text(
+            "UPDATE chunk SET ref_count = chunk.ref_count - released.refs "
+            "FROM unnest(CAST(:hashes AS varchar[]), CAST(:refs AS integer[])) AS released(chunk_hash, refs) "
+            "WHERE chunk.chunk_hash = released.chunk_hash"
+        ),
+        {"hashes": hashes, "refs": [references[chunk_hash] for chunk_hash in hashes]},
+    )
+
+
+def archive_version(db: Session, file: FileMetadata) -> FileVersion:
+    """
+    Stores the current content of a file as a version in the chunk store.
+
+    Has to run before the blob at file.storage_location is replaced. The version
+    row is added to the session and committed together with the new content.
+
+    Args:
+        db (Session): The database session, the chunk store lock is held until it commits.
+        file (FileMetadata): The file whose current content is archived.
+
+    Returns:
+        FileVersion: The archived version.
+    """
+    lock_chunk_store(db)
+    manifest = []
+    rows = {}
+    for data in chunk_stream(iter_blob(file.storage_location, file.compression)):
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        manifest.append(chunk_hash)
+        if chunk_hash in rows:
+            VERSION_ARCHIVED_BYTES.labels("deduplicated").inc(len(data))
+            continue
+        rows[chunk_hash] = _store_chunk(chunk_hash, data)
+        VERSION_ARCHIVED_BYTES.labels("new" if rows[chunk_hash]["written"] else "deduplicated").inc(len(data))
+    if manifest:
+        _add_references(db, rows, Counter(manifest))
+
+    version = FileVersion(
+        file_id=file.file_id,
+        version_number=file.version,
+        file_size=file.file_size,
+        file_type=file.file_type,
+        chunks=manifest,
+        created_at=file.updated_at,
+    )
+    db.add(version)
+    return version
+
+
+def release_versions(db: Session, versions: list[FileVersion]):
+    """
+    Deletes versions and drops their chunk references.
+
+    Chunks left without references are removed later by sweep_unreferenced_chunks.
+    """
+    references = Counter(chunk_hash for version in versions for chunk_hash in version.chunks)
+    if references:
+        _release_references(db, references)
+    for version in versions:
+        db.delete(version)
+    # no relationship orders these deletes before the file rows referencing versions are deleted
+    db.flush()
+
+
+def release_file_versions(db: Session, file_ids: list):
+    """Releases all versions of files that are about to be deleted."""
+    if not file_ids:
+        return
+    versions = db.query(FileVersion).filter(FileVersion.file_id.in_(file_ids)).all()
+    release_versions(db, versions)
+
+
+def iter_version(db: Session, version: FileVersion, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    """
+    Returns an iterator over the content of a version in [start, end).
+
+    The chunk rows are loaded up front, the iterator itself only reads files
+    and can be consumed after the session is closed.
+    """
+    chunks = {
+        chunk.chunk_hash: chunk
+        for chunk in db.query(Chunk).filter(Chunk.chunk_hash.in_(set(version.chunks))).all()
+    }
+    layout = [(chunks[chunk_hash].size, chunks[chunk_hash].compression, chunk_hash) for chunk_hash in version.chunks]
+    end = version.file_size if end is None else min(end, version.file_size)
+
+    def read() -> Iterator[bytes]:
+        offset = 0
+        for size, chunk_compression, chunk_hash in layout:
+            if offset >= end:
+                break
+            if offset + size > start:
+                with open(chunk_path(chunk_hash, chunk_compression), "rb") as f:
+                    data = f.read()
+                if chunk_compression == compression.ZSTD:
+                    data = compression.decompress(data)
+                yield data[max(start - offset, 0) : end - offset]
+            offset += size
+
+    return read()
+
+
+def prune_expired_versions(db: Session, now: datetime | None = None) -> int:
+    """
+    Applies the retention policy: keeps the newest VersioningConfig.MAX_VERSIONS
+    archived versions of every file and none older than MAX_AGE_DAYS.
+
+    Returns:
+        int: The number of pruned versions.
+    """
+    conditions = []
+    params = {"limit": PRUNE_BATCH_SIZE}
+    if VersioningConfig.MAX_VERSIONS > 0:
+        conditions.append("newer >= :max_versions")
+        params["max_versions"] = VersioningConfig.MAX_VERSIONS
+    if VersioningConfig.MAX_AGE_DAYS > 0:
+        conditions.append("archived_at < :cutoff")
+        params["cutoff"] = (now or datetime.now()) - timedelta(days=VersioningConfig.MAX_AGE_DAYS)
+    if not conditions:
+        return 0
+
+    pruned = 0
+    while True:
+        version_ids = db.execute(
+            text(
+                "SELECT version_id FROM ("
+                "  SELECT version_id, archived_at,"
+                "    row_number() OVER (PARTITION BY file_id ORDER BY version_number DESC) - 1 AS newer"
+                "  FROM file_version"
+                f") ranked WHERE {' OR '.join(conditions)} LIMIT :limit"
+            ),
+            params,
+        ).scalars().all()
+        if not version_ids:
+            return pruned
+        versions = db.query(FileVersion).filter(FileVersion.version_id.in_(version_ids)).all()
+        release_versions(db, versions)
+        db.commit()
+        pruned += len(versions)
+        VERSIONS_PRUNED.inc(len(versions))
+
+
+def sweep_unreferenced_chunks(db: Session) -> int:
+    """
+    Deletes chunks no version references anymore, rows and files.
+
+    Files are removed while the exclusive lock is held and before the commit, a
+    failed commit leaves rows without files only for chunks nothing references.
+
+    Returns:
+        int: The number of deleted chunks.
+    """
+    swept = 0
+    while True:
+        lock_chunk_store(db, exclusive=True)
+        rows = db.execute(
+            text(
+                "DELETE FROM chunk WHERE chunk_hash IN ("
+                "  SELECT chunk_hash FROM chunk WHERE ref_count <= 0 LIMIT :limit"
+                ") RETURNING chunk_hash, compression"
+            ),
+            {"limit": PRUNE_BATCH_SIZE},
+        ).all()
+        for chunk_hash, chunk_compression in rows:
+            try:
+                os.remove(chunk_path(chunk_hash, chunk_compression))
+            except FileNotFoundError:
+                pass
+        db.commit()
+        swept += len(rows)
+        VERSION_CHUNKS_SWEPT.inc(len(rows))
+        if len(rows) < PRUNE_BATCH_SIZE:
+            return swept
+
+
+def prune_versions():
+    """Background job applying the retention policy and sweeping the chunk store."""
+    with exclusive_session(VERSION_PRUNE_LOCK) as db:
+        if db is None:
+            return
+        prune_expired_versions(db)
+        sweep_unreferenced_chunks(db)
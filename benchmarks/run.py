@@ -0,0 +1,295 @@
+"""
+Benchmarks the upload, listing, trash and download hot paths in-process.
+
+Seeds synthetic drives into the database configured in app/.env (use a
+dedicated database), drives the FastAPI app through the test client and
+reports p50/p95/p99 latency, throughput, SQL statements and peak RSS per
+endpoint. Results can be saved as a baseline and later runs compared
+against it.
+
+    python benchmarks/run.py --preset small --save-baseline
+    python benchmarks/run.py --preset small --compare
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import statistics
+import sys
+import time
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+_QUERY_COUNT = re.compile(r'desc="(\d+) queries"')
+
+
+@dataclass
+class Result:
+    requests: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    throughput_rps: float
+    queries: int
+    peak_rss_kb: int
+    rss_growth_kb: int
+
+
+@dataclass
+class Scenario:
+    name: str
+    call: Callable[[int], object]
+    # relative weight of the scenario; heavy listings run fewer iterations
+    weight: float = 1.0
+
+
+def _peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _query_count(response) -> int:
+    match = _QUERY_COUNT.search(response.headers.get("server-timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+def _percentile(samples: list[float], percent: int) -> float:
+    if len(samples) < 2:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+def run_scenario(scenario: Scenario, iterations: int, max_seconds: float, warmup: int) -> Result:
+    for index in range(warmup):
+        scenario.call(index)
+
+    rss_before = _peak_rss_kb()
+    latencies = []
+    queries = 0
+    started = time.perf_counter()
+    for index in range(max(1, int(iterations * scenario.weight))):
+        request_start = time.perf_counter()
+        response = scenario.call(index)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f"{scenario.name} returned {response.status_code}: {response.text[:200]}"
+            )
+        queries = max(queries, _query_count(response))
+        if time.perf_counter() - started > max_seconds and len(latencies) >= 5:
+            break
+    elapsed = time.perf_counter() - started
+    peak = _peak_rss_kb()
+
+    return Result(
+        requests=len(latencies),
+        p50_ms=round(_percentile(latencies, 50), 3),
+        p95_ms=round(_percentile(latencies, 95), 3),
+        p99_ms=round(_percentile(latencies, 99), 3),
+        throughput_rps=round(len(latencies) / elapsed, 2),
+        queries=queries,
+        peak_rss_kb=peak,
+        rss_growth_kb=peak - rss_before,
+    )
+
+
+def build_scenarios(client, user, upload_size: int) -> list[Scenario]:
+    headers = user.headers
+    upload_payload = os.urandom(upload_size)
+    trashed = user.trashed_file_ids
+
+    def untrash_and_trash(index):
+        file_id = trashed[index % len(trashed)]
+        client.get(f"/files/untrash/{file_id}", headers=headers)
+        return client.delete(f"/files/delete/{file_id}", headers=headers)
+
+    return [
+        Scenario("list_root_files", lambda i: client.get("/files/", headers=headers)),
+        Scenario(
+            "list_folder_files_small",
+            lambda i: client.get("/files/", params={"folder_id": str(user.deep_leaf_folder_id)}, headers=headers),
+        ),
+        Scenario(
+            "folder_contents_small",
+            lambda i: client.get(f"/folder/all/{user.deep_leaf_folder_id}", headers=headers),
+        ),
+        Scenario(
+            "folder_contents_wide",
+            lambda i: client.get(f"/folder/all/{user.wide_folder_id}", headers=headers),
+            weight=0.1,
+        ),
+        Scenario("user_folders", lambda i: client.get("/folder/", headers=headers), weight=0.25),
+        Scenario(
+            "folder_tree_with_files",
+            lambda i: client.get("/folder/tree", params={"include_files": True}, headers=headers),
+            weight=0.25,
+        ),
+        Scenario("show_trash_files", lambda i: client.get("/files/trash", headers=headers), weight=0.25),
+        Scenario("show_trash_folders", lambda i: client.get("/folder/trash/", headers=headers)),
+        Scenario("trash_untrash_file", untrash_and_trash),
+        Scenario(
+            "download_file",
+            lambda i: client.get(
+                f"/files/download/{user.download_file_ids[i % len(user.download_file_ids)]}",
+                headers=headers,
+            ),
+        ),
+        Scenario(
+            "upload_files",
+            lambda i: client.post(
+                f"/files/upload/{user.root_folder_id}",
+                headers=headers,
+                files=[("files", (f"bench-{i}-{n}.bin", upload_payload, "application/octet-stream")) for n in range(4)],
+            ),
+            weight=0.5,
+        ),
+    ]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {metric} {result[metric]:.2f} vs baseline {base[metric]:.2f}"
+                )
+        if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput_rps']:.1f} vs baseline {base['throughput_rps']:.1f}"
+            )
+        if result["queries"] > base["queries"]:
+            regressions.append(f"{name}: {result['queries']} queries vs baseline {base['queries']}")
+    return regressions
+
+
+def print_table(results: dict):
+    header = f"{'scenario':<26}{'reqs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}{'peak RSS MB':>13}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(
+            f"{name:<26}{result['requests']:>6}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+            f"{result['p99_ms']:>10.2f}{result['throughput_rps']:>10.1f}{result['queries']:>9}"
+            f"{result['peak_rss_kb'] / 1024:>13.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", default="small", help="size of the synthetic drives (small, large)")
+    parser.add_argument("--iterations", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--max-seconds", type=float, default=30.0, help="time cap per scenario")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="bytes per uploaded file")
+    parser.add_argument("--only", nargs="*", help="run only these scenarios")
+    parser.add_argument("--baseline", help="baseline name, defaults to the preset")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="exit 1 on regressions against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before flagging")
+    parser.add_argument("--keep-data", action="store_true", help="do not remove the seeded drives afterwards")
+    args = parser.parse_args()
+
+    # the app resolves .env, templates and UPLOADS relative to its own directory
+    sys.path.insert(0, APP_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    os.chdir(APP_DIR)
+    warnings.filterwarnings("ignore")
+
+    from alembic import command
+    from alembic.config import Config as AlembicConfig
+    from fastapi.testclient import TestClient
+    from sqlmodel import Session
+
+    import main as app_main
+    from config import SQLProfilingConfig
+    from database import engine
+    from utils.sql_profiler import assert_constant_query_count
+
+    import seed
+
+    # statements per request are read from the Server-Timing header
+    SQLProfilingConfig.SERVER_TIMING = True
+    preset = seed.PRESETS[args.preset]
+    command.upgrade(AlembicConfig("alembic.ini"), "head")
+    with Session(engine) as db:
+        seed.reset(db)
+        print(f"Seeding preset {args.preset!r} ...", flush=True)
+        seed_start = time.perf_counter()
+        users = seed.seed(db, preset)
+        print(f"Seeded {len(users)} users in {time.perf_counter() - seed_start:.1f}s", flush=True)
+
+    results = {}
+    try:
+        with TestClient(app_main.app) as client:
+            for scenario in build_scenarios(client, users[0], args.upload_size):
+                if args.only and scenario.name not in args.only:
+                    continue
+                print(f"Running {scenario.name} ...", flush=True)
+                results[scenario.name] = asdict(
+                    run_scenario(scenario, args.iterations, args.max_seconds, args.warmup)
+                )
+    finally:
+        if not args.keep_data:
+            with Session(engine) as db:
+                seed.reset(db)
+
+    print()
+    print_table(results)
+
+    status = 0
+    if {"folder_contents_small", "folder_contents_wide"} <= results.keys():
+        try:
+            assert_constant_query_count(
+                {
+                    preset.files_per_folder: results["folder_contents_small"]["queries"],
+                    preset.wide_folder_files: results["folder_contents_wide"]["queries"],
+                }
+            )
+        except AssertionError as e:
+            print(f"\nN+1: folder contents {e}")
+            status = 1
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{args.baseline or args.preset}.json")
+    if args.compare:
+        if not os.path.exists(baseline_path):
+            print(f"\nNo baseline at {baseline_path}, run with --save-baseline first")
+            return 1
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            status = 1
+        else:
+            print("\nNo regressions against baseline")
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(
+                {
+                    "preset": asdict(preset),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"\nSaved baseline to {baseline_path}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
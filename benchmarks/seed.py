@@ -0,0 +1,236 @@
+"""
+Seeds synthetic drives into the configured database for the benchmark suite.
+
+Rows are written with bulk core inserts so even the 100k-file folder seeds in
+seconds. Only files that a scenario actually downloads get a blob on disk.
+"""
+import os
+import shutil
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from models.postgres_models import FileMetadata, Folder, User
+from utils.jwttoken import create_access_token
+
+BENCH_EMAIL_DOMAIN = "bench.example.com"
+UPLOAD_FOLDER = "UPLOADS"
+INSERT_BATCH = 5000
+
+
+@dataclass
+class SeededUser:
+    uid: uuid.UUID
+    email: str
+    root_folder_id: uuid.UUID
+    token: str
+    deep_leaf_folder_id: uuid.UUID | None = None
+    wide_folder_id: uuid.UUID | None = None
+    trashed_file_ids: list[uuid.UUID] = field(default_factory=list)
+    download_file_ids: list[uuid.UUID] = field(default_factory=list)
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+@dataclass
+class Preset:
+    users: int
+    tree_depth: int
+    tree_fanout: int
+    files_per_folder: int
+    wide_folder_files: int
+    trashed_files: int
+    download_files: int
+    download_size: int
+
+
+PRESETS = {
+    "small": Preset(
+        users=10, tree_depth=4, tree_fanout=3, files_per_folder=5,
+        wide_folder_files=2_000, trashed_files=200, download_files=20, download_size=256 * 1024,
+    ),
+    "large": Preset(
+        users=1_000, tree_depth=8, tree_fanout=3, files_per_folder=10,
+        wide_folder_files=100_000, trashed_files=5_000, download_files=50, download_size=4 * 1024 * 1024,
+    ),
+}
+
+
+def _bulk_insert(db: Session, model, rows: list[dict]):
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.execute(insert(model), rows[start : start + INSERT_BATCH])
+
+
+def _file_row(user_id, folder_id, name, size=0, location="", **extra) -> dict:
+    now = datetime.now()
+    return {
+        "file_id": uuid.uuid4(),
+        "folder_id": folder_id,
+        "user_id": user_id,
+        "file_name": name,
+        "file_size": size,
+        "file_type": "text/plain",
+        "storage_location": location,
+        "uploaded_at": now,
+        "updated_at": now,
+        "is_trashed": False,
+        "trashed_at": None,
+        **extra,
+    }
+
+
+def _folder_row(user_id, name, parent) -> dict:
+    now = datetime.now()
+    return {
+        "folder_id": uuid.uuid4(),
+        "user_id": user_id,
+        "folder_name": name,
+        "parent_folder": parent,
+        "created_at": now,
+        "updated_at": now,
+        "is_trashed": False,
+        "trashed_at": None,
+    }
+
+
+def reset(db: Session):
+    """Removes every user created by an earlier benchmark run, with their rows and blobs."""
+    user_ids = db.scalars(
+        select(User.uid).where(User.email.like(f"%@{BENCH_EMAIL_DOMAIN}"))
+    ).all()
+    if not user_ids:
+        return
+    db.execute(delete(FileMetadata).where(FileMetadata.user_id.in_(user_ids)))
+    db.execute(delete(Folder).where(Folder.user_id.in_(user_ids)))
+    db.execute(delete(User).where(User.uid.in_(user_ids)))
+    db.commit()
+    for user_id in user_ids:
+        user_path = os.path.join(UPLOAD_FOLDER, str(user_id))
+        if os.path.isdir(user_path):
+            shutil.rmtree(user_path)
+
+
+def seed_users(db: Session, count: int) -> list[SeededUser]:
+    users = []
+    user_rows = []
+    folder_rows = []
+    for _ in range(count):
+        uid = uuid.uuid4()
+        email = f"{uid.hex[:12]}@{BENCH_EMAIL_DOMAIN}"
+        root = _folder_row(uid, "/", None)
+        user_rows.append(
+            {
+                "uid": uid,
+                "username": "bench",
+                "email": email,
+                "hashed_password": "!",
+                "is_verified": True,
+                "root_folder_id": root["folder_id"],
+            }
+        )
+        folder_rows.append(root)
+        users.append(
+            SeededUser(
+                uid=uid,
+                email=email,
+                root_folder_id=root["folder_id"],
+                token=create_access_token(data={"sub": email}, expire_minutes=24 * 60),
+            )
+        )
+    _bulk_insert(db, User, user_rows)
+    _bulk_insert(db, Folder, folder_rows)
+    db.commit()
+    return users
+
+
+def seed_deep_tree(db: Session, user: SeededUser, depth: int, fanout: int, files_per_folder: int):
+    """Builds a tree of `fanout` subfolders per level, `depth` levels below the root."""
+    folder_rows = []
+    file_rows = []
+    level = [user.root_folder_id]
+    for depth_index in range(depth):
+        next_level = []
+        for parent in level:
+            for child_index in range(fanout):
+                row = _folder_row(user.uid, f"d{depth_index}-{child_index}", parent)
+                folder_rows.append(row)
+                next_level.append(row["folder_id"])
+                file_rows.extend(
+                    _file_row(user.uid, row["folder_id"], f"f{file_index}.txt")
+                    for file_index in range(files_per_folder)
+                )
+        level = next_level
+    _bulk_insert(db, Folder, folder_rows)
+    _bulk_insert(db, FileMetadata, file_rows)
+    db.commit()
+    user.deep_leaf_folder_id = level[-1] if level else user.root_folder_id
+
+
+def seed_wide_folder(db: Session, user: SeededUser, files: int):
+    row = _folder_row(user.uid, "wide", user.root_folder_id)
+    _bulk_insert(db, Folder, [row])
+    _bulk_insert(
+        db,
+        FileMetadata,
+        [_file_row(user.uid, row["folder_id"], f"w{index:06d}.txt") for index in range(files)],
+    )
+    db.commit()
+    user.wide_folder_id = row["folder_id"]
+
+
+def seed_trash(db: Session, user: SeededUser, files: int):
+    trashed_at = datetime.now() - timedelta(days=1)
+    rows = [
+        _file_row(user.uid, user.root_folder_id, f"t{index}.txt", is_trashed=True, trashed_at=trashed_at)
+        for index in range(files)
+    ]
+    _bulk_insert(db, FileMetadata, rows)
+    db.commit()
+    user.trashed_file_ids = [row["file_id"] for row in rows]
+
+
+def seed_downloads(db: Session, user: SeededUser, files: int, size: int):
+    folder_path = os.path.join(UPLOAD_FOLDER, str(user.uid), str(user.root_folder_id))
+    os.makedirs(folder_path, exist_ok=True)
+    payload = os.urandom(min(size, 1024 * 1024))
+    rows = []
+    for index in range(files):
+        path = os.path.join(folder_path, f"download-{index}.bin")
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(payload[:remaining])
+                remaining -= len(payload)
+        rows.append(
+            _file_row(
+                user.uid, user.root_folder_id, f"download-{index}.bin", size=size, location=path,
+                file_type="application/octet-stream",
+            )
+        )
+    _bulk_insert(db, FileMetadata, rows)
+    db.commit()
+    user.download_file_ids = [row["file_id"] for row in rows]
+
+
+def seed(db: Session, preset: Preset) -> list[SeededUser]:
+    """
+    Seeds all synthetic drives for a preset.
+
+    The first user gets the heavy drive (deep tree, wide folder, full trash and
+    downloadable blobs), the others only a root folder and a shallow tree so the
+    tables have realistic selectivity.
+    """
+    users = seed_users(db, preset.users)
+    heavy = users[0]
+    seed_deep_tree(db, heavy, preset.tree_depth, preset.tree_fanout, preset.files_per_folder)
+    seed_wide_folder(db, heavy, preset.wide_folder_files)
+    seed_trash(db, heavy, preset.trashed_files)
+    seed_downloads(db, heavy, preset.download_files, preset.download_size)
+    for user in users[1:]:
+        seed_deep_tree(db, user, 2, preset.tree_fanout, preset.files_per_folder)
+    return users
@@ -0,0 +1,416 @@
+"""
+Reconciles file_metadata and the version chunk store with the files on the storage volumes.
+
+Finds
+  - orphaned blobs and chunk files no row references, e.g. from an upload that
+    died between writing the blob and committing its row,
+  - rows whose blob is missing or does not have the recorded size,
+  - chunk rows whose file is missing,
+  - empty directories.
+
+Only reports by default. With --repair orphans are moved to <volume>/.orphaned,
+rows with a missing blob are restored from their newest version or moved to
+the trash, recorded sizes are corrected and empty directories removed. Files
+younger than --grace-minutes are left alone since they may belong to an upload
+that is still running.
+
+Rows are read in primary key ranges and blobs checked by a thread pool, user
+directories are scanned in parallel with os.scandir. Progress is checkpointed
+after every batch, an interrupted scrub continues where it stopped with --resume.
+
+    python scripts/scrub_storage.py --report scrub.jsonl
+    python scripts/scrub_storage.py --repair --resume
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), "app")
+
+PHASES = ("rows", "chunks", "disk", "chunk_files")
+
+
+@dataclass
+class Finding:
+    kind: str
+    path: str
+    file_id: str | None = None
+    detail: str | None = None
+    action: str | None = None
+
+
+class Checkpoint:
+    """Scrub progress and totals, written atomically after every batch."""
+
+    def __init__(self, path: str, resume: bool):
+        self.path = path
+        self.state = {
+            "run": datetime.now().strftime("%Y%m%d-%H%M%S"),
+            "phases": {phase: {"done": False} for phase in PHASES},
+            "counts": {},
+        }
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def phase(self, name: str) -> dict:
+        return self.state["phases"][name]
+
+    def count(self, kind: str, amount: int = 1):
+        self.state["counts"][kind] = self.state["counts"].get(kind, 0) + amount
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class Scrubber:
+    def __init__(self, args, checkpoint: Checkpoint, report):
+        from database import engine
+        from utils.storage import VOLUMES
+        from utils.versions import CHUNK_FOLDER
+
+        self.engine = engine
+        self.args = args
+        self.checkpoint = checkpoint
+        self.report = report
+        self.roots = [volume.path for volume in VOLUMES]
+        self.chunk_folder = CHUNK_FOLDER
+        self.cutoff = time.time() - args.grace_minutes * 60
+        self.executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    def record(self, finding: Finding):
+        self.checkpoint.count(finding.kind)
+        self.report.write(json.dumps(asdict(finding)) + "\n")
+        if self.args.verbose:
+            print(f"{finding.kind:<22} {finding.path} {finding.detail or ''} {finding.action or ''}")
+
+    def is_recent(self, path: str) -> bool:
+        try:
+            return os.stat(path).st_mtime > self.cutoff
+        except FileNotFoundError:
+            return True
+
+    def quarantine_file(self, path: str) -> str:
+        from utils.storage import volume_of
+
+        # stays on the blob's volume, so the move is a rename
+        root = volume_of(path).path
+        target = os.path.join(root, ".orphaned", self.checkpoint.state["run"], os.path.relpath(path, root))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(path, target)
+        return f"moved to {target}"
+
+    # rows -> disk
+
+    def scrub_rows(self):
+        from sqlalchemy.orm import Session
+
+        from models.postgres_models import FileMetadata
+
+        state = self.checkpoint.phase("rows")
+        with Session(self.engine) as db:
+            while True:
+                query = db.query(FileMetadata).order_by(FileMetadata.file_id)
+                if state.get("after"):
+                    query = query.filter(FileMetadata.file_id > state["after"])
+                files = query.limit(self.args.batch_size).all()
+                if not files:
+                    break
+                sizes = self.executor.map(_stat_size, [file.storage_location for file in files])
+                for file, size in zip(files, sizes):
+                    self.check_row(db, file, size)
+                db.commit()
+                state["after"] = str(files[-1].file_id)
+                self.checkpoint.count("rows_checked", len(files))
+                self.checkpoint.save()
+        state["done"] = True
+        self.checkpoint.save()
+
+    def check_row(self, db, file, size: int | None):
+        expected = file.stored_size if file.stored_size is not None else file.file_size
+        if size is None:
+            finding = Finding("missing_blob", file.storage_location, str(file.file_id))
+            if self.args.repair and not file.is_trashed:
+                finding.action = self.repair_missing_blob(db, file)
+            self.record(finding)
+        elif size != expected:
+            finding = Finding(
+                "size_mismatch",
+                file.storage_location,
+                str(file.file_id),
+                f"recorded {expected} bytes, {size} on disk",
+            )
+            if self.args.repair and not self.is_recent(file.storage_location):
+                finding.action = self.repair_size(file, size)
+            self.record(finding)
+
+    def repair_missing_blob(self, db, file) -> str:
+        from models.postgres_models import FileVersion
+        from utils.storage import commit_blob, should_compress, stage_chunks
+        from utils.versions import iter_version, lock_chunk_store
+
+        version = (
+            db.query(FileVersion)
+            .filter(FileVersion.file_id == file.file_id)
+            .order_by(FileVersion.version_number.desc())
+            .first()
+        )
+        if version is None:
+            file.is_trashed = True
+            file.trashed_at = datetime.now()
+            return "moved to trash"
+        lock_chunk_store(db)
+        staged = stage_chunks(
+            iter_version(db, version),
+            os.path.dirname(file.storage_location),
+            should_compress(version.file_type, file.file_name),
+        )
+        commit_blob(staged, file.storage_location)
+        file.file_size = staged.size
+        file.file_type = version.file_type
+        file.compression = staged.compression
+        file.stored_size = staged.stored_size
+        return f"restored from version {version.version_number}"
+
+    def repair_size(self, file, size: int) -> str:
+        from utils import compression
+
+        if file.compression == compression.ZSTD:
+            try:
+                file.file_size = compression.SeekableReader(file.storage_location).size
+            except (OSError, ValueError):
+                return "left as is, unreadable seek table"
+        else:
+            file.file_size = size
+        file.stored_size = size
+        return "recorded size updated"
+
+    def scrub_chunks(self):
+        from sqlalchemy.orm import Session
+
+        from models.postgres_models import Chunk
+        from utils.versions import chunk_path
+
+        state = self.checkpoint.phase("chunks")
+        with Session(self.engine) as db:
+            while True:
+                query = db.query(Chunk).order_by(Chunk.chunk_hash)
+                if state.get("after"):
+                    query = query.filter(Chunk.chunk_hash > state["after"])
+                chunks = query.limit(self.args.batch_size).all()
+                if not chunks:
+                    break
+                paths = [chunk_path(chunk.chunk_hash, chunk.compression) for chunk in chunks]
+                for chunk, path, size in zip(chunks, paths, self.executor.map(_stat_size, paths)):
+                    if size is None and chunk.ref_count > 0:
+                        self.record(Finding("missing_chunk", path, detail=f"{chunk.ref_count} references"))
+                    elif size is not None and size != chunk.stored_size:
+                        self.record(
+                            Finding("chunk_size_mismatch", path, detail=f"recorded {chunk.stored_size} bytes, {size} on disk")
+                        )
+                state["after"] = chunks[-1].chunk_hash
+                self.checkpoint.count("chunks_checked", len(chunks))
+                self.checkpoint.save()
+        state["done"] = True
+        self.checkpoint.save()
+
+    # disk -> rows
+
+    def scrub_disk(self):
+        state = self.checkpoint.phase("disk")
+        done = set(state.setdefault("users", []))
+        user_dirs = []
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if not entry.is_dir(follow_symlinks=False):
+                        self.record(Finding("unexpected_file", entry.path))
+                    elif entry.path not in done:
+                        user_dirs.append(entry.path)
+
+        for user_dir, findings in zip(user_dirs, self.executor.map(self.scan_user_dir, user_dirs)):
+            for finding in findings:
+                self.record(finding)
+            state["users"].append(user_dir)
+            self.checkpoint.save()
+        state["done"] = True
+        self.checkpoint.save()
+
+    def scan_user_dir(self, user_dir: str) -> list[Finding]:
+        from uuid import UUID
+
+        from sqlalchemy.orm import Session
+
+        from models.postgres_models import FileMetadata, RetiredBlob
+
+        try:
+            user_id = UUID(os.path.basename(user_dir))
+        except ValueError:
+            user_id = None
+        known = set()
+        if user_id is not None:
+            with Session(self.engine) as db:
+                known = {
+                    os.path.normpath(location)
+                    for (location,) in db.query(FileMetadata.storage_location).filter(
+                        FileMetadata.user_id == user_id
+                    )
+                }
+                # still served to downloads that looked them up before a move, removed by the sweep
+                known.update(
+                    os.path.normpath(path)
+                    for (path,) in db.query(RetiredBlob.path).filter(
+                        RetiredBlob.path.startswith(os.path.join(user_dir, ""), autoescape=True)
+                    )
+                )
+        findings = []
+        self.scan_dir(user_dir, known, findings)
+        return findings
+
+    def scan_dir(self, path: str, known: set, findings: list) -> bool:
+        """Checks a directory tree against the known blob paths, returns whether it ended up empty."""
+        empty = True
+        with os.scandir(path) as entries:
+            for entry in list(entries):
+                if entry.is_dir(follow_symlinks=False):
+                    empty &= self.scan_dir(entry.path, known, findings)
+                elif os.path.normpath(entry.path) in known:
+                    empty = False
+                elif entry.stat(follow_symlinks=False).st_mtime > self.cutoff:
+                    empty = False
+                else:
+                    finding = Finding("orphaned_blob", entry.path, detail=f"{entry.stat().st_size} bytes")
+                    if self.args.repair:
+                        finding.action = self.quarantine_file(entry.path)
+                    else:
+                        empty = False
+                    findings.append(finding)
+        if empty and os.path.dirname(path) not in {root.rstrip(os.sep) for root in self.roots}:
+            finding = Finding("empty_directory", path)
+            if self.args.repair and not self.is_recent(path):
+                try:
+                    os.rmdir(path)
+                    finding.action = "removed"
+                except OSError:
+                    pass
+            findings.append(finding)
+        return empty
+
+    def scrub_chunk_files(self):
+        state = self.checkpoint.phase("chunk_files")
+        done = set(state.setdefault("prefixes", []))
+        if not os.path.isdir(self.chunk_folder):
+            state["done"] = True
+            self.checkpoint.save()
+            return
+        prefixes = sorted(
+            entry.name for entry in os.scandir(self.chunk_folder) if entry.is_dir() and entry.name not in done
+        )
+        for prefix, findings in zip(prefixes, self.executor.map(self.scan_chunk_prefix, prefixes)):
+            for finding in findings:
+                self.record(finding)
+            state["prefixes"].append(prefix)
+            self.checkpoint.save()
+        state["done"] = True
+        self.checkpoint.save()
+
+    def scan_chunk_prefix(self, prefix: str) -> list[Finding]:
+        from sqlalchemy import text
+        from sqlalchemy.orm import Session
+
+        from utils.versions import lock_chunk_store
+
+        files = {}
+        for dirpath, _, filenames in os.walk(os.path.join(self.chunk_folder, prefix)):
+            for filename in filenames:
+                files[os.path.join(dirpath, filename)] = filename
+        findings = []
+        with Session(self.engine) as db:
+            if self.args.repair:
+                # chunk files are only removed under the exclusive lock, like the sweeper does
+                lock_chunk_store(db, exclusive=True)
+            hashes = {name.split(".")[0] for name in files.values()}
+            rows = dict(
+                db.execute(
+                    text("SELECT chunk_hash, compression FROM chunk WHERE chunk_hash = ANY(:hashes)"),
+                    {"hashes": list(hashes)},
+                ).all()
+            )
+            for path, name in files.items():
+                chunk_hash, _, suffix = name.partition(".")
+                if chunk_hash in rows and suffix == ("zst" if rows[chunk_hash] else ""):
+                    continue
+                if self.is_recent(path):
+                    continue
+                finding = Finding("orphaned_chunk", path)
+                if self.args.repair:
+                    finding.action = self.quarantine_file(path)
+                findings.append(finding)
+            db.commit()
+        return findings
+
+    def run(self):
+        for phase in PHASES:
+            if self.checkpoint.phase(phase)["done"]:
+                print(f"Skipping {phase}, done in a previous run")
+                continue
+            print(f"Scrubbing {phase} ...", flush=True)
+            getattr(self, f"scrub_{phase}")()
+        self.executor.shutdown()
+
+
+def _stat_size(path: str) -> int | None:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repair", action="store_true", help="fix what can be fixed instead of only reporting")
+    parser.add_argument("--resume", action="store_true", help="continue from the checkpoint of an interrupted run")
+    parser.add_argument("--checkpoint", default="scrub-checkpoint.json")
+    parser.add_argument("--report", default="scrub-report.jsonl", help="findings, one JSON object per line")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) * 4))
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per key range")
+    parser.add_argument("--grace-minutes", type=float, default=60, help="ignore files modified more recently")
+    parser.add_argument("--verbose", "-v", action="store_true", help="print every finding")
+    args = parser.parse_args()
+
+    checkpoint_path = os.path.abspath(args.checkpoint)
+    report_path = os.path.abspath(args.report)
+    # the app resolves .env and UPLOADS relative to its own directory
+    sys.path.insert(0, APP_DIR)
+    os.chdir(APP_DIR)
+    warnings.filterwarnings("ignore")
+
+    checkpoint = Checkpoint(checkpoint_path, args.resume)
+    with open(report_path, "a" if args.resume else "w") as report:
+        Scrubber(args, checkpoint, report).run()
+
+    print()
+    for kind, count in sorted(checkpoint.state["counts"].items()):
+        print(f"{kind:<22}{count:>10}")
+    print(f"\nReport written to {report_path}")
+    os.remove(checkpoint_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Shared setup of the test suite.
+
+The app reads .env, templates and UPLOADS relative to its own directory, so the
+tests run from app/ with the configuration in app/.env, like the benchmarks.
+Tests needing the database are skipped when it cannot be reached; use a
+dedicated database, the drives seeded here are removed afterwards.
+"""
+import os
+import sys
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+TEST_EMAIL_DOMAIN = "tests.example.com"
+
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+
+
+def pytest_configure(config):
+    # SQLModel warns about every session.query() the routers use
+    config.addinivalue_line("filterwarnings", "ignore::DeprecationWarning")
+
+
+@dataclass
+class Drive:
+    uid: uuid.UUID
+    headers: dict
+    root_folder_id: uuid.UUID
+    folder_id: uuid.UUID
+    trashed_folder_id: uuid.UUID
+    versioned_file_id: uuid.UUID
+
+
+@pytest.fixture(scope="session")
+def engine():
+    from alembic import command
+    from alembic.config import Config as AlembicConfig
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    from database import engine
+
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except OperationalError as exc:
+        pytest.skip(f"database unavailable: {exc.orig}")
+    command.upgrade(AlembicConfig("alembic.ini"), "head")
+    return engine
+
+
+@pytest.fixture(scope="session")
+def client(engine):
+    from fastapi.testclient import TestClient
+
+    import main
+    from config import SQLProfilingConfig
+
+    # the N+1 checks read the statement count of each request from this header
+    SQLProfilingConfig.SERVER_TIMING = True
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def make_drive(engine):
+    """
+    Seeds drives whose listings all return `size` rows, and removes them afterwards.
+
+    A drive has `size` files and subfolders in its root, `size` files in one subfolder,
+    `size` trashed files, a trashed folder holding `size` trashed files and subfolders,
+    a file with `size` archived versions and `size` finished jobs.
+    """
+    from sqlalchemy import delete, insert, select
+    from sqlmodel import Session
+
+    from models.postgres_models import FileMetadata, FileVersion, Folder, Job, User
+    from utils.jwttoken import create_access_token
+
+    user_ids = []
+
+    def folder_row(uid, name, parent, trashed_at=None):
+        now = datetime.now()
+        return {
+            "folder_id": uuid.uuid4(),
+            "user_id": uid,
+            "folder_name": name,
+            "parent_folder": parent,
+            "created_at": now,
+            "updated_at": now,
+            "is_trashed": trashed_at is not None,
+            "trashed_at": trashed_at,
+        }
+
+    def file_row(uid, folder_id, name, trashed_at=None, **extra):
+        now = datetime.now()
+        return {
+            "file_id": uuid.uuid4(),
+            "folder_id": folder_id,
+            "user_id": uid,
+            "file_name": name,
+            "file_size": 1,
+            "file_type": "image/png",
+            "storage_location": "",
+            "uploaded_at": now,
+            "updated_at": now,
+            "is_trashed": trashed_at is not None,
+            "trashed_at": trashed_at,
+            "detected_type": "image/png",
+            "media_analyzed_at": now,
+            **extra,
+        }
+
+    def make(size: int) -> Drive:
+        uid = uuid.uuid4()
+        email = f"{uid.hex[:12]}@{TEST_EMAIL_DOMAIN}"
+        trashed_at = datetime.now() - timedelta(hours=1)
+        root = folder_row(uid, "/", None)
+        folder = folder_row(uid, "folder", root["folder_id"])
+        trashed_folder = folder_row(uid, "trashed", root["folder_id"], trashed_at)
+        folders = [root, folder, trashed_folder]
+        folders += [folder_row(uid, f"d{index}", root["folder_id"]) for index in range(size)]
+        folders += [folder_row(uid, f"t{index}", trashed_folder["folder_id"], trashed_at) for index in range(size)]
+        files = [file_row(uid, root["folder_id"], f"r{index}.png") for index in range(size)]
+        files += [file_row(uid, folder["folder_id"], f"f{index}.png") for index in range(size)]
+        files += [file_row(uid, root["folder_id"], f"x{index}.png", trashed_at) for index in range(size)]
+        files += [file_row(uid, trashed_folder["folder_id"], f"t{index}.png", trashed_at) for index in range(size)]
+        versioned = file_row(uid, folder["folder_id"], "versioned.png", version=size + 1)
+        versions = [
+            {
+                "version_id": uuid.uuid4(),
+                "file_id": versioned["file_id"],
+                "version_number": number,
+                "file_size": 1,
+                "file_type": "image/png",
+                "chunks": [],
+                "created_at": datetime.now(),
+                "archived_at": datetime.now(),
+            }
+            for number in range(1, size + 1)
+        ]
+        jobs = [
+            {"job_id": uuid.uuid4(), "user_id": uid, "kind": "copy_folder", "status": "done"}
+            for _ in range(size)
+        ]
+        with Session(engine) as db:
+            db.execute(
+                insert(User),
+                [
+                    {
+                        "uid": uid,
+                        "username": "test",
+                        "email": email,
+                        "hashed_password": "!",
+                        "is_verified": True,
+                        "root_folder_id": root["folder_id"],
+                    }
+                ],
+            )
+            user_ids.append(uid)
+            db.execute(insert(Folder), folders)
+            db.execute(insert(FileMetadata), files + [versioned])
+            # an insert without rows would insert one row of defaults
+            if versions:
+                db.execute(insert(FileVersion), versions)
+            if jobs:
+                db.execute(insert(Job), jobs)
+            db.commit()
+        return Drive(
+            uid=uid,
+            headers={"Authorization": f"Bearer {create_access_token(data={'sub': email})}"},
+            root_folder_id=root["folder_id"],
+            folder_id=folder["folder_id"],
+            trashed_folder_id=trashed_folder["folder_id"],
+            versioned_file_id=versioned["file_id"],
+        )
+
+    yield make
+
+    if user_ids:
+        with Session(engine) as db:
+            file_ids = select(FileMetadata.file_id).where(FileMetadata.user_id.in_(user_ids))
+            db.execute(delete(FileVersion).where(FileVersion.file_id.in_(file_ids)))
+            db.execute(delete(Job).where(Job.user_id.in_(user_ids)))
+            db.execute(delete(FileMetadata).where(FileMetadata.user_id.in_(user_ids)))
+            db.execute(delete(Folder).where(Folder.user_id.in_(user_ids)))
+            db.execute(delete(User).where(User.uid.in_(user_ids)))
+            db.commit()
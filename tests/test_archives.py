@@ -0,0 +1,94 @@
+import io
+import stat
+import zipfile
+
+import pytest
+
+from config import ExtractConfig
+from utils.archives import ArchiveError, ArchiveLimitError, inspect_archive
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(ExtractConfig, "MAX_ENTRIES", 10)
+    monkeypatch.setattr(ExtractConfig, "MAX_BYTES", 8 * 1024 * 1024)
+    monkeypatch.setattr(ExtractConfig, "MAX_RATIO", 100.0)
+
+
+def _archive(entries, compression=zipfile.ZIP_STORED) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for entry, content in entries:
+            archive.writestr(entry, content)
+    buffer.seek(0)
+    return buffer
+
+
+def _inspect(buffer: io.BytesIO):
+    return inspect_archive(buffer, len(buffer.getvalue()))
+
+
+def test_inspect_archive_lists_files_and_folders():
+    buffer = _archive(
+        [
+            ("a.txt", b"a"),
+            ("docs/", b""),
+            ("photos/2024/b.jpg", b"bb"),
+            ("__MACOSX/photos/._b.jpg", b"x"),
+        ]
+    )
+    entries, folders, total_size = _inspect(buffer)
+    assert [path for _, path in entries] == [("a.txt",), ("photos", "2024", "b.jpg")]
+    assert folders == {("docs",), ("photos", "2024")}
+    assert total_size == 3
+
+
+def test_inspect_archive_rejects_other_files():
+    with pytest.raises(ArchiveError, match="Not a zip archive"):
+        inspect_archive(io.BytesIO(b"not a zip"), 9)
+
+
+@pytest.mark.parametrize("name", ["../evil.txt", "/etc/passwd", "a/../../evil.txt"])
+def test_inspect_archive_rejects_paths_leaving_the_folder(name):
+    with pytest.raises(ArchiveError):
+        _inspect(_archive([(name, b"x")]))
+
+
+def test_inspect_archive_refuses_symlinks():
+    link = zipfile.ZipInfo("link")
+    link.external_attr = (stat.S_IFLNK | 0o777) << 16
+    with pytest.raises(ArchiveError, match="Symbolic link"):
+        _inspect(_archive([(link, b"/etc/passwd")]))
+
+
+def test_inspect_archive_refuses_encrypted_entries():
+    buffer = _archive([("secret.txt", b"x")])
+    # set the encryption flag in the central directory record
+    content = bytearray(buffer.getvalue())
+    offset = content.rindex(b"PK\x01\x02")
+    content[offset + 8] |= 0x1
+    with pytest.raises(ArchiveError, match="Encrypted"):
+        _inspect(io.BytesIO(bytes(content)))
+
+
+def test_inspect_archive_limits_entries():
+    _inspect(_archive([(f"{index}.txt", b"x") for index in range(10)]))
+    with pytest.raises(ArchiveLimitError):
+        _inspect(_archive([(f"{index}.txt", b"x") for index in range(11)]))
+
+
+def test_inspect_archive_limits_total_size():
+    with pytest.raises(ArchiveLimitError):
+        _inspect(_archive([("a.bin", b"\0" * (5 * 1024 * 1024)), ("b.bin", b"\0" * (4 * 1024 * 1024))]))
+
+
+def test_inspect_archive_limits_compression_ratio_of_an_entry():
+    with pytest.raises(ArchiveLimitError, match="'zeros.bin'"):
+        _inspect(_archive([("zeros.bin", b"\0" * (2 * 1024 * 1024))], zipfile.ZIP_DEFLATED))
+
+
+def test_inspect_archive_limits_compression_ratio_of_small_entries():
+    # every entry is below the size checked one by one, together they still count
+    entries = [(f"{index}.bin", b"\0" * (512 * 1024)) for index in range(8)]
+    with pytest.raises(ArchiveLimitError, match="of the archive"):
+        _inspect(_archive(entries, zipfile.ZIP_DEFLATED))
@@ -0,0 +1,88 @@
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from utils.blob_cache import BlobCache
+
+
+def _file(size=10, **fields):
+    return SimpleNamespace(
+        **{
+            "file_id": uuid.uuid4(),
+            "file_size": size,
+            "version": 1,
+            "updated_at": datetime(2024, 1, 1),
+            "storage_location": "UPLOADS/a",
+            **fields,
+        }
+    )
+
+
+def test_cacheable():
+    cache = BlobCache(budget=100, max_object_size=10)
+    assert cache.cacheable(_file(10))
+    assert not cache.cacheable(_file(0))
+    assert not cache.cacheable(_file(11))
+    assert not BlobCache(budget=5, max_object_size=10).cacheable(_file(5))
+
+
+def test_admits_on_the_second_miss():
+    cache = BlobCache(budget=100, max_object_size=10)
+    file = _file()
+    assert not cache.admit(file)
+    assert cache.admit(file)
+    assert not cache.admit(file)
+
+
+def test_get_returns_what_was_put():
+    cache = BlobCache(budget=100, max_object_size=10)
+    file = _file()
+    assert cache.get(file) is None
+    cache.put(file, b"0123456789")
+    assert cache.get(file) == b"0123456789"
+    assert cache.size == 10
+
+
+def test_changed_rows_miss():
+    cache = BlobCache(budget=100, max_object_size=10)
+    file = _file()
+    for change in ({"version": 2}, {"updated_at": datetime(2024, 1, 2)}, {"storage_location": "UPLOADS/b"}):
+        cache.put(file, b"0123456789")
+        changed = SimpleNamespace(**{**vars(file), **change})
+        assert cache.get(changed) is None
+        assert cache.size == 0
+
+
+def test_put_replaces_the_previous_content():
+    cache = BlobCache(budget=100, max_object_size=10)
+    file = _file()
+    cache.put(file, b"old")
+    cache.put(file, b"new content")
+    assert cache.get(file) == b"new content"
+    assert cache.size == len(b"new content")
+
+
+def test_evicts_least_recently_used():
+    cache = BlobCache(budget=30, max_object_size=10)
+    first, second, third, fourth = (_file() for _ in range(4))
+    for file in (first, second, third):
+        cache.put(file, b"x" * 10)
+    cache.get(first)
+    cache.put(fourth, b"x" * 10)
+    assert cache.get(second) is None
+    assert cache.get(first) is not None
+    assert cache.get(third) is not None
+    assert cache.get(fourth) is not None
+    assert cache.size == 30
+
+
+def test_invalidate():
+    cache = BlobCache(budget=100, max_object_size=10)
+    file = _file()
+    cache.admit(file)
+    cache.put(file, b"0123456789")
+    cache.invalidate(file.file_id)
+    assert cache.get(file) is None
+    assert cache.size == 0
+    # the doorkeeper forgets the file too
+    assert not cache.admit(file)
@@ -0,0 +1,122 @@
+import hashlib
+import io
+import os
+import zlib
+
+import pytest
+
+from models.schemas import DeltaInstruction, DeltaRecipe
+from utils import compression
+from utils.delta import MIN_BLOCK_SIZE, DeltaError, apply_delta, block_signatures
+from utils.storage import iter_blob, stage_chunks
+
+BLOCK = MIN_BLOCK_SIZE
+OLD = os.urandom(BLOCK) + os.urandom(BLOCK) + os.urandom(BLOCK // 2)
+
+needs_zstd = pytest.mark.skipif(not compression.available(), reason="zstandard is not installed")
+
+
+@pytest.fixture(params=[None, pytest.param(compression.ZSTD, marks=needs_zstd)])
+def stored(request, tmp_path):
+    """The old content as a plain or a compressed blob."""
+    staged = stage_chunks([OLD], str(tmp_path / "stored"), compress=request.param is not None)
+    return staged.temp_path, staged.compression
+
+
+def _recipe(new: bytes, instructions: list[dict], **fields) -> DeltaRecipe:
+    return DeltaRecipe(
+        **{
+            "base_version": 1,
+            "block_size": BLOCK,
+            "file_size": len(new),
+            "sha256": hashlib.sha256(new).hexdigest(),
+            "instructions": [DeltaInstruction(**instruction) for instruction in instructions],
+            **fields,
+        }
+    )
+
+
+def _content(staged) -> bytes:
+    return b"".join(iter_blob(staged.temp_path, staged.compression))
+
+
+def test_block_signatures(stored):
+    path, blob_compression = stored
+    blocks = [OLD[:BLOCK], OLD[BLOCK:2 * BLOCK], OLD[2 * BLOCK:]]
+    assert block_signatures(path, blob_compression, BLOCK) == [
+        {"weak": zlib.adler32(block), "strong": hashlib.blake2b(block, digest_size=16).hexdigest()}
+        for block in blocks
+    ]
+
+
+def test_apply_delta_copies_blocks_and_takes_uploaded_data(stored, tmp_path):
+    path, blob_compression = stored
+    new = OLD[:BLOCK] + b"inserted" + OLD[2 * BLOCK:] + OLD[:BLOCK]
+    recipe = _recipe(new, [{"block": 0}, {"data": 8}, {"block": 2}, {"block": 0}])
+    staged = apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(b"inserted"), str(tmp_path / "new"))
+    assert staged.size == len(new)
+    assert _content(staged) == new
+
+
+@needs_zstd
+def test_apply_delta_compresses_the_new_content(stored, tmp_path):
+    path, blob_compression = stored
+    new = OLD[:2 * BLOCK] + b"a" * 100_000
+    recipe = _recipe(new, [{"block": 0, "count": 2}, {"data": 100_000}])
+    staged = apply_delta(
+        path, blob_compression, len(OLD), recipe, io.BytesIO(b"a" * 100_000), str(tmp_path / "new"), compress=True
+    )
+    assert staged.compression == compression.ZSTD
+    assert staged.stored_size < staged.size
+    assert _content(staged) == new
+
+
+def test_apply_delta_keeps_incompressible_content_plain(stored, tmp_path):
+    path, blob_compression = stored
+    recipe = _recipe(OLD, [{"block": 0, "count": 3}])
+    staged = apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(), str(tmp_path / "new"), compress=True)
+    assert staged.compression is None
+    assert _content(staged) == OLD
+
+
+@pytest.mark.parametrize(
+    "instructions, data, message",
+    [
+        ([{"block": 3}], b"", "does not exist"),
+        ([{"block": 2, "count": 2}], b"", "does not exist"),
+        ([{"data": 10}], b"short", "shorter"),
+        ([{"data": 4}], b"longer", "longer"),
+        ([{"block": 0, "data": 4}], b"data", "either block or data"),
+        ([{"count": 2}], b"", "either block or data"),
+    ],
+)
+def test_apply_delta_rejects_recipes_that_do_not_fit(stored, tmp_path, instructions, data, message):
+    path, blob_compression = stored
+    directory = tmp_path / "new"
+    recipe = _recipe(OLD, instructions)
+    with pytest.raises(DeltaError, match=message):
+        apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(data), str(directory))
+    assert not os.listdir(directory)
+
+
+def test_apply_delta_checks_size_and_checksum(stored, tmp_path):
+    path, blob_compression = stored
+    directory = tmp_path / "new"
+    with pytest.raises(DeltaError, match="instead of"):
+        recipe = _recipe(OLD, [{"block": 0}], file_size=len(OLD))
+        apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(), str(directory))
+    with pytest.raises(DeltaError, match="more than file_size"):
+        recipe = _recipe(OLD, [{"block": 0, "count": 3}], file_size=BLOCK)
+        apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(), str(directory))
+    with pytest.raises(DeltaError, match="sha256"):
+        recipe = _recipe(OLD, [{"block": 0, "count": 3}], sha256="0" * 64)
+        apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(), str(directory))
+    assert not os.listdir(directory)
+
+
+@pytest.mark.parametrize("block_size", [MIN_BLOCK_SIZE - 1, 16 * 1024 * 1024])
+def test_apply_delta_rejects_block_sizes_out_of_range(stored, tmp_path, block_size):
+    path, blob_compression = stored
+    recipe = _recipe(OLD, [{"block": 0}], block_size=block_size)
+    with pytest.raises(DeltaError, match="block_size"):
+        apply_delta(path, blob_compression, len(OLD), recipe, io.BytesIO(), str(tmp_path))
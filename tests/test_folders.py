@@ -0,0 +1,57 @@
+import pytest
+
+from utils.folders import check_name, split_relative_path
+
+
+@pytest.mark.parametrize(
+    "path, parts",
+    [
+        ("a.txt", ("a.txt",)),
+        ("photos/2024/a.jpg", ("photos", "2024", "a.jpg")),
+        ("photos\\2024\\a.jpg", ("photos", "2024", "a.jpg")),
+        ("photos//./2024/a.jpg", ("photos", "2024", "a.jpg")),
+        ("photos/", ("photos",)),
+    ],
+)
+def test_split_relative_path(path, parts):
+    assert split_relative_path(path) == parts
+
+
+@pytest.mark.parametrize("path", ["", ".", "/", "/etc/passwd", "../a", "a/../../b", "a/.."])
+def test_split_relative_path_rejects_paths_leaving_the_root(path):
+    with pytest.raises(ValueError):
+        split_relative_path(path)
+
+
+@pytest.mark.parametrize("path", ["a/b\0c.txt", "a\0/b.txt", "\0"])
+def test_split_relative_path_rejects_invalid_names(path):
+    with pytest.raises(ValueError):
+        split_relative_path(path)
+
+
+def test_upload_tree_rejects_invalid_names(client, make_drive):
+    drive = make_drive(0)
+    response = client.post(
+        f"/files/upload-tree/{drive.root_folder_id}",
+        headers=drive.headers,
+        files=[("files", ("a.txt", b"a", "text/plain"))],
+        data={"paths": "docs/a\0.txt"},
+    )
+    assert response.status_code == 400
+
+
+def test_split_relative_path_rejects_long_components():
+    split_relative_path("a/" + "b" * 255)
+    with pytest.raises(ValueError):
+        split_relative_path("a/" + "b" * 256)
+
+
+@pytest.mark.parametrize("name", ["a.txt", ".hidden", "a..b", "ünïcode name"])
+def test_check_name(name):
+    assert check_name(name) == name
+
+
+@pytest.mark.parametrize("name", ["", ".", "..", "a/b", "../a", "a\\b", "a\0b", "x" * 256])
+def test_check_name_rejects(name):
+    with pytest.raises(ValueError):
+        check_name(name)
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from sqlmodel import Session
+
+from config import JobConfig
+from models.postgres_models import Job
+from utils.jobs import DONE, FAILED, PENDING, RUNNING, expire_jobs, run_job
+
+
+def test_expire_jobs(engine, make_drive):
+    drive = make_drive(0)
+    now = datetime.now()
+    stale = now - timedelta(seconds=JobConfig.STALE_SECONDS + 1)
+    old = now - timedelta(days=JobConfig.RETENTION_DAYS, seconds=1)
+    jobs = {
+        "lost_pending": Job(user_id=drive.uid, kind="copy_folder", status=PENDING, updated_at=stale),
+        "lost_running": Job(user_id=drive.uid, kind="copy_folder", status=RUNNING, updated_at=stale),
+        "running": Job(user_id=drive.uid, kind="copy_folder", status=RUNNING, updated_at=now),
+        "old": Job(user_id=drive.uid, kind="copy_folder", status=DONE, updated_at=old, finished_at=old),
+        "recent": Job(user_id=drive.uid, kind="copy_folder", status=DONE, updated_at=now, finished_at=now),
+    }
+    with Session(engine) as db:
+        db.add_all(jobs.values())
+        db.commit()
+        ids = {name: job.job_id for name, job in jobs.items()}
+        expire_jobs(db, now)
+
+        statuses = {name: db.get(Job, job_id) for name, job_id in ids.items()}
+        assert statuses["lost_pending"].status == FAILED
+        assert statuses["lost_running"].status == FAILED
+        assert statuses["lost_running"].finished_at == now
+        assert statuses["running"].status == RUNNING
+        assert statuses["old"] is None
+        assert statuses["recent"].status == DONE
+
+
+def test_run_job_skips_expired_jobs(engine, make_drive):
+    drive = make_drive(0)
+    with Session(engine) as db:
+        job = Job(user_id=drive.uid, kind="copy_folder", status=FAILED, error="Interrupted")
+        db.add(job)
+        db.commit()
+        calls = []
+        run_job(job.job_id, lambda db, progress: calls.append(progress))
+        db.refresh(job)
+        assert not calls
+        assert job.status == FAILED
@@ -0,0 +1,46 @@
+"""
+N+1 checks: every listing endpoint issues as many statements for a large result as for a small one.
+
+The statements of a request are read from the Server-Timing header that
+QueryProfilerMiddleware adds, as the benchmarks do.
+"""
+import re
+
+import pytest
+
+from utils.sql_profiler import assert_constant_query_count
+
+SIZES = (2, 20)
+QUERY_COUNT = re.compile(r'desc="(\d+) queries"')
+
+LISTINGS = {
+    "root_files": lambda drive: ("/files/", {}),
+    "folder_files": lambda drive: ("/files/", {"folder_id": str(drive.folder_id)}),
+    "media": lambda drive: ("/files/media", {"type": "image/"}),
+    "file_versions": lambda drive: (f"/files/versions/{drive.versioned_file_id}", {}),
+    "trashed_files": lambda drive: ("/files/trash", {}),
+    "folders": lambda drive: ("/folder/", {}),
+    "folder_tree": lambda drive: ("/folder/tree", {"include_files": True}),
+    "folder_contents": lambda drive: (f"/folder/all/{drive.root_folder_id}", {}),
+    "trashed_folders": lambda drive: ("/folder/trash/", {}),
+    "trashed_folder_contents": lambda drive: (f"/folder/trash/{drive.trashed_folder_id}", {}),
+    "jobs": lambda drive: ("/jobs/", {}),
+}
+
+
+def _query_count(response) -> int:
+    match = QUERY_COUNT.search(response.headers.get("server-timing", ""))
+    assert match, "no query count in the Server-Timing header"
+    return int(match.group(1))
+
+
+@pytest.mark.parametrize("listing", sorted(LISTINGS))
+def test_query_count_does_not_grow_with_result(client, make_drive, listing):
+    counts = {}
+    for size in SIZES:
+        drive = make_drive(size)
+        path, params = LISTINGS[listing](drive)
+        response = client.get(path, params=params, headers=drive.headers)
+        assert response.status_code == 200, response.text
+        counts[size] = _query_count(response)
+    assert_constant_query_count(counts)
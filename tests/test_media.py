@@ -0,0 +1,37 @@
+import struct
+
+import pytest
+
+from utils.media import sniff_type
+
+
+@pytest.mark.parametrize(
+    "head, content_type",
+    [
+        (b"\x89PNG\r\n\x1a\n" + b"\0" * 8, "image/png"),
+        (b"\xff\xd8\xff\xe0\0\x10JFIF", "image/jpeg"),
+        (b"GIF89a\x01\0", "image/gif"),
+        (b"%PDF-1.7\n", "application/pdf"),
+        (b"PK\x03\x04\x14\0", "application/zip"),
+        (b"RIFF" + struct.pack("<I", 100) + b"WEBPVP8 ", "image/webp"),
+        (b"RIFF" + struct.pack("<I", 100) + b"WAVEfmt ", "audio/wav"),
+        (b"\0\0\0\x18ftypheic", "image/heic"),
+        (b"\0\0\0\x18ftypisom", "video/mp4"),
+        (b"\xff\xfb\x90\x64", "audio/mpeg"),
+        (b"ID3\x04\0", "audio/mpeg"),
+        (b"hello, world\n", "text/plain"),
+        ("café".encode(), "text/plain"),
+    ],
+)
+def test_sniff_type(head, content_type):
+    assert sniff_type(head) == content_type
+
+
+def test_sniff_type_accepts_text_cut_off_in_a_character():
+    head = ("a" * 100 + "€").encode()[:-1]
+    assert sniff_type(head) == "text/plain"
+
+
+@pytest.mark.parametrize("head", [b"", b"\0\x01\x02\x03", b"RIFF\0\0\0\0JUNK", b"\xc3\x28" + b"a" * 20])
+def test_sniff_type_unknown(head):
+    assert sniff_type(head) is None
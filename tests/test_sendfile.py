@@ -0,0 +1,33 @@
+import pytest
+from fastapi import HTTPException
+
+from utils.sendfile import parse_range
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 100)),
+        ("bytes=100-", (100, 1000)),
+        ("bytes=-100", (900, 1000)),
+        ("bytes=-5000", (0, 1000)),
+        ("bytes=900-5000", (900, 1000)),
+        ("bytes=999-999", (999, 1000)),
+        (" bytes=0-0", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [None, "", "items=0-10", "bytes=0-10,20-30", "bytes=a-b", "bytes=-"])
+def test_parse_range_sends_the_whole_file(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [("bytes=1000-", 1000), ("bytes=5-2", 1000), ("bytes=-0", 1000), ("bytes=0-", 0)])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(HTTPException) as exc_info:
+        parse_range(header, size)
+    assert exc_info.value.status_code == 416
+    assert exc_info.value.headers["Content-Range"] == f"bytes */{size}"
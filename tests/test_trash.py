@@ -0,0 +1,37 @@
+from sqlmodel import Session
+
+from models.postgres_models import FileMetadata
+from utils.trash import purge_trashed_files
+
+
+def _trashed_files(db, drive):
+    return (
+        db.query(FileMetadata)
+        .filter(FileMetadata.user_id == drive.uid, FileMetadata.is_trashed == True)
+        .order_by(FileMetadata.file_name)
+        .all()
+    )
+
+
+def test_purge_skips_a_file_being_restored(engine, make_drive):
+    drive = make_drive(2)
+    with Session(engine) as restore, Session(engine) as purge:
+        restored = _trashed_files(restore, drive)[0]
+        restore.refresh(restored, with_for_update=True)
+        purged = purge_trashed_files(purge, user_id=drive.uid)
+        restored.is_trashed = False
+        restored.trashed_at = None
+        restore.commit()
+
+        assert purged == 3
+        assert not _trashed_files(purge, drive)
+        assert purge.get(FileMetadata, (drive.uid, restored.file_id)).is_trashed is False
+
+
+def test_restore_after_purge_is_not_found(client, engine, make_drive):
+    drive = make_drive(2)
+    with Session(engine) as db:
+        file_id = _trashed_files(db, drive)[0].file_id
+        purge_trashed_files(db, user_id=drive.uid)
+    response = client.get(f"/files/untrash/{file_id}", headers=drive.headers)
+    assert response.status_code == 404